@@ -0,0 +1,60 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy.orm import Session
+
+from app.db import get_db
+from app.models_ai_reply_cache import ReviewAIReplyBatch
+from app.ai_reply_batch import (
+    batch_to_dict,
+    poll_reply_batch,
+    submit_reply_batch,
+)
+
+router = APIRouter(prefix="/reviews/ai-replies/batch", tags=["ai-replies-batch"])
+
+
+def _openai_client(request: Request):
+    openai_client = request.app.state.openai_client
+    if not openai_client:
+        raise HTTPException(500, "IA no configurada (OPENAI_API_KEY falta)")
+    return openai_client
+
+
+@router.post("")
+def create_ai_replies_batch(
+    request: Request,
+    job_id: int = Query(..., description="ID del job (local)"),
+    db: Session = Depends(get_db),
+):
+    """
+    Genera en modo batch TODAS las respuestas IA que faltan del job
+    (histórico completo). Devuelve enseguida; consultar con GET /{batch_id}.
+    """
+    openai_client = _openai_client(request)
+
+    try:
+        batch = submit_reply_batch(db, job_id=job_id, openai_client=openai_client)
+    except Exception as e:
+        raise HTTPException(500, f"No se pudo enviar el batch: {e}")
+
+    return batch_to_dict(batch)
+
+
+@router.get("/{batch_id}")
+def get_ai_replies_batch(
+    request: Request,
+    batch_id: int,
+    db: Session = Depends(get_db),
+):
+    batch = db.get(ReviewAIReplyBatch, batch_id)
+    if not batch:
+        raise HTTPException(404, "Batch no encontrado")
+
+    try:
+        batch = poll_reply_batch(db, batch=batch, openai_client=_openai_client(request))
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        print("⚠️ ai_reply_batch poll:", repr(e))
+
+    return batch_to_dict(batch)
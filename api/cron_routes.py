@@ -1,9 +1,11 @@
 import os
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.orm import Session
 from app.db import get_db
 from api.reviews_sync import sync_reviews_all, sync_reviews_for_job
 from app.review_requests.sender import process_pending
+from app.ai_reply_batch import poll_pending_reply_batches
+from app.review_requests.import_repo import fail_stale_import_batches
 
 router = APIRouter(prefix="/cron", tags=["cron"])
 
@@ -31,4 +33,26 @@ def cron_send_review_requests(
     db: Session = Depends(get_db),
 ):
     _check_secret(secret)
-    return process_pending(db)
\ No newline at end of file
+    return process_pending(db)
+
+@router.post("/poll-ai-reply-batches")
+def cron_poll_ai_reply_batches(
+    request: Request,
+    secret: str = Query(...),
+    db: Session = Depends(get_db),
+):
+    _check_secret(secret)
+
+    openai_client = request.app.state.openai_client
+    if not openai_client:
+        raise HTTPException(500, "IA no configurada (OPENAI_API_KEY falta)")
+
+    return poll_pending_reply_batches(db, openai_client=openai_client)
+
+@router.post("/fail-stale-imports")
+def cron_fail_stale_imports(
+    secret: str = Query(...),
+    db: Session = Depends(get_db),
+):
+    _check_secret(secret)
+    return {"failed": fail_stale_import_batches(db)}
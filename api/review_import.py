@@ -5,27 +5,49 @@ import os
 import re
 import shutil
 import tempfile
-from typing import Any, Dict, List, Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterator, List, Optional
 from datetime import datetime, timezone
 from pathlib import Path
-import mimetypes
 from datetime import datetime, timezone, date
-import boto3
-from botocore.client import Config
 from app.review_requests.import_normalizers import normalize_name, normalize_phone
 import pandas as pd
 from openai import OpenAI
-from pypdf import PdfReader
 
 
 from fastapi import APIRouter, File, UploadFile, HTTPException, Form, Depends
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 
 
-from app.db import get_db
-from app.review_requests.import_service import import_appointments_payloads
+from app.db import SessionLocal, get_db
+from app.llm_cache import cached_llm_call, file_sha256
+from app.pdf_text import extract_pdf_pages
+from app.review_requests.import_models import ReviewImportBatch
+from app.review_requests.import_repo import (
+    claim_import_file,
+    create_import_batch,
+    find_imported_file_by_hash,
+    mark_import_batch_failed,
+    release_import_claims,
+    touch_import_batches,
+    get_cached_extraction,
+    save_cached_extraction,
+)
+from app.review_requests.import_service import (
+    MANUAL_REVIEW_USER_MESSAGE,
+    duplicate_files_result,
+    import_appointments_payloads,
+    processing_result,
+)
 from app.review_requests.import_schemas import ImportBatchOut
+from app.review_requests.import_storage import (
+    enqueue_original_upload,
+    persist_storage_keys_when_done,
+)
 
 
 router = APIRouter(prefix="/api/reviews", tags=["reviews-import"])
@@ -38,70 +60,117 @@ DEFAULT_COUNTRY = os.getenv("DEFAULT_COUNTRY", "ES")
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 
-STORAGE_BUCKET = os.getenv("REVIEW_IMPORTS_BUCKET")
-STORAGE_REGION = os.getenv("AWS_REGION", "us-east-1")
-STORAGE_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
-AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-print("BUCKET:", os.getenv("REVIEW_IMPORTS_BUCKET"))
-print("KEY:", os.getenv("AWS_ACCESS_KEY_ID"))
-print("ENDPOINT:", os.getenv("S3_ENDPOINT_URL"))
+# Versión del extractor (prompts + normalización). Subirla invalida las
+# extracciones guardadas en review_import_extractions.
+IMPORT_EXTRACTOR_VERSION = os.getenv("IMPORT_EXTRACTOR_VERSION", "v3")
 
-def _get_s3_client():
-    if not STORAGE_BUCKET or not AWS_ACCESS_KEY_ID or not AWS_SECRET_ACCESS_KEY or not STORAGE_ENDPOINT_URL:
-        raise RuntimeError(
-            "Storage no configurado: faltan REVIEW_IMPORTS_BUCKET / AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY / S3_ENDPOINT_URL"
-        )
+# Estos formatos se parsean en local: no compensa guardar su extracción
+STRUCTURED_EXTENSIONS = {".csv", ".xlsx", ".xls", ".json"}
 
-    return boto3.client(
-        "s3",
-        endpoint_url=STORAGE_ENDPOINT_URL,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        region_name=STORAGE_REGION,
-        config=Config(signature_version="s3v4"),
-    )
+# Nº máximo de llamadas LLM simultáneas al extraer un texto largo por chunks
+IMPORT_TEXT_CHUNK_CONCURRENCY = int(os.getenv("IMPORT_TEXT_CHUNK_CONCURRENCY", "4"))
 
+# Archivos de una misma subida extraídos a la vez
+IMPORT_FILE_CONCURRENCY = int(os.getenv("IMPORT_FILE_CONCURRENCY", "4"))
 
-def _safe_filename(filename: str) -> str:
-    name = os.path.basename(filename or "upload")
-    name = re.sub(r"[^A-Za-z0-9._-]+", "_", name)
-    return name[:180] or "upload"
+# Importaciones en segundo plano (background=true): el endpoint responde
+# enseguida y el dashboard consulta /import-appointments/{batch_id}/status
+IMPORT_BACKGROUND_WORKERS = int(os.getenv("IMPORT_BACKGROUND_WORKERS", "2"))
+_import_executor = ThreadPoolExecutor(
+    max_workers=IMPORT_BACKGROUND_WORKERS,
+    thread_name_prefix="review-import",
+)
 
+# Latido de los lotes en segundo plano de este proceso (encolados o en curso):
+# una extracción larga (LLM/PDF) no escribe progreso y el barrido de lotes
+# colgados (IMPORT_STALE_BATCH_SECONDS) no debe darlos por muertos
+IMPORT_HEARTBEAT_SECONDS = int(os.getenv("IMPORT_HEARTBEAT_SECONDS", "60"))
+_live_batches: set[int] = set()
+_cancelled_batches: set[int] = set()
+_live_batches_lock = threading.Lock()
+_heartbeat_thread: Optional[threading.Thread] = None
 
-def _store_original_upload(
-    *,
-    job_id: int,
-    filename: str,
-    content: bytes,
-    content_type: Optional[str],
-    file_hash: str,
-) -> dict[str, Any]:
-    s3 = _get_s3_client()
 
-    safe_name = _safe_filename(filename)
-    now = datetime.now(timezone.utc)
-    guessed_type = content_type or mimetypes.guess_type(safe_name)[0] or "application/octet-stream"
+def _heartbeat_loop() -> None:
+    while True:
+        time.sleep(IMPORT_HEARTBEAT_SECONDS)
+        with _live_batches_lock:
+            batch_ids = set(_live_batches)
+        if not batch_ids:
+            continue
 
-    key = (
-        f"review-imports/job_{job_id}/"
-        f"{now.strftime('%Y/%m/%d/%H%M%S')}_{file_hash[:12]}_{safe_name}"
-    )
+        db = SessionLocal()
+        try:
+            alive = touch_import_batches(db, batch_ids=batch_ids)
+            with _live_batches_lock:
+                # ya no están en 'processing' (marcados como fallidos fuera)
+                _cancelled_batches.update((batch_ids - alive) & _live_batches)
+        except Exception as e:
+            db.rollback()
+            print("⚠️ latido de importaciones:", repr(e))
+        finally:
+            db.close()
 
-    s3.put_object(
-        Bucket=STORAGE_BUCKET,
-        Key=key,
-        Body=content,
-        ContentType=guessed_type,
-    )
 
-    return {
-        "storage_provider": "supabase_s3",
-        "storage_bucket": STORAGE_BUCKET,
-        "storage_key": key,
-        "storage_url": None,
-        "size_bytes": len(content),
-    }
+def _register_live_batch(batch_id: int) -> None:
+    global _heartbeat_thread
+    with _live_batches_lock:
+        _live_batches.add(batch_id)
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(
+                target=_heartbeat_loop, name="review-import-heartbeat", daemon=True
+            )
+            _heartbeat_thread.start()
+
+
+def _unregister_live_batch(batch_id: int) -> None:
+    with _live_batches_lock:
+        _live_batches.discard(batch_id)
+        _cancelled_batches.discard(batch_id)
+
+
+def _batch_cancelled(batch_id: int) -> bool:
+    with _live_batches_lock:
+        return batch_id in _cancelled_batches
+
+# Reserva de (job, sha256) mientras se importa: evita procesar dos veces el
+# mismo archivo subido a la vez; pasado este tiempo se considera abandonada
+IMPORT_CLAIM_TTL_SECONDS = int(os.getenv("IMPORT_CLAIM_TTL_SECONDS", str(3 * 3600)))
+
+# Importación en streaming (CSV/Excel grandes): memoria acotada por chunk, no por archivo
+UPLOAD_SPOOL_BLOCK_BYTES = 1024 * 1024
+IMPORT_STREAM_THRESHOLD_BYTES = int(os.getenv("IMPORT_STREAM_THRESHOLD_BYTES", str(5 * 1024 * 1024)))
+IMPORT_STREAM_CHUNK_ROWS = int(os.getenv("IMPORT_STREAM_CHUNK_ROWS", "5000"))
+
+print("BUCKET:", os.getenv("REVIEW_IMPORTS_BUCKET"))
+print("KEY:", os.getenv("AWS_ACCESS_KEY_ID"))
+print("ENDPOINT:", os.getenv("S3_ENDPOINT_URL"))
+
+
+async def _spool_upload(upload: UploadFile, suffix: str) -> tuple[str, str, int]:
+    """
+    Copia el UploadFile a un temporal en bloques (sin leerlo entero en memoria)
+    calculando el sha256 a la vez. Devuelve (ruta, sha256, tamaño).
+    """
+    h = hashlib.sha256()
+    size = 0
+
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        tmp_path = tmp.name
+        try:
+            while True:
+                block = await upload.read(UPLOAD_SPOOL_BLOCK_BYTES)
+                if not block:
+                    break
+                h.update(block)
+                size += len(block)
+                tmp.write(block)
+        except Exception:
+            tmp.close()
+            os.unlink(tmp_path)
+            raise
+
+    return tmp_path, h.hexdigest(), size
 
 def _clean_phone(raw: str) -> Optional[str]:
     if not raw:
@@ -192,28 +261,23 @@ def _try_read_text_file(tmp_path: str) -> Optional[str]:
 
 
     return None
-def _extract_pdf_text(file_path: str) -> Optional[str]:
+def _extract_pdf_pages(file_path: str, file_hash: Optional[str] = None) -> list[str]:
     """
-    Extrae texto plano de un PDF usando pypdf.
-    Devuelve None si no puede extraer nada útil.
+    Texto de cada página del PDF (cadena vacía si la página no tiene texto).
+    En PDFs grandes se reparte por rangos de páginas en un pool de procesos.
+    file_hash: sha256 ya calculado al volcar la subida (evita releer el PDF).
     """
-    try:
-        reader = PdfReader(file_path)
-        pages_text = []
-
-        for page in reader.pages:
-            try:
-                text = page.extract_text() or ""
-            except Exception:
-                text = ""
+    return extract_pdf_pages(file_path, file_hash=file_hash)
 
-            if text and text.strip():
-                pages_text.append(text)
 
-        full_text = "\n".join(pages_text).strip()
-        return full_text or None
-    except Exception:
-        return None
+def _extract_pdf_text(file_path: str, file_hash: Optional[str] = None) -> Optional[str]:
+    """
+    Extrae texto plano de un PDF usando pypdf.
+    Devuelve None si no puede extraer nada útil.
+    """
+    pages_text = [t for t in _extract_pdf_pages(file_path, file_hash) if t and t.strip()]
+    full_text = "\n".join(pages_text).strip()
+    return full_text or None
 
 
 def _normalize_detected_date(raw: str) -> Optional[str]:
@@ -500,6 +564,176 @@ def _extract_appointments_from_text_locally(text: str) -> Optional[Dict[str, Any
         "unparsed": [],
     }
 
+# =========================
+# PDF local-first: agendas tabulares (una cita por línea)
+# =========================
+
+_AGENDA_TIME_RE = re.compile(r"\b(\d{1,2}:\d{2})(?::\d{2})?\b")
+_AGENDA_DATE_RES = [
+    re.compile(r"\b(\d{4}-\d{2}-\d{2})\b"),
+    re.compile(r"\b(\d{1,2}/\d{1,2}/\d{4})\b"),
+    re.compile(r"\b(\d{1,2}-\d{1,2}-\d{4})\b"),
+    re.compile(r"\b(\d{1,2}/\d{1,2}/\d{2})\b"),
+]
+_AGENDA_PHONE_RE = re.compile(r"(\+?\d[\d\s().-]{7,}\d)")
+_AGENDA_NAME_STRIP_RE = re.compile(r"[|;,\-–—:()\[\]\t]+")
+_AGENDA_DIGITS_RE = re.compile(r"\d")
+
+# Máximo de filas incompletas (sin nombre/fecha/hora) para fiarse de una página
+PDF_LOCAL_MAX_INCOMPLETE_RATIO = float(os.getenv("PDF_LOCAL_MAX_INCOMPLETE_RATIO", "0.2"))
+
+
+def _parse_agenda_line(line: str, current_date: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Una fila de agenda: hora + nombre (+ teléfono, + fecha).
+    La fecha, si no viene en la fila, es la de la última cabecera vista.
+    """
+    time_match = _AGENDA_TIME_RE.search(line)
+    if not time_match:
+        return None
+
+    rest = line
+    row_date = None
+    for date_re in _AGENDA_DATE_RES:
+        m = date_re.search(rest)
+        if m:
+            row_date = _normalize_detected_date(m.group(1))
+            rest = rest[:m.start()] + " " + rest[m.end():]
+            break
+
+    time = _normalize_detected_time(time_match.group(1))
+    # rangos "10:00 - 10:30": se queda la hora de inicio
+    rest = _AGENDA_TIME_RE.sub(" ", rest)
+
+    phone = None
+    phone_match = _AGENDA_PHONE_RE.search(rest)
+    if phone_match:
+        phone = _clean_phone(phone_match.group(1))
+        rest = rest[:phone_match.start()] + " " + rest[phone_match.end():]
+
+    name = _AGENDA_NAME_STRIP_RE.sub(" ", rest)
+    name = re.sub(r"\s+", " ", name).strip()
+    if not any(ch.isalpha() for ch in name) or name.lower() in SPANISH_WEEKDAYS:
+        name = None
+
+    date = row_date or current_date
+
+    issues = []
+    if not name:
+        issues.append("missing_name")
+    if not phone:
+        issues.append("missing_phone")
+    if not date:
+        issues.append("missing_date")
+    if not time:
+        issues.append("missing_time")
+
+    return {
+        "name": name,
+        "phone": phone,
+        "date": date,
+        "time": time,
+        "timezone": DEFAULT_TZ,
+        "notes": None,
+        "confidence": 0.9 if len(issues) <= 1 else 0.6,
+        "issues": issues,
+    }
+
+
+def _parse_agenda_page(
+    text: str,
+    current_date: Optional[str],
+) -> tuple[list[Dict[str, Any]], bool, Optional[str]]:
+    """
+    Devuelve (citas, fiable, fecha_cabecera_al_final).
+
+    Una página es fiable si sus filas están casi todas completas y no quedan
+    líneas sueltas con teléfonos/números que el parser no supo colocar.
+    """
+    rows: list[Dict[str, Any]] = []
+    suspicious_leftovers = 0
+
+    for raw_line in (text or "").splitlines():
+        line = raw_line.strip()
+        if not line:
+            continue
+
+        row = _parse_agenda_line(line, current_date)
+        if row is not None:
+            rows.append(row)
+            continue
+
+        # cabecera de día: "14/04/2025", "Lunes 14 de abril de 2025"...
+        header_date = None
+        for date_re in _AGENDA_DATE_RES:
+            m = date_re.search(line)
+            if m:
+                header_date = _normalize_detected_date(m.group(1))
+                break
+        if not header_date:
+            header_date = _parse_spanish_text_date(line)
+        if header_date:
+            current_date = header_date
+            continue
+
+        if _AGENDA_PHONE_RE.search(line) or len(_AGENDA_DIGITS_RE.findall(line)) >= 6:
+            suspicious_leftovers += 1
+
+    if not rows:
+        return [], suspicious_leftovers == 0, current_date
+
+    incomplete = sum(
+        1 for r in rows if not (r["name"] and r["date"] and r["time"])
+    )
+    reliable = (
+        incomplete / len(rows) <= PDF_LOCAL_MAX_INCOMPLETE_RATIO
+        and suspicious_leftovers <= max(2, len(rows) // 10)
+    )
+    return rows, reliable, current_date
+
+
+def _extract_pdf_local_first(
+    file_path: str,
+    filename: str,
+    file_hash: Optional[str] = None,
+    read_only: bool = False,
+) -> Optional[Dict[str, Any]]:
+    """
+    PDF con texto: se parsea página a página en local y solo las páginas
+    dudosas se mandan al LLM (como texto). Devuelve None si el PDF no tiene
+    texto (escaneado) y hay que mandarlo entero a OpenAI.
+    """
+    pages = _extract_pdf_pages(file_path, file_hash)
+    if not any(p and p.strip() for p in pages):
+        return None
+
+    appointments: list[Dict[str, Any]] = []
+    unparsed: list[Any] = []
+    llm_pages: list[str] = []
+    current_date = None
+
+    for text in pages:
+        if not text or not text.strip():
+            continue
+        rows, reliable, current_date = _parse_agenda_page(text, current_date)
+        if reliable:
+            appointments.extend(rows)
+        else:
+            llm_pages.append(text)
+
+    print(
+        f"📄 PDF local-first {filename}: {len(pages)} páginas, "
+        f"{len(appointments)} citas en local, {len(llm_pages)} páginas al LLM"
+    )
+
+    if llm_pages:
+        data = _openai_extract_from_text("\n\n".join(llm_pages), filename, read_only)
+        appointments.extend(data.get("appointments", []))
+        unparsed.extend(data.get("unparsed", []))
+
+    return {"appointments": appointments, "unparsed": unparsed}
+
+
 JSON_SCHEMA: Dict[str, Any] = {
     "name": "appointments_extract",
     "schema": {
@@ -568,15 +802,16 @@ def _normalize_extracted_appointments(data: Dict[str, Any]) -> Dict[str, Any]:
 
 
 
-def _openai_extract(file_path: str, filename: str) -> Dict[str, Any]:
+def _openai_extract(
+    file_path: str,
+    filename: str,
+    read_only: bool = False,
+    file_hash: Optional[str] = None,
+) -> Dict[str, Any]:
     import json
     import re
 
 
-    with open(file_path, "rb") as f:
-        uploaded = client.files.create(file=f, purpose="user_data")
-
-
     prompt = f"""
 Eres un extractor de citas de clínica.
 Devuelve SOLO JSON.
@@ -611,70 +846,75 @@ Archivo: {filename}
 """.strip()
 
 
-    base_payload = dict(
-        model="gpt-4.1-mini",
-        input=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": prompt},
-                    {"type": "input_file", "file_id": uploaded.id},
-                ],
-            }
-        ],
-    )
-
-
-    try:
-        resp = client.responses.create(
-            **base_payload,
-            response_format={
-                "type": "json_schema",
-                "json_schema": JSON_SCHEMA,
-            },
-        )
-        return json.loads(resp.output_text)
-    except TypeError:
-        pass
-
+    def _call() -> Dict[str, Any]:
+        with open(file_path, "rb") as f:
+            uploaded = client.files.create(file=f, purpose="user_data")
 
-    try:
-        resp = client.responses.create(
-            **base_payload,
-            format={
-                "type": "json_schema",
-                "json_schema": JSON_SCHEMA,
-            },
+        base_payload = dict(
+            model="gpt-4.1-mini",
+            input=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "input_text", "text": prompt},
+                        {"type": "input_file", "file_id": uploaded.id},
+                    ],
+                }
+            ],
         )
-        return json.loads(resp.output_text)
-    except TypeError:
-        pass
-
-
-    resp = client.responses.create(**base_payload)
-    text = resp.output_text or ""
-    m = re.search(r"\{.*\}", text, re.DOTALL)
-    if not m:
-        raise ValueError(f"No se encontró JSON en la respuesta: {text[:300]}")
-    return json.loads(m.group(0))
 
 
+        try:
+            resp = client.responses.create(
+                **base_payload,
+                response_format={
+                    "type": "json_schema",
+                    "json_schema": JSON_SCHEMA,
+                },
+            )
+            return json.loads(resp.output_text)
+        except TypeError:
+            pass
 
 
-def _openai_extract_from_text(text: str, filename: str) -> Dict[str, Any]:
+        try:
+            resp = client.responses.create(
+                **base_payload,
+                format={
+                    "type": "json_schema",
+                    "json_schema": JSON_SCHEMA,
+                },
+            )
+            return json.loads(resp.output_text)
+        except TypeError:
+            pass
 
 
-    chunks = _chunk_text(text, 25000)
+        resp = client.responses.create(**base_payload)
+        text = resp.output_text or ""
+        m = re.search(r"\{.*\}", text, re.DOTALL)
+        if not m:
+            raise ValueError(f"No se encontró JSON en la respuesta: {text[:300]}")
+        return json.loads(m.group(0))
 
 
-    all_appointments = []
-    all_unparsed = []
+    # El file_id cambia en cada subida: la clave usa el hash del contenido
+    # (el ya calculado al volcar la subida si se conoce)
+    return json.loads(
+        cached_llm_call(
+            model="gpt-4.1-mini",
+            temperature=None,
+            prompt={"prompt": prompt, "file_sha256": file_hash or file_sha256(file_path)},
+            compute=lambda: json.dumps(_call(), ensure_ascii=False),
+            read_only=read_only,
+        )
+    )
 
 
-    for chunk in chunks:
 
 
-        prompt = f"""
+def _openai_extract_text_chunk(chunk: str, filename: str, read_only: bool = False) -> Dict[str, Any]:
+    prompt = f"""
 Eres un extractor automático de citas médicas.
 
 
@@ -715,7 +955,7 @@ Contenido del archivo ({filename}):
 {chunk}
 """.strip()
 
-
+    def _call() -> str:
         resp = client.responses.create(
             model="gpt-4.1-mini",
             input=[{
@@ -723,32 +963,49 @@ Contenido del archivo ({filename}):
                 "content": [{"type": "input_text", "text": prompt}],
             }],
         )
+        return resp.output_text or ""
 
+    out = cached_llm_call(
+        model="gpt-4.1-mini",
+        temperature=None,
+        prompt=prompt,
+        compute=_call,
+        read_only=read_only,
+    )
+    m = re.search(r"\{[\s\S]*\}", out)
+    if not m:
+        return {"appointments": [], "unparsed": []}
 
-        out = resp.output_text or ""
-        m = re.search(r"\{[\s\S]*\}", out)
-
+    return json.loads(m.group(0))
 
-        if not m:
-            continue
 
+def _openai_extract_from_text(text: str, filename: str, read_only: bool = False) -> Dict[str, Any]:
+    chunks = _chunk_text(text, 25000)
 
-        data = json.loads(m.group(0))
+    all_appointments = []
+    all_unparsed = []
 
+    # los chunks se extraen en paralelo; map() conserva el orden del texto
+    workers = max(1, min(IMPORT_TEXT_CHUNK_CONCURRENCY, len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda c: _openai_extract_text_chunk(c, filename, read_only), chunks))
 
+    for data in results:
         all_appointments.extend(data.get("appointments", []))
         all_unparsed.extend(data.get("unparsed", []))
 
-
     return {
         "appointments": all_appointments,
         "unparsed": all_unparsed
     }
 
 
-
-
-def _openai_extract_image(file_path: str, filename: str) -> Dict[str, Any]:
+def _openai_extract_image(
+    file_path: str,
+    filename: str,
+    read_only: bool = False,
+    file_hash: Optional[str] = None,
+) -> Dict[str, Any]:
     import base64
     import json
     import re
@@ -763,10 +1020,6 @@ def _openai_extract_image(file_path: str, filename: str) -> Dict[str, Any]:
         "heic": "image/heic",
     }.get(ext, "image/png")
 
-    with open(file_path, "rb") as f:
-        b64 = base64.b64encode(f.read()).decode("utf-8")
-
-    data_url = f"data:{mime};base64,{b64}"
     current_year = datetime.now().year
 
     prompt = f"""
@@ -816,56 +1069,77 @@ Objetivo:
 Archivo: {filename}
 """.strip()
 
-    base_payload = dict(
-        model="gpt-4.1",
-        input=[{
-            "role": "user",
-            "content": [
-                {"type": "input_text", "text": prompt},
-                {"type": "input_image", "image_url": data_url},
-            ],
-        }],
-    )
+    def _call() -> Dict[str, Any]:
+        with open(file_path, "rb") as f:
+            b64 = base64.b64encode(f.read()).decode("utf-8")
 
-    try:
-        resp = client.responses.create(
-            **base_payload,
-            response_format={
-                "type": "json_schema",
-                "json_schema": JSON_SCHEMA,
-            },
-        )
-        return json.loads(resp.output_text)
-    except TypeError:
-        pass
+        data_url = f"data:{mime};base64,{b64}"
 
-    try:
-        resp = client.responses.create(
-            **base_payload,
-            format={
-                "type": "json_schema",
-                "json_schema": JSON_SCHEMA,
-            },
+        base_payload = dict(
+            model="gpt-4.1",
+            input=[{
+                "role": "user",
+                "content": [
+                    {"type": "input_text", "text": prompt},
+                    {"type": "input_image", "image_url": data_url},
+                ],
+            }],
         )
-        return json.loads(resp.output_text)
-    except TypeError:
-        pass
 
-    resp = client.responses.create(**base_payload)
-    out = resp.output_text or ""
-    m = re.search(r"\{[\s\S]*\}", out)
-    if not m:
-        raise ValueError(f"No se encontró JSON en la respuesta: {out[:300]}")
-    return json.loads(m.group(0))
+        try:
+            resp = client.responses.create(
+                **base_payload,
+                response_format={
+                    "type": "json_schema",
+                    "json_schema": JSON_SCHEMA,
+                },
+            )
+            return json.loads(resp.output_text)
+        except TypeError:
+            pass
+
+        try:
+            resp = client.responses.create(
+                **base_payload,
+                format={
+                    "type": "json_schema",
+                    "json_schema": JSON_SCHEMA,
+                },
+            )
+            return json.loads(resp.output_text)
+        except TypeError:
+            pass
 
-def _extract_with_openai(tmp_path: str, filename: str) -> Dict[str, Any]:
+        resp = client.responses.create(**base_payload)
+        out = resp.output_text or ""
+        m = re.search(r"\{[\s\S]*\}", out)
+        if not m:
+            raise ValueError(f"No se encontró JSON en la respuesta: {out[:300]}")
+        return json.loads(m.group(0))
+
+    return json.loads(
+        cached_llm_call(
+            model="gpt-4.1",
+            temperature=None,
+            prompt={"prompt": prompt, "image_sha256": file_hash or file_sha256(file_path)},
+            compute=lambda: json.dumps(_call(), ensure_ascii=False),
+            read_only=read_only,
+        )
+    )
+
+def _extract_with_openai(
+    tmp_path: str,
+    filename: str,
+    file_hash: Optional[str] = None,
+    read_only: bool = False,
+) -> Dict[str, Any]:
     # 1) .gz -> descomprimir y volver a procesar
     if _is_gz(filename):
         extracted_path = None
         try:
             extracted_path, inner_filename = _gunzip_file(tmp_path, filename)
             print(f"📦 .gz detectado: {filename} -> archivo interno: {inner_filename}")
-            return _extract_with_openai(extracted_path, inner_filename)
+            return _extract_with_openai(extracted_path, inner_filename, read_only=read_only)
         finally:
             if extracted_path:
                 try:
@@ -922,41 +1196,9 @@ def _extract_with_openai(tmp_path: str, filename: str) -> Dict[str, Any]:
                     if not df.empty:
                         print(f"🧾 archivo sin extensión tratado como JSON: {filename}")
 
-                        columns_map = {str(c).strip().lower(): c for c in df.columns}
-                        phone_cols = [
-                            orig for low, orig in columns_map.items()
-                            if any(k in low for k in ["phone", "movil", "móvil", "mobile", "tel", "telefono", "teléfono"])
-                        ]
-                        name_cols = [
-                            orig for low, orig in columns_map.items()
-                            if any(k in low for k in ["name", "patient", "nombre", "paciente", "cliente"])
-                        ]
-                        date_cols = [
-                            orig for low, orig in columns_map.items()
-                            if any(k in low for k in ["date", "fecha", "dia", "día"])
-                        ]
-                        time_cols = [
-                            orig for low, orig in columns_map.items()
-                            if any(k in low for k in ["time", "hora", "inicio"])
-                        ]
-
-                        appointments = []
-                        for _, row in df.iterrows():
-                            name = row.get(name_cols[0]) if name_cols else None
-                            phone = row.get(phone_cols[0]) if phone_cols else None
-                            date = row.get(date_cols[0]) if date_cols else None
-                            time = row.get(time_cols[0]) if time_cols else None
-
-                            appointments.append({
-                                "name": str(name).strip() if name is not None and str(name).strip() else None,
-                                "phone": _clean_phone(str(phone)) if phone is not None and str(phone).strip() else None,
-                                "date": str(date).strip() if date is not None and str(date).strip() else None,
-                                "time": str(time).strip()[:5] if time is not None and str(time).strip() else None,
-                                "timezone": DEFAULT_TZ,
-                                "notes": None,
-                                "confidence": 1.0,
-                                "issues": [],
-                            })
+                        appointments = _appointments_from_dataframe(
+                            df, **_detect_columns_loose(df)
+                        )
 
                         return _normalize_extracted_appointments({
                             "appointments": appointments,
@@ -972,41 +1214,9 @@ def _extract_with_openai(tmp_path: str, filename: str) -> Dict[str, Any]:
                 if df is not None and not df.empty:
                     print(f"📊 archivo sin extensión tratado como CSV: {filename}")
 
-                    columns_map = {str(c).strip().lower(): c for c in df.columns}
-                    phone_cols = [
-                        orig for low, orig in columns_map.items()
-                        if any(k in low for k in ["phone", "movil", "móvil", "mobile", "tel", "telefono", "teléfono"])
-                    ]
-                    name_cols = [
-                        orig for low, orig in columns_map.items()
-                        if any(k in low for k in ["name", "patient", "nombre", "paciente", "cliente"])
-                    ]
-                    date_cols = [
-                        orig for low, orig in columns_map.items()
-                        if any(k in low for k in ["date", "fecha", "dia", "día"])
-                    ]
-                    time_cols = [
-                        orig for low, orig in columns_map.items()
-                        if any(k in low for k in ["time", "hora", "inicio"])
-                    ]
-
-                    appointments = []
-                    for _, row in df.iterrows():
-                        name = row.get(name_cols[0]) if name_cols else None
-                        phone = row.get(phone_cols[0]) if phone_cols else None
-                        date = row.get(date_cols[0]) if date_cols else None
-                        time = row.get(time_cols[0]) if time_cols else None
-
-                        appointments.append({
-                            "name": str(name).strip() if name is not None and str(name).strip() else None,
-                            "phone": _clean_phone(str(phone)) if phone is not None and str(phone).strip() else None,
-                            "date": str(date).strip() if date is not None and str(date).strip() else None,
-                            "time": str(time).strip()[:5] if time is not None and str(time).strip() else None,
-                            "timezone": DEFAULT_TZ,
-                            "notes": None,
-                            "confidence": 1.0,
-                            "issues": [],
-                        })
+                    appointments = _appointments_from_dataframe(
+                        df, **_detect_columns_loose(df)
+                    )
 
                     return _normalize_extracted_appointments({
                         "appointments": appointments,
@@ -1020,27 +1230,78 @@ def _extract_with_openai(tmp_path: str, filename: str) -> Dict[str, Any]:
         if text is not None:
             print(f"📄 archivo sin extensión tratado como texto: {filename}")
             return _normalize_extracted_appointments(
-                _openai_extract_from_text(text, filename)
+                _openai_extract_from_text(text, filename, read_only)
             )
 
-    # 4) PDF -> OpenAI directo
+    # 4) PDF -> parser local por páginas; OpenAI solo para páginas dudosas
+    #    o PDFs sin texto (escaneados)
     if _is_pdf(filename):
-        print(f"📄 PDF enviado a OpenAI directamente: {filename}")
+        local = _extract_pdf_local_first(tmp_path, filename, file_hash, read_only)
+        if local is not None:
+            return _normalize_extracted_appointments(local)
+
+        print(f"📄 PDF sin texto enviado a OpenAI directamente: {filename}")
         return _normalize_extracted_appointments(
-            _openai_extract(tmp_path, filename)
+            _openai_extract(tmp_path, filename, read_only, file_hash)
         )
 
     # 5) Imagen -> OpenAI
     if _is_image(filename):
         return _normalize_extracted_appointments(
-            _openai_extract_image(tmp_path, filename)
+            _openai_extract_image(tmp_path, filename, read_only, file_hash)
         )
 
     # 6) Fallback final -> OpenAI
     return _normalize_extracted_appointments(
-        _openai_extract(tmp_path, filename)
+        _openai_extract(tmp_path, filename, read_only, file_hash)
     )
 
+def _extract_with_cache(
+    db: Session,
+    *,
+    tmp_path: str,
+    filename: str,
+    file_hash: str,
+    save: bool = True,
+) -> Dict[str, Any]:
+    """
+    _extract_with_openai con el resultado normalizado guardado por sha256 del
+    archivo + IMPORT_EXTRACTOR_VERSION: reimportar / reintentar no llama al LLM.
+    save=False (vista previa): solo se leen las cachés (extracción y LLM).
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in STRUCTURED_EXTENSIONS:
+        return _extract_with_openai(tmp_path, filename, file_hash, read_only=not save)
+
+    try:
+        cached = get_cached_extraction(
+            db, file_hash=file_hash, extractor_version=IMPORT_EXTRACTOR_VERSION
+        )
+        if cached is not None:
+            print(f"💾 extracción reutilizada: {filename} ({file_hash[:12]})")
+            return cached
+    except Exception as e:
+        db.rollback()
+        print("⚠️ caché de extracción (lectura):", repr(e))
+
+    data = _extract_with_openai(tmp_path, filename, file_hash, read_only=not save)
+    if not save:
+        return data
+
+    try:
+        save_cached_extraction(
+            db,
+            file_hash=file_hash,
+            extractor_version=IMPORT_EXTRACTOR_VERSION,
+            data=data,
+        )
+    except Exception as e:
+        db.rollback()
+        print("⚠️ caché de extracción (escritura):", repr(e))
+
+    return data
+
+
 def _collect_import_keys(files_payload: list[dict[str, Any]]) -> tuple[set[str], set[str]]:
     phones: set[str] = set()
     names: set[str] = set()
@@ -1058,11 +1319,206 @@ def _collect_import_keys(files_payload: list[dict[str, Any]]) -> tuple[set[str],
     return phones, names
 
 
+def _extract_spooled_file(f: dict[str, Any], dry_run: bool = False) -> dict[str, Any]:
+    """
+    Extracción de un archivo volcado a disco (se ejecuta en un hilo, con su
+    propia sesión para la caché de extracciones).
+    """
+    tmp_path = f["tmp_path"]
+    filename = f["filename"]
+
+    if f["size_bytes"] >= IMPORT_STREAM_THRESHOLD_BYTES:
+        chunks = _iter_structured_chunks(tmp_path, filename)
+        if chunks is not None:
+            print(f"🌊 importación en streaming: {filename} ({f['size_bytes']} bytes)")
+            return {"appointment_chunks": chunks}
+
+    db = SessionLocal()
+    try:
+        data = _extract_with_cache(
+            db,
+            tmp_path=tmp_path,
+            filename=filename,
+            file_hash=f["file_hash"],
+            save=not dry_run,
+        )
+    finally:
+        db.close()
+
+    return {"appointments": data.get("appointments", [])}
+
+
+def _build_file_payloads(
+    *,
+    job_id: int,
+    spooled: list[dict[str, Any]],
+    pending_tmp_paths: list[str],
+    on_file_done: Optional[Callable[[int], None]] = None,
+    dry_run: bool = False,
+) -> list[dict[str, Any]]:
+    """
+    Extracción de los archivos ya volcados a disco, en paralelo; la subida
+    de los originales se encola aparte y no se espera. Devuelve los payloads en el orden de subida. Los temporales de archivos
+    en streaming se quedan en pending_tmp_paths (se leen al importar).
+    En vista previa (dry_run) no se archiva nada ni se escribe la caché.
+    """
+    workers = max(1, min(IMPORT_FILE_CONCURRENCY, len(spooled)))
+
+    # archivado de originales en segundo plano (write-behind): no espera a S3
+    stored_by_file = [
+        enqueue_original_upload(
+            job_id=job_id,
+            filename=f["filename"],
+            file_path=f["tmp_path"],
+            content_type=f["content_type"],
+            file_hash=f["file_hash"],
+        )
+        if not dry_run
+        else {
+            "storage_provider": None,
+            "storage_bucket": None,
+            "storage_key": None,
+            "size_bytes": f["size_bytes"],
+            "storage_upload": None,
+        }
+        for f in spooled
+    ]
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="import-file") as pool:
+        extract_futures = [pool.submit(_extract_spooled_file, f, dry_run) for f in spooled]
+
+        done = 0
+        for fut in as_completed(extract_futures):
+            fut.result()
+            done += 1
+            if on_file_done:
+                on_file_done(done)
+
+        files_payload: list[dict[str, Any]] = []
+        for f, stored, extract_fut in zip(spooled, stored_by_file, extract_futures):
+            extracted = extract_fut.result()
+
+            files_payload.append({
+                "original_filename": f["filename"],
+                "mime_type": f["content_type"],
+                "file_hash": f["file_hash"],
+                "storage_provider": stored["storage_provider"],
+                "storage_bucket": stored["storage_bucket"],
+                "storage_key": stored["storage_key"],
+                "storage_url": stored.get("storage_url"),
+                "size_bytes": stored["size_bytes"],
+                "storage_upload": stored["storage_upload"],
+                **extracted,
+            })
+
+            if "appointment_chunks" not in extracted:
+                pending_tmp_paths.remove(f["tmp_path"])
+                try:
+                    os.unlink(f["tmp_path"])
+                except Exception:
+                    pass
+
+    return files_payload
+
+
+def _run_import_in_background(
+    *,
+    batch_id: int,
+    job_id: int,
+    spooled: list[dict[str, Any]],
+    duplicate_files: int,
+    claimed_hashes: list[str],
+) -> None:
+    db = SessionLocal()
+    pending_tmp_paths = [f["tmp_path"] for f in spooled]
+
+    def _still_processing() -> bool:
+        # el barrido de lotes colgados (u otro proceso) pudo marcarlo failed
+        if _batch_cancelled(batch_id):
+            return False
+        batch = db.get(ReviewImportBatch, batch_id)
+        if batch is None:
+            return False
+        db.refresh(batch)
+        return batch.status == "processing"
+
+    def _extract_progress(files_done: int) -> None:
+        if _batch_cancelled(batch_id):
+            return
+        batch = db.get(ReviewImportBatch, batch_id)
+        if batch:
+            batch.progress_json = {
+                **(batch.progress_json or {}),
+                "stage": "extracting",
+                "files_done": files_done,
+            }
+            db.commit()
+
+    try:
+        if not _still_processing():
+            print(f"⚠️ lote {batch_id} ya no está en curso, no se importa")
+            return
+
+        _extract_progress(0)
+
+        files_payload = _build_file_payloads(
+            job_id=job_id,
+            spooled=spooled,
+            pending_tmp_paths=pending_tmp_paths,
+            on_file_done=_extract_progress,
+        )
+        if not _still_processing():
+            print(f"⚠️ lote {batch_id} marcado como fallido durante la extracción, se descarta")
+            return
+
+        preload_phones, preload_names = _collect_import_keys(files_payload)
+
+        import_appointments_payloads(
+            db,
+            job_id=job_id,
+            files_payload=files_payload,
+            preload_phones=preload_phones,
+            preload_names=preload_names,
+            duplicate_files=duplicate_files,
+            batch_id=batch_id,
+        )
+        persist_storage_keys_when_done(batch_id=batch_id, files_payload=files_payload)
+        print(f"✅ importación en segundo plano completada: batch={batch_id}")
+
+    except Exception as e:
+        print(f"❌ importación en segundo plano batch={batch_id}:", repr(e))
+        try:
+            db.rollback()
+            mark_import_batch_failed(db, batch_id=batch_id, error_message=str(e))
+            batch = db.get(ReviewImportBatch, batch_id)
+            if batch:
+                batch.progress_json = {**(batch.progress_json or {}), "stage": "failed"}
+            db.commit()
+        except Exception:
+            pass
+
+    finally:
+        for path in pending_tmp_paths:
+            try:
+                os.unlink(path)
+            except Exception:
+                pass
+        try:
+            release_import_claims(db, job_id=job_id, file_hashes=claimed_hashes)
+        except Exception as e:
+            print(f"⚠️ no se pudieron liberar reservas batch={batch_id}:", repr(e))
+        _unregister_live_batch(batch_id)
+        db.close()
+
+
 @router.post("/import-appointments", response_model=ImportBatchOut)
 async def import_appointments(
     job_id: int = Form(...),
     file: Optional[UploadFile] = File(None),
     files: Optional[List[UploadFile]] = File(None),
+    force: bool = Form(False),
+    background: bool = Form(False),
+    dry_run: bool = Form(False),
     db: Session = Depends(get_db),
 ):
     print("🔥 import_appointments hit", job_id)
@@ -1081,71 +1537,194 @@ async def import_appointments(
     if not incoming_files:
         raise HTTPException(status_code=400, detail="Debes subir al menos un archivo")
 
-    files_payload: list[dict[str, Any]] = []
+    spooled: list[dict[str, Any]] = []
+    # los temporales de archivos en streaming se leen durante la importación,
+    # así que se borran al final
+    pending_tmp_paths: list[str] = []
 
-    for current_file in incoming_files:
-        filename = current_file.filename or "upload"
-        suffix = os.path.splitext(filename)[1].lower()
+    seen_hashes: set[str] = set()
+    duplicate_files = 0
+    previous_batch_id: Optional[int] = None
+    # reservas (job, sha256) de esta subida; se liberan al terminar
+    claimed_hashes: list[str] = []
 
-        content = await current_file.read()
-        file_hash = hashlib.sha256(content).hexdigest()
+    try:
+        for current_file in incoming_files:
+            filename = current_file.filename or "upload"
+            suffix = os.path.splitext(filename)[1].lower()
+
+            tmp_path, file_hash, size_bytes = await _spool_upload(current_file, suffix)
+            pending_tmp_paths.append(tmp_path)
+
+            # mismo contenido ya importado en este job (o repetido en la misma subida):
+            # ni S3, ni OpenAI, ni matching
+            if not force:
+                previous = None
+                if file_hash not in seen_hashes:
+                    previous = find_imported_file_by_hash(db, job_id=job_id, file_hash=file_hash)
+                if previous is not None or file_hash in seen_hashes:
+                    print(f"♻️ archivo duplicado omitido: {filename} ({file_hash[:12]})")
+                    duplicate_files += 1
+                    if previous is not None:
+                        previous_batch_id = previous.batch_id
+                    continue
+
+                # misma subida en curso en otra petición (aún sin filas de archivo)
+                if not dry_run:
+                    if not claim_import_file(
+                        db, job_id=job_id, file_hash=file_hash, ttl_seconds=IMPORT_CLAIM_TTL_SECONDS
+                    ):
+                        print(f"♻️ archivo ya en importación omitido: {filename} ({file_hash[:12]})")
+                        duplicate_files += 1
+                        continue
+                    claimed_hashes.append(file_hash)
+            seen_hashes.add(file_hash)
+
+            spooled.append({
+                "tmp_path": tmp_path,
+                "filename": filename,
+                "content_type": current_file.content_type,
+                "file_hash": file_hash,
+                "size_bytes": size_bytes,
+            })
 
-        stored = _store_original_upload(
+        if not spooled:
+            return JSONResponse(
+                duplicate_files_result(batch_id=previous_batch_id or 0, files_received=duplicate_files)
+            )
+
+        if background and not dry_run:
+            batch = create_import_batch(db, job_id=job_id, files_count=len(spooled))
+            batch.progress_json = {
+                "stage": "queued",
+                "files_total": len(spooled),
+                "files_done": 0,
+                "rows_processed": 0,
+                "summary": None,
+            }
+            db.commit()
+
+            _register_live_batch(batch.id)
+            _import_executor.submit(
+                _run_import_in_background,
+                batch_id=batch.id,
+                job_id=job_id,
+                spooled=spooled,
+                duplicate_files=duplicate_files,
+                claimed_hashes=claimed_hashes,
+            )
+            # los temporales de los archivos encolados y las reservas pasan a
+            # ser del worker; los de duplicados omitidos se borran aquí (finally)
+            handed_over = {f["tmp_path"] for f in spooled}
+            pending_tmp_paths = [p for p in pending_tmp_paths if p not in handed_over]
+            claimed_hashes = []
+
+            return JSONResponse(
+                processing_result(
+                    batch_id=batch.id,
+                    files_received=len(spooled) + duplicate_files,
+                    duplicate_files=duplicate_files,
+                )
+            )
+
+        # S3 + parseo/LLM fuera del event loop
+        files_payload = await run_in_threadpool(
+            _build_file_payloads,
             job_id=job_id,
-            filename=filename,
-            content=content,
-            content_type=current_file.content_type,
-            file_hash=file_hash,
+            spooled=spooled,
+            pending_tmp_paths=pending_tmp_paths,
+            dry_run=dry_run,
         )
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp_path = tmp.name
-            tmp.write(content)
-
         try:
-            data = _extract_with_openai(tmp_path, filename)
-            files_payload.append({
-                "original_filename": filename,
-                "mime_type": current_file.content_type,
-                "file_hash": file_hash,
-                "appointments": data.get("appointments", []),
-                "storage_provider": stored["storage_provider"],
-                "storage_bucket": stored["storage_bucket"],
-                "storage_key": stored["storage_key"],
-                "storage_url": stored.get("storage_url"),
-                "size_bytes": stored["size_bytes"],
-            })
-        finally:
+            # 🔥 NUEVO: extraer claves para precarga eficiente
+            preload_phones, preload_names = _collect_import_keys(files_payload)
+
+            # los CSV/xlsx en streaming se parsean al consumirse aquí:
+            # fuera del event loop, igual que la extracción
+            result = await run_in_threadpool(
+                import_appointments_payloads,
+                db,
+                job_id=job_id,
+                files_payload=files_payload,
+                preload_phones=preload_phones,
+                preload_names=preload_names,
+                duplicate_files=duplicate_files,
+                dry_run=dry_run,
+            )
+            if not dry_run:
+                persist_storage_keys_when_done(
+                    batch_id=result["batch_id"], files_payload=files_payload
+                )
+            return JSONResponse(result)
+
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"No se pudo importar: {e}")
+
+    finally:
+        for path in pending_tmp_paths:
             try:
-                os.unlink(tmp_path)
+                os.unlink(path)
             except Exception:
                 pass
+        if claimed_hashes:
+            try:
+                release_import_claims(db, job_id=job_id, file_hashes=claimed_hashes)
+            except Exception as e:
+                db.rollback()
+                print("⚠️ no se pudieron liberar reservas:", repr(e))
 
-    try:
-        # 🔥 NUEVO: extraer claves para precarga eficiente
-        preload_phones, preload_names = _collect_import_keys(files_payload)
 
-        result = import_appointments_payloads(
-            db,
-            job_id=job_id,
-            files_payload=files_payload,
-            preload_phones=preload_phones,
-            preload_names=preload_names,
-        )
-        return JSONResponse(result)
+@router.get("/import-appointments/{batch_id}/status")
+def import_appointments_status(batch_id: int, db: Session = Depends(get_db)):
+    batch = db.get(ReviewImportBatch, batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Importación no encontrada")
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"No se pudo importar: {e}")
+    progress = batch.progress_json or {}
+
+    return {
+        "batch_id": batch.id,
+        "job_id": batch.job_id,
+        "status": batch.status,
+        "stage": progress.get("stage"),
+        "files_total": progress.get("files_total", batch.files_count),
+        "files_done": progress.get("files_done", 0),
+        "rows_processed": progress.get("rows_processed", 0),
+        "summary": progress.get("summary"),
+        "manual_review_required": batch.manual_review_required,
+        "manual_review_reason": batch.manual_review_reason,
+        "user_message": MANUAL_REVIEW_USER_MESSAGE if batch.manual_review_required else None,
+        "error": batch.error_message,
+    }
 
 def _chunk_text(text: str, size: int = 25000):
+    """
+    Trocea el texto en bloques de ~size caracteres cortando siempre en un
+    salto de línea, para no partir una fila de la agenda entre dos chunks.
+    Una línea más larga que size se trocea tal cual.
+    """
     chunks = []
-    start = 0
+    current: list[str] = []
+    current_len = 0
+
+    for line in text.splitlines(keepends=True):
+        while len(line) > size:
+            if current:
+                chunks.append("".join(current))
+                current, current_len = [], 0
+            chunks.append(line[:size])
+            line = line[size:]
 
+        if current_len + len(line) > size and current:
+            chunks.append("".join(current))
+            current, current_len = [], 0
 
-    while start < len(text):
-        chunks.append(text[start:start+size])
-        start += size
+        current.append(line)
+        current_len += len(line)
 
+    if current:
+        chunks.append("".join(current))
 
     return chunks
 
@@ -1291,6 +1870,175 @@ def _parse_structured_file(tmp_path: str, filename: str):
     if df is None or df.empty:
         return None
 
+    columns = _detect_columns_strict(df)
+    if columns is None:
+        return None
+
+    appointments = _appointments_from_dataframe(df, **columns)
+
+    return {
+        "appointments": appointments,
+        "unparsed": []
+    }
+
+
+# =========================
+# Normalización columnar (pandas) para archivos estructurados
+# =========================
+
+def _detect_columns_loose(df: pd.DataFrame) -> dict[str, Optional[str]]:
+    """
+    Detección de columnas para archivos sin extensión (JSON/CSV).
+    """
+    columns_map = {str(c).strip().lower(): c for c in df.columns}
+    return {
+        "name_col": _pick_first_matching_column(
+            columns_map, ["name", "patient", "nombre", "paciente", "cliente"]
+        ),
+        "phone_col": _pick_first_matching_column(
+            columns_map, ["phone", "movil", "móvil", "mobile", "tel", "telefono", "teléfono"]
+        ),
+        "date_col": _pick_first_matching_column(columns_map, ["date", "fecha", "dia", "día"]),
+        "time_col": _pick_first_matching_column(columns_map, ["time", "hora", "inicio"]),
+    }
+
+
+def _column_as_text(series: pd.Series) -> pd.Series:
+    """
+    Columna -> strings sin espacios (dtype "string"), <NA> si vacío/NaN.
+    """
+    if pd.api.types.is_float_dtype(series):
+        # 612345678.0 -> "612345678" (teléfonos leídos como float por culpa de NaN)
+        try:
+            series = series.astype("Int64")
+        except (TypeError, ValueError):
+            pass
+
+    s = series.astype("string").str.strip()
+    return s.mask(s == "")
+
+
+def _clean_phone_column(series: pd.Series) -> pd.Series:
+    """
+    Versión vectorizada de _clean_phone.
+    """
+    s = _column_as_text(series).str.replace(r"[^\d+]", "", regex=True)
+    plus = s.str.startswith("+").fillna(False)
+    digits = s.str.replace(r"\D", "", regex=True)
+    n = digits.str.len().fillna(0)
+
+    out = pd.Series(pd.NA, index=series.index, dtype="string")
+    out = out.mask(~plus & (n >= 8) & (n <= 15), "+" + digits)
+    if DEFAULT_COUNTRY == "ES":
+        out = out.mask(~plus & (n == 9), "+34" + digits)
+    out = out.mask(plus & (n > 0), "+" + digits)
+    return out
+
+
+def _date_column(series: pd.Series) -> pd.Series:
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.dt.strftime("%Y-%m-%d").astype("string")
+    return _column_as_text(series)
+
+
+def _time_column(series: pd.Series) -> pd.Series:
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.dt.strftime("%H:%M").astype("string")
+    return _column_as_text(series).str.slice(0, 5)
+
+
+def _split_datetime_column(series: pd.Series) -> tuple[pd.Series, pd.Series]:
+    if pd.api.types.is_datetime64_any_dtype(series):
+        parsed = series
+    else:
+        raw = _column_as_text(series)
+        parsed = pd.to_datetime(raw, errors="coerce")
+        # formatos mezclados: reintenta solo las celdas que fallaron
+        leftover = parsed.isna() & raw.notna()
+        if leftover.any():
+            parsed = parsed.copy()
+            parsed[leftover] = pd.to_datetime(raw[leftover], errors="coerce", format="mixed")
+
+    return (
+        parsed.dt.strftime("%Y-%m-%d").astype("string"),
+        parsed.dt.strftime("%H:%M").astype("string"),
+    )
+
+
+def _to_optional_list(series: Optional[pd.Series], length: int) -> list[Optional[str]]:
+    if series is None:
+        return [None] * length
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def _appointments_from_dataframe(
+    df: pd.DataFrame,
+    *,
+    name_col: Optional[str] = None,
+    phone_col: Optional[str] = None,
+    date_col: Optional[str] = None,
+    time_col: Optional[str] = None,
+    datetime_col: Optional[str] = None,
+) -> list[Dict[str, Any]]:
+    """
+    Limpia nombre/teléfono/fecha/hora por columnas completas y solo al final
+    materializa los dicts de citas (sin df.iterrows()).
+    """
+    n = len(df)
+
+    names = _column_as_text(df[name_col]) if name_col else None
+    raw_phones = _column_as_text(df[phone_col]) if phone_col else None
+    phones = _clean_phone_column(df[phone_col]) if phone_col else None
+
+    dates = None
+    times = None
+    # Prioridad: si hay fecha/hora separadas, usar eso
+    if date_col or time_col:
+        dates = _date_column(df[date_col]) if date_col else None
+        times = _time_column(df[time_col]) if time_col else None
+    # Solo usar datetime combinado si no existen columnas separadas
+    elif datetime_col:
+        dates, times = _split_datetime_column(df[datetime_col])
+
+    names_l = _to_optional_list(names, n)
+    phones_l = _to_optional_list(phones, n)
+    has_phone_l = raw_phones.notna().tolist() if raw_phones is not None else [False] * n
+    dates_l = _to_optional_list(dates, n)
+    times_l = _to_optional_list(times, n)
+
+    appointments = []
+    for name, phone, has_phone, date_value, time_value in zip(
+        names_l, phones_l, has_phone_l, dates_l, times_l
+    ):
+        issues = []
+        if not name:
+            issues.append("missing_name")
+        if not has_phone:
+            issues.append("missing_phone")
+        if not date_value:
+            issues.append("missing_date")
+        if not time_value:
+            issues.append("missing_time")
+
+        appointments.append({
+            "name": name,
+            "phone": phone,
+            "date": date_value,
+            "time": time_value,
+            "timezone": DEFAULT_TZ,
+            "notes": None,
+            "confidence": 1.0,
+            "issues": issues,
+        })
+
+    return appointments
+
+
+def _detect_columns_strict(df: pd.DataFrame) -> Optional[dict[str, Optional[str]]]:
+    """
+    Detección de columnas para CSV / Excel / JSON con extensión.
+    Devuelve None si no hay ninguna columna reconocible.
+    """
     columns_map = {str(c).strip().lower(): c for c in df.columns}
 
     name_col = _pick_first_matching_column(columns_map, [
@@ -1314,75 +2062,93 @@ def _parse_structured_file(tmp_path: str, filename: str):
         "fecha hora", "fecha_hora", "datetime", "start"
     ])
 
-    print("🧩 columnas detectadas:", {
+    columns = {
         "name_col": name_col,
         "phone_col": phone_col,
         "date_col": date_col,
         "time_col": time_col,
         "datetime_col": datetime_col,
-    })
+    }
+    print("🧩 columnas detectadas:", columns)
 
-    if not any([name_col, phone_col, date_col, time_col, datetime_col]):
+    if not any(columns.values()):
         return None
 
-    appointments = []
+    return columns
 
-    for _, row in df.iterrows():
-        raw_name = row.get(name_col) if name_col else None
-        raw_phone = row.get(phone_col) if phone_col else None
 
-        raw_date = None
-        raw_time = None
-
-        # Prioridad: si hay fecha/hora separadas, usar eso
-        if date_col or time_col:
-            raw_date = row.get(date_col) if date_col else None
-            raw_time = row.get(time_col) if time_col else None
-
-        # Solo usar datetime combinado si no existen columnas separadas
-        elif datetime_col:
-            dt_value = row.get(datetime_col)
-            if dt_value is not None and str(dt_value).strip():
-                if hasattr(dt_value, "strftime"):
-                    raw_date = dt_value.strftime("%Y-%m-%d")
-                    raw_time = dt_value.strftime("%H:%M")
-                else:
-                    dt_text = str(dt_value).strip()
-                    try:
-                        parsed = pd.to_datetime(dt_text, errors="raise")
-                        raw_date = parsed.strftime("%Y-%m-%d")
-                        raw_time = parsed.strftime("%H:%M")
-                    except Exception:
-                        raw_date = None
-                        raw_time = None
-
-        raw_name_str = str(raw_name).strip() if raw_name is not None and str(raw_name).strip() else None
-        raw_phone_str = str(raw_phone).strip() if raw_phone is not None and str(raw_phone).strip() else None
-        raw_date_str = str(raw_date).strip() if raw_date is not None and str(raw_date).strip() else None
-        raw_time_str = str(raw_time).strip() if raw_time is not None and str(raw_time).strip() else None
+# =========================
+# Lectura en streaming (CSV con chunksize / Excel read-only)
+# =========================
 
-        issues = []
-        if not raw_name_str:
-            issues.append("missing_name")
-        if not raw_phone_str:
-            issues.append("missing_phone")
-        if not raw_date_str:
-            issues.append("missing_date")
-        if not raw_time_str:
-            issues.append("missing_time")
+def _iter_csv_frames(tmp_path: str) -> Iterator[pd.DataFrame]:
+    with pd.read_csv(tmp_path, chunksize=IMPORT_STREAM_CHUNK_ROWS) as reader:
+        for df in reader:
+            yield df
 
-        appointments.append({
-            "name": raw_name_str,
-            "phone": _clean_phone(raw_phone_str) if raw_phone_str else None,
-            "date": raw_date_str,
-            "time": raw_time_str[:5] if raw_time_str else None,
-            "timezone": DEFAULT_TZ,
-            "notes": None,
-            "confidence": 1.0,
-            "issues": issues,
-        })
 
-    return {
-        "appointments": appointments,
-        "unparsed": []
-    }
\ No newline at end of file
+def _iter_excel_frames(tmp_path: str) -> Iterator[pd.DataFrame]:
+    from openpyxl import load_workbook
+
+    wb = load_workbook(tmp_path, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        header = None
+        buffer: list[tuple] = []
+
+        for row in ws.iter_rows(values_only=True):
+            if header is None:
+                if any(v is not None and str(v).strip() for v in row):
+                    header = [str(v).strip() if v is not None else f"col_{i}" for i, v in enumerate(row)]
+                continue
+
+            buffer.append(tuple(row[:len(header)]))
+            if len(buffer) >= IMPORT_STREAM_CHUNK_ROWS:
+                yield pd.DataFrame(buffer, columns=header).infer_objects()
+                buffer = []
+
+        if header is not None and buffer:
+            yield pd.DataFrame(buffer, columns=header).infer_objects()
+    finally:
+        wb.close()
+
+
+def _iter_structured_chunks(tmp_path: str, filename: str) -> Optional[Iterator[list[Dict[str, Any]]]]:
+    """
+    Para CSV / .xlsx grandes: generador de listas de citas ya normalizadas,
+    de IMPORT_STREAM_CHUNK_ROWS en IMPORT_STREAM_CHUNK_ROWS filas.
+    Devuelve None si el archivo no admite streaming (se usa el camino normal).
+    """
+    lower = filename.lower()
+    if lower.endswith(".csv"):
+        frames = _iter_csv_frames(tmp_path)
+    elif lower.endswith(".xlsx"):
+        frames = _iter_excel_frames(tmp_path)
+    else:
+        return None
+
+    try:
+        first = next(frames)
+    except StopIteration:
+        return None
+    except Exception as e:
+        print(f"⚠️ streaming no disponible para {filename}: {e!r}")
+        return None
+
+    columns = _detect_columns_strict(first)
+    if columns is None:
+        frames.close()
+        return None
+
+    def _gen() -> Iterator[list[Dict[str, Any]]]:
+        df = first
+        while df is not None:
+            if not df.empty:
+                data = _normalize_extracted_appointments({
+                    "appointments": _appointments_from_dataframe(df, **columns),
+                    "unparsed": [],
+                })
+                yield data["appointments"]
+            df = next(frames, None)
+
+    return _gen()
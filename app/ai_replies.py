@@ -0,0 +1,44 @@
+# app/ai_replies.py
+"""
+Prompt y utilidades compartidas para generar respuestas IA a reseñas
+(endpoint /reviews/ai-replies, modo batch y streaming).
+"""
+
+from __future__ import annotations
+
+import hashlib
+
+REPLY_MODEL = "gpt-4.1-mini"
+REPLY_TEMPERATURE = 0.5
+REPLY_TONE = "default"
+
+REPLY_SYSTEM_PROMPT = (
+    "Eres un asistente experto en atención al cliente para pequeñas empresas. "
+    "Respondes a reseñas de Google en español con un tono humano, cercano y profesional. "
+    "Sé breve (3-5 frases), agradecido y, si la reseña es negativa, empático y orientado a solución. "
+    "No inventes datos ni promociones agresivas."
+)
+
+
+def build_reply_messages(review: dict) -> list[dict]:
+    star = review.get("star_rating", 5)
+    comment = review.get("comment", "")
+    reviewer = review.get("reviewer_name", "el cliente")
+
+    user_prompt = f"""Reseña:
+- Estrellas: {star}
+- Cliente: {reviewer}
+- Comentario: "{comment}"
+
+Redacta la respuesta que pondrá el negocio en su perfil de Google.
+"""
+
+    return [
+        {"role": "system", "content": REPLY_SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def reply_input_hash(rating: int, text: str) -> str:
+    # hash del texto+rating (ReviewAIReply.input_hash)
+    return hashlib.sha1(f"{rating}|{text}".encode("utf-8")).hexdigest()
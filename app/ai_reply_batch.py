@@ -0,0 +1,470 @@
+# app/ai_reply_batch.py
+"""
+Modo batch (offline) para generar respuestas IA en bloque.
+
+Pensado para el onboarding: miles de reseñas históricas sin respuesta.
+1) Se reúnen las reseñas sin ReviewAIReply (o con input_hash distinto).
+2) Se escribe un .jsonl con una petición /v1/chat/completions por reseña.
+3) Se envía a la Batch API de OpenAI (o a un runner local si
+   AI_REPLY_BATCH_MODE=local) y se devuelve enseguida.
+4) Un poll posterior (endpoint o cron) descarga el resultado y hace
+   upsert masivo en review_ai_replies.
+
+Como mucho hay un batch en curso por job: un segundo POST devuelve el que
+ya existe (así no se pagan dos veces las mismas reseñas).
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Optional
+
+from sqlalchemy.orm import Session
+
+from app.ai_replies import (
+    REPLY_MODEL,
+    REPLY_TEMPERATURE,
+    REPLY_TONE,
+    build_reply_messages,
+    reply_input_hash,
+)
+from app.db import SessionLocal
+from app.models import Review
+from app.models_ai_reply_cache import ReviewAIReply, ReviewAIReplyBatch
+
+AI_REPLY_BATCH_MODE = os.getenv("AI_REPLY_BATCH_MODE", "openai").lower()
+AI_REPLY_BATCH_MAX_REQUESTS = int(os.getenv("AI_REPLY_BATCH_MAX_REQUESTS", "50000"))
+AI_REPLY_BATCH_DIR = os.getenv("AI_REPLY_BATCH_DIR", "./data/ai_reply_batches")
+# un batch local sin latido en este tiempo se da por muerto (reinicio)
+AI_REPLY_LOCAL_STALE_SECONDS = int(os.getenv("AI_REPLY_LOCAL_STALE_SECONDS", "900"))
+LOCAL_HEARTBEAT_EVERY = 50
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+TERMINAL_STATUSES = {"completed", "failed", "empty"}
+
+# estados finales de la Batch API sin éxito; expired/cancelled pueden traer
+# salida parcial, que se guarda igualmente
+_PROVIDER_FAILED = {"failed", "expired", "cancelled"}
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def collect_missing_replies(db: Session, *, job_id: int) -> list[dict[str, Any]]:
+    """
+    Reseñas del job (todo el histórico, con texto) cuya respuesta IA falta
+    o está desactualizada.
+    """
+    rows = (
+        db.query(Review)
+        .filter(Review.job_id == job_id)
+        .filter(Review.text.isnot(None))
+        .filter(Review.text != "")
+        .all()
+    )
+
+    ids = [r.id for r in rows]
+    cached_hash = {}
+    if ids:
+        cached_hash = dict(
+            db.query(ReviewAIReply.review_id, ReviewAIReply.input_hash)
+            .filter(ReviewAIReply.review_id.in_(ids))
+            .all()
+        )
+
+    missing = []
+    for r in rows:
+        text = (r.text or "").strip()
+        if not text:
+            continue
+        rating = int(r.rating or 0)
+        input_hash = reply_input_hash(rating, text)
+        if cached_hash.get(r.id) == input_hash:
+            continue
+        missing.append(
+            {
+                "id": r.id,
+                "author": r.author_name or "Cliente",
+                "rating": rating,
+                "text": text,
+                "input_hash": input_hash,
+            }
+        )
+
+    return missing[:AI_REPLY_BATCH_MAX_REQUESTS]
+
+
+def _custom_id(review_id: int, input_hash: str) -> str:
+    return f"{review_id}:{input_hash}"
+
+
+def _parse_custom_id(custom_id: str) -> tuple[Optional[int], Optional[str]]:
+    rid, _, input_hash = (custom_id or "").partition(":")
+    if not rid.isdigit() or not input_hash:
+        return None, None
+    return int(rid), input_hash
+
+
+def write_batch_input_file(missing: list[dict[str, Any]]) -> str:
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", suffix=".jsonl", delete=False
+    ) as f:
+        for r in missing:
+            line = {
+                "custom_id": _custom_id(r["id"], r["input_hash"]),
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": {
+                    "model": REPLY_MODEL,
+                    "temperature": REPLY_TEMPERATURE,
+                    "messages": build_reply_messages(
+                        {
+                            "reviewer_name": r["author"],
+                            "star_rating": r["rating"],
+                            "comment": r["text"],
+                        }
+                    ),
+                },
+            }
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        return f.name
+
+
+def apply_batch_output(db: Session, *, job_id: int, output_text: str) -> int:
+    """
+    Upsert masivo de las respuestas del .jsonl de salida
+    (1 SELECT + 1 commit, sin importar el nº de líneas).
+    """
+    results: dict[int, tuple[str, str]] = {}
+
+    for line in (output_text or "").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except Exception:
+            continue
+
+        review_id, input_hash = _parse_custom_id(item.get("custom_id"))
+        if review_id is None:
+            continue
+
+        response = item.get("response") or {}
+        if item.get("error") or int(response.get("status_code") or 0) >= 400:
+            continue
+
+        try:
+            reply_text = response["body"]["choices"][0]["message"]["content"].strip()
+        except Exception:
+            continue
+
+        if reply_text:
+            results[review_id] = (input_hash, reply_text)
+
+    if not results:
+        return 0
+
+    existing = {
+        c.review_id: c
+        for c in db.query(ReviewAIReply)
+        .filter(ReviewAIReply.review_id.in_(list(results.keys())))
+        .all()
+    }
+
+    now = _now()
+    for review_id, (input_hash, reply_text) in results.items():
+        c = existing.get(review_id)
+        if c:
+            c.reply_text = reply_text
+            c.input_hash = input_hash
+            c.model_used = REPLY_MODEL
+            c.updated_at = now
+        else:
+            db.add(
+                ReviewAIReply(
+                    review_id=review_id,
+                    job_id=job_id,
+                    input_hash=input_hash,
+                    reply_text=reply_text,
+                    model_used=REPLY_MODEL,
+                    tone=REPLY_TONE,
+                    created_at=now,
+                    updated_at=now,
+                )
+            )
+
+    db.commit()
+    return len(results)
+
+
+def _mark_failed(db: Session, batch: ReviewAIReplyBatch, error: str) -> None:
+    batch.status = "failed"
+    batch.error_message = (error or "")[:4000]
+    batch.completed_at = _now()
+    db.commit()
+
+
+def _local_output_path(batch_id: int) -> str:
+    return os.path.join(AI_REPLY_BATCH_DIR, f"batch_{batch_id}_output.jsonl")
+
+
+def _run_local_batch(batch_id: int, input_path: str, openai_client) -> None:
+    """
+    Sustituto local de la Batch API: ejecuta las peticiones del .jsonl en
+    un hilo de fondo y escribe un .jsonl de salida con el mismo formato.
+    """
+    db = SessionLocal()
+    try:
+        batch = db.get(ReviewAIReplyBatch, batch_id)
+        if not batch:
+            return
+
+        batch.status = "in_progress"
+        db.commit()
+
+        os.makedirs(AI_REPLY_BATCH_DIR, exist_ok=True)
+        output_path = _local_output_path(batch_id)
+
+        with open(input_path, "r", encoding="utf-8") as f_in, open(
+            output_path, "w", encoding="utf-8"
+        ) as f_out:
+            for n, line in enumerate(f_in, start=1):
+                if n % LOCAL_HEARTBEAT_EVERY == 0:
+                    # latido: el poll distingue un batch vivo de uno huérfano
+                    f_out.flush()
+                    batch.updated_at = _now()
+                    db.commit()
+
+                req = json.loads(line)
+                out: dict[str, Any] = {"custom_id": req["custom_id"]}
+                try:
+                    completion = openai_client.chat.completions.create(**req["body"])
+                    out["response"] = {
+                        "status_code": 200,
+                        "body": {
+                            "choices": [
+                                {"message": {"content": completion.choices[0].message.content or ""}}
+                            ]
+                        },
+                    }
+                except Exception as e:
+                    out["error"] = {"message": str(e)}
+                f_out.write(json.dumps(out, ensure_ascii=False) + "\n")
+
+        batch.output_file_id = output_path
+        with open(output_path, "r", encoding="utf-8") as f:
+            batch.replies_saved = apply_batch_output(db, job_id=batch.job_id, output_text=f.read())
+        batch.status = "completed"
+        batch.completed_at = _now()
+        db.commit()
+        print(f"✅ ai_reply_batch local {batch_id}: {batch.replies_saved} respuestas")
+
+    except Exception as e:
+        db.rollback()
+        batch = db.get(ReviewAIReplyBatch, batch_id)
+        if batch:
+            _mark_failed(db, batch, str(e))
+        print(f"❌ ai_reply_batch local {batch_id}:", repr(e))
+    finally:
+        db.close()
+        try:
+            os.unlink(input_path)
+        except Exception:
+            pass
+
+
+def find_active_batch(db: Session, *, job_id: int) -> Optional[ReviewAIReplyBatch]:
+    return (
+        db.query(ReviewAIReplyBatch)
+        .filter(ReviewAIReplyBatch.job_id == job_id)
+        .filter(ReviewAIReplyBatch.status.notin_(list(TERMINAL_STATUSES)))
+        .order_by(ReviewAIReplyBatch.id.asc())
+        .first()
+    )
+
+
+def submit_reply_batch(db: Session, *, job_id: int, openai_client) -> ReviewAIReplyBatch:
+    # doble clic / reintento del cliente / cron solapado: se devuelve el batch
+    # en curso en vez de volver a enviar (y pagar) las mismas reseñas
+    active = find_active_batch(db, job_id=job_id)
+    if active is not None:
+        print(f"♻️ ai_reply_batch {active.id} ya en curso para job {job_id}")
+        return active
+
+    missing = collect_missing_replies(db, job_id=job_id)
+
+    batch = ReviewAIReplyBatch(
+        job_id=job_id,
+        mode=AI_REPLY_BATCH_MODE,
+        status="submitted",
+        requests_count=len(missing),
+    )
+    db.add(batch)
+    db.commit()
+    db.refresh(batch)
+
+    # dos peticiones a la vez: gana el batch de menor id, el otro se descarta
+    # antes de enviar nada
+    active = find_active_batch(db, job_id=job_id)
+    if active is not None and active.id != batch.id:
+        db.delete(batch)
+        db.commit()
+        return active
+
+    if not missing:
+        batch.status = "empty"
+        batch.completed_at = _now()
+        db.commit()
+        return batch
+
+    input_path = write_batch_input_file(missing)
+    print(f"📦 ai_reply_batch {batch.id}: {len(missing)} peticiones (mode={batch.mode})")
+
+    if batch.mode == "local":
+        threading.Thread(
+            target=_run_local_batch,
+            args=(batch.id, input_path, openai_client),
+            daemon=True,
+        ).start()
+        return batch
+
+    try:
+        with open(input_path, "rb") as f:
+            uploaded = openai_client.files.create(file=f, purpose="batch")
+
+        provider_batch = openai_client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+            metadata={"job_id": str(job_id), "kind": "review_ai_replies"},
+        )
+
+        batch.input_file_id = uploaded.id
+        batch.provider_batch_id = provider_batch.id
+        batch.status = provider_batch.status or "submitted"
+        db.commit()
+    except Exception as e:
+        _mark_failed(db, batch, str(e))
+        raise
+    finally:
+        try:
+            os.unlink(input_path)
+        except Exception:
+            pass
+
+    return batch
+
+
+def _recover_local_batch(db: Session, batch: ReviewAIReplyBatch) -> ReviewAIReplyBatch:
+    """
+    El runner local vive en un hilo del proceso web: si deja de dar latidos
+    (reinicio / redeploy), se guarda la salida parcial y se marca failed.
+    """
+    updated_at = batch.updated_at or batch.created_at
+    if updated_at and updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+    if updated_at and updated_at > _now() - timedelta(seconds=AI_REPLY_LOCAL_STALE_SECONDS):
+        return batch
+
+    saved = 0
+    output_path = _local_output_path(batch.id)
+    if os.path.exists(output_path):
+        with open(output_path, "r", encoding="utf-8") as f:
+            saved = apply_batch_output(db, job_id=batch.job_id, output_text=f.read())
+
+    batch.replies_saved = saved
+    _mark_failed(db, batch, f"batch local interrumpido ({saved} respuestas guardadas)")
+    print(f"⚠️ ai_reply_batch local {batch.id} huérfano: {saved} respuestas recuperadas")
+    return batch
+
+
+def poll_reply_batch(db: Session, *, batch: ReviewAIReplyBatch, openai_client) -> ReviewAIReplyBatch:
+    if batch.status in TERMINAL_STATUSES:
+        return batch
+
+    # El runner local actualiza su propia fila; aquí solo se recuperan huérfanos
+    if batch.mode == "local":
+        return _recover_local_batch(db, batch)
+
+    provider_batch = openai_client.batches.retrieve(batch.provider_batch_id)
+    status = provider_batch.status or batch.status
+
+    if status in _PROVIDER_FAILED:
+        # expired/cancelled conservan lo que sí se completó
+        output_file_id = getattr(provider_batch, "output_file_id", None)
+        if output_file_id:
+            batch.output_file_id = output_file_id
+            output_text = openai_client.files.content(output_file_id).text
+            batch.replies_saved = apply_batch_output(
+                db, job_id=batch.job_id, output_text=output_text
+            )
+
+        errors = getattr(provider_batch, "errors", None)
+        _mark_failed(db, batch, f"batch {status}: {errors}")
+        return batch
+
+    if status != "completed":
+        if batch.status != status:
+            batch.status = status
+            db.commit()
+        return batch
+
+    output_file_id = getattr(provider_batch, "output_file_id", None)
+    batch.output_file_id = output_file_id
+
+    saved = 0
+    if output_file_id:
+        output_text = openai_client.files.content(output_file_id).text
+        saved = apply_batch_output(db, job_id=batch.job_id, output_text=output_text)
+
+    batch.replies_saved = saved
+    batch.status = "completed"
+    batch.completed_at = _now()
+    db.commit()
+    print(f"✅ ai_reply_batch {batch.id}: {saved} respuestas guardadas")
+    return batch
+
+
+def poll_pending_reply_batches(db: Session, *, openai_client) -> dict[str, int]:
+    pending = (
+        db.query(ReviewAIReplyBatch)
+        .filter(ReviewAIReplyBatch.status.notin_(list(TERMINAL_STATUSES)))
+        .all()
+    )
+
+    completed = 0
+    failed = 0
+    for batch in pending:
+        try:
+            poll_reply_batch(db, batch=batch, openai_client=openai_client)
+        except Exception as e:
+            db.rollback()
+            print(f"⚠️ ai_reply_batch poll {batch.id}:", repr(e))
+            continue
+        if batch.status == "completed":
+            completed += 1
+        elif batch.status == "failed":
+            failed += 1
+
+    return {"checked": len(pending), "completed": completed, "failed": failed}
+
+
+def batch_to_dict(batch: ReviewAIReplyBatch) -> dict[str, Any]:
+    return {
+        "batch_id": batch.id,
+        "job_id": batch.job_id,
+        "mode": batch.mode,
+        "status": batch.status,
+        "requests_count": batch.requests_count,
+        "replies_saved": batch.replies_saved,
+        "error": batch.error_message,
+        "created_at": batch.created_at.isoformat() if batch.created_at else None,
+        "completed_at": batch.completed_at.isoformat() if batch.completed_at else None,
+    }
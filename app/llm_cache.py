@@ -0,0 +1,247 @@
+# app/llm_cache.py
+"""
+Caché persistente (BD) de respuestas LLM.
+
+Clave: (model, temperature, sha256 del prompt). Sirve para no volver a pagar
+tokens/latencia al re-importar el mismo archivo o re-analizar un dataset
+que no ha cambiado. Tiene TTL y un tope de filas (se expulsan las menos usadas).
+
+Las lecturas no escriben: los hits se acumulan en memoria y se vuelcan por
+lotes en una sesión propia; la expulsión se hace de forma periódica.
+
+La caché nunca rompe la llamada: cualquier error de BD se ignora y se
+llama al LLM como siempre.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Optional
+
+from sqlalchemy import bindparam, delete, func, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.db import SessionLocal
+from app.models_llm_cache import LLMResponseCache
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+LLM_CACHE_MAX_ROWS = int(os.getenv("LLM_CACHE_MAX_ROWS", "5000"))
+LLM_CACHE_HITS_FLUSH_SECONDS = int(os.getenv("LLM_CACHE_HITS_FLUSH_SECONDS", "60"))
+LLM_CACHE_EVICT_SECONDS = int(os.getenv("LLM_CACHE_EVICT_SECONDS", "3600"))
+
+# id de fila -> (hits pendientes, último uso)
+_pending_hits: dict[int, tuple[int, datetime]] = {}
+_hits_lock = threading.Lock()
+_last_hits_flush = time.monotonic()
+_last_evict = 0.0
+
+# Temperatura por defecto de la API cuando la llamada no la fija
+DEFAULT_TEMPERATURE = 1.0
+
+
+def prompt_hash(prompt: Any) -> str:
+    raw = json.dumps(prompt, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def file_sha256(file_path: str) -> str:
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _as_utc(dt: datetime) -> datetime:
+    # SQLite devuelve datetimes naive
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def get_cached_response(*, model: str, temperature: float, key: str) -> Optional[tuple[str, int]]:
+    """(texto, id de fila) o None. Solo lectura."""
+    db = SessionLocal()
+    try:
+        row = db.execute(
+            select(LLMResponseCache).where(
+                LLMResponseCache.model == model,
+                LLMResponseCache.temperature == temperature,
+                LLMResponseCache.prompt_hash == key,
+            )
+        ).scalar_one_or_none()
+        if not row:
+            return None
+
+        now = datetime.now(timezone.utc)
+        if _as_utc(row.created_at) < now - timedelta(seconds=LLM_CACHE_TTL_SECONDS):
+            # caducada: la borra la expulsión periódica
+            return None
+
+        return row.response_text, row.id
+    finally:
+        db.close()
+
+
+def _record_hit(row_id: int) -> None:
+    global _last_hits_flush
+
+    now = datetime.now(timezone.utc)
+    with _hits_lock:
+        hits, _ = _pending_hits.get(row_id, (0, now))
+        _pending_hits[row_id] = (hits + 1, now)
+
+        if time.monotonic() - _last_hits_flush < LLM_CACHE_HITS_FLUSH_SECONDS:
+            return
+        pending = dict(_pending_hits)
+        _pending_hits.clear()
+        _last_hits_flush = time.monotonic()
+
+    flush_hits(pending)
+
+
+def flush_hits(pending: Optional[dict[int, tuple[int, datetime]]] = None) -> None:
+    """Vuelca los hits acumulados: un UPDATE (executemany) y un commit."""
+    if pending is None:
+        with _hits_lock:
+            pending = dict(_pending_hits)
+            _pending_hits.clear()
+    if not pending:
+        return
+
+    db = SessionLocal()
+    try:
+        table = LLMResponseCache.__table__
+        db.execute(
+            update(table)
+            .where(table.c.id == bindparam("row_id"))
+            .values(
+                hits=func.coalesce(table.c.hits, 0) + bindparam("new_hits"),
+                last_used_at=bindparam("used_at"),
+            ),
+            [
+                {"row_id": row_id, "new_hits": hits, "used_at": used_at}
+                for row_id, (hits, used_at) in pending.items()
+            ],
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print("⚠️ llm_cache hits:", repr(e))
+    finally:
+        db.close()
+
+
+def store_cached_response(*, model: str, temperature: float, key: str, text: str) -> None:
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        db.add(
+            LLMResponseCache(
+                model=model,
+                temperature=temperature,
+                prompt_hash=key,
+                response_text=text,
+                hits=0,
+                created_at=now,
+                last_used_at=now,
+            )
+        )
+        try:
+            db.commit()
+        except IntegrityError:
+            # ya existe (otra petición a la vez, o una fila caducada que aún
+            # no ha expulsado _maybe_evict): se refresca
+            db.rollback()
+            db.execute(
+                update(LLMResponseCache)
+                .where(
+                    LLMResponseCache.model == model,
+                    LLMResponseCache.temperature == temperature,
+                    LLMResponseCache.prompt_hash == key,
+                )
+                .values(response_text=text, created_at=now, last_used_at=now)
+            )
+            db.commit()
+            return
+
+        _maybe_evict(db, now=now)
+    finally:
+        db.close()
+
+
+def _maybe_evict(db, *, now: datetime) -> None:
+    """Como mucho una vez cada LLM_CACHE_EVICT_SECONDS por proceso."""
+    global _last_evict
+
+    with _hits_lock:
+        if time.monotonic() - _last_evict < LLM_CACHE_EVICT_SECONDS:
+            return
+        _last_evict = time.monotonic()
+
+    db.execute(
+        delete(LLMResponseCache).where(
+            LLMResponseCache.created_at < now - timedelta(seconds=LLM_CACHE_TTL_SECONDS)
+        )
+    )
+
+    total = db.execute(select(func.count(LLMResponseCache.id))).scalar() or 0
+    overflow = total - LLM_CACHE_MAX_ROWS
+    if overflow > 0:
+        oldest_ids = db.execute(
+            select(LLMResponseCache.id)
+            .order_by(LLMResponseCache.last_used_at.asc())
+            .limit(overflow)
+        ).scalars().all()
+        db.execute(delete(LLMResponseCache).where(LLMResponseCache.id.in_(oldest_ids)))
+
+    db.commit()
+
+
+def cached_llm_call(
+    *,
+    model: str,
+    temperature: Optional[float],
+    prompt: Any,
+    compute: Callable[[], str],
+    read_only: bool = False,
+) -> str:
+    """
+    Devuelve la respuesta cacheada para (model, temperature, prompt) o
+    ejecuta `compute()` y guarda su resultado.
+
+    `prompt` puede ser cualquier cosa serializable a JSON (mensajes, texto,
+    hash de un adjunto...). Si `compute()` lanza, no se guarda nada.
+    read_only=True (vistas previas): solo consulta; ni guarda ni cuenta hits.
+    """
+    if not LLM_CACHE_ENABLED:
+        return compute()
+
+    temp = DEFAULT_TEMPERATURE if temperature is None else float(temperature)
+    key = prompt_hash(prompt)
+
+    try:
+        cached = get_cached_response(model=model, temperature=temp, key=key)
+        if cached is not None:
+            text, row_id = cached
+            print(f"💾 llm_cache hit model={model} key={key[:12]}")
+            if not read_only:
+                _record_hit(row_id)
+            return text
+    except Exception as e:
+        print("⚠️ llm_cache lectura:", repr(e))
+
+    text = compute()
+    if read_only:
+        return text
+
+    try:
+        store_cached_response(model=model, temperature=temp, key=key, text=text)
+    except Exception as e:
+        print("⚠️ llm_cache escritura:", repr(e))
+
+    return text
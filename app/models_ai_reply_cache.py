@@ -31,3 +31,34 @@ class ReviewAIReply(Base):
     __table_args__ = (
         UniqueConstraint("review_id", name="uq_review_ai_replies_review_id"),
     )
+
+
+class ReviewAIReplyBatch(Base):
+    __tablename__ = "review_ai_reply_batches"
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(Integer, index=True, nullable=False)
+
+    mode = Column(String(16), nullable=False, default="openai")   # openai | local
+    status = Column(String(32), nullable=False, default="submitted", index=True)
+
+    provider_batch_id = Column(String(128), nullable=True)
+    input_file_id = Column(String(128), nullable=True)
+    output_file_id = Column(String(128), nullable=True)
+
+    requests_count = Column(Integer, nullable=False, default=0)
+    replies_saved = Column(Integer, nullable=False, default=0)
+    error_message = Column(Text, nullable=True)
+
+    created_at = Column(
+        DateTime(timezone=True),
+        nullable=False,
+        default=lambda: datetime.now(timezone.utc),
+    )
+    updated_at = Column(
+        DateTime(timezone=True),
+        nullable=False,
+        default=lambda: datetime.now(timezone.utc),
+        onupdate=lambda: datetime.now(timezone.utc),
+    )
+    completed_at = Column(DateTime(timezone=True), nullable=True)
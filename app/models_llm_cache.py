@@ -0,0 +1,33 @@
+# app/models_llm_cache.py
+from sqlalchemy import Column, Integer, String, Text, DateTime, Float, UniqueConstraint
+from datetime import datetime, timezone
+from app.db import Base
+
+
+class LLMResponseCache(Base):
+    __tablename__ = "llm_response_cache"
+
+    id = Column(Integer, primary_key=True, index=True)
+
+    model = Column(String(64), nullable=False)
+    temperature = Column(Float, nullable=False, default=1.0)
+    prompt_hash = Column(String(64), nullable=False)   # sha256 del prompt (+ adjuntos)
+
+    response_text = Column(Text, nullable=False)
+    hits = Column(Integer, nullable=False, default=0)
+
+    created_at = Column(
+        DateTime(timezone=True),
+        nullable=False,
+        default=lambda: datetime.now(timezone.utc),
+    )
+    last_used_at = Column(
+        DateTime(timezone=True),
+        nullable=False,
+        index=True,
+        default=lambda: datetime.now(timezone.utc),
+    )
+
+    __table_args__ = (
+        UniqueConstraint("model", "temperature", "prompt_hash", name="uq_llm_cache_model_temp_prompt"),
+    )
@@ -0,0 +1,129 @@
+# app/pdf_text.py
+"""
+Extracción de texto de PDFs por páginas.
+
+- PDFs grandes: los rangos de páginas se reparten entre procesos
+  (pypdf es CPU puro, con hilos no escala por el GIL).
+- Caché en memoria del texto de cada página por (sha256 del archivo, nº página),
+  así reintentos / reimportaciones del mismo PDF no vuelven a parsearlo.
+
+Este módulo solo importa pypdf para que los procesos hijos (spawn) arranquen rápido.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from pypdf import PdfReader
+
+PDF_TEXT_WORKERS = int(os.getenv("PDF_TEXT_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "20"))
+PDF_PAGE_CACHE_MAX = int(os.getenv("PDF_PAGE_CACHE_MAX", "5000"))
+
+_page_cache: "OrderedDict[tuple[str, int], str]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _file_sha256(file_path: str) -> str:
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: no heredar conexiones de BD / clientes HTTP del proceso web
+            _pool = ProcessPoolExecutor(
+                max_workers=PDF_TEXT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _extract_page_range(file_path: str, pages: list[int]) -> list[tuple[int, str]]:
+    """Se ejecuta en un proceso hijo: abre el PDF y extrae solo esas páginas."""
+    reader = PdfReader(file_path)
+    out = []
+    for i in pages:
+        try:
+            text = reader.pages[i].extract_text() or ""
+        except Exception:
+            text = ""
+        out.append((i, text))
+    return out
+
+
+def _cache_get(key: tuple[str, int]) -> Optional[str]:
+    with _cache_lock:
+        text = _page_cache.get(key)
+        if text is not None:
+            _page_cache.move_to_end(key)
+        return text
+
+
+def _cache_put(key: tuple[str, int], text: str) -> None:
+    with _cache_lock:
+        _page_cache[key] = text
+        _page_cache.move_to_end(key)
+        while len(_page_cache) > PDF_PAGE_CACHE_MAX:
+            _page_cache.popitem(last=False)
+
+
+def extract_pdf_pages(file_path: str, file_hash: Optional[str] = None) -> list[str]:
+    """
+    Texto de cada página del PDF (cadena vacía si la página no tiene texto).
+    Lista vacía si el PDF no se puede abrir.
+    """
+    try:
+        page_count = len(PdfReader(file_path).pages)
+    except Exception:
+        return []
+
+    file_hash = file_hash or _file_sha256(file_path)
+
+    texts: dict[int, str] = {}
+    missing: list[int] = []
+    for i in range(page_count):
+        cached = _cache_get((file_hash, i))
+        if cached is None:
+            missing.append(i)
+        else:
+            texts[i] = cached
+
+    if missing:
+        workers_used = 1
+        if len(missing) < PDF_PARALLEL_MIN_PAGES or PDF_TEXT_WORKERS <= 1:
+            results = _extract_page_range(file_path, missing)
+        else:
+            # rangos contiguos: cada proceso abre el PDF una sola vez
+            size = -(-len(missing) // PDF_TEXT_WORKERS)
+            ranges = [missing[i:i + size] for i in range(0, len(missing), size)]
+            try:
+                pool = _get_pool()
+                futures = [pool.submit(_extract_page_range, file_path, r) for r in ranges]
+                results = [item for fut in futures for item in fut.result()]
+                workers_used = len(ranges)
+            except Exception as e:
+                print("⚠️ pool de PDF no disponible, extracción secuencial:", repr(e))
+                results = _extract_page_range(file_path, missing)
+
+        for i, text in results:
+            texts[i] = text
+            _cache_put((file_hash, i), text)
+
+        print(f"📄 PDF: {len(missing)}/{page_count} páginas extraídas ({workers_used} procesos)")
+
+    return [texts.get(i, "") for i in range(page_count)]
@@ -0,0 +1,142 @@
+# app/review_dedup.py
+"""
+Colapsa reseñas casi duplicadas antes de mandarlas al LLM.
+
+Muchos negocios tienen decenas de reseñas cortas casi idénticas
+("Muy buena atención", "Excelente!!"). En vez de serializar cada una,
+se agrupan por similitud (MinHash + LSH sobre shingles de caracteres)
+y se envía un representante por grupo con su multiplicidad ("veces").
+"""
+
+from __future__ import annotations
+
+import hashlib
+import re
+import unicodedata
+from typing import Any
+
+_PUNCT_RE = re.compile(r"[^\w\s]+", re.UNICODE)
+_SPACES_RE = re.compile(r"\s+")
+
+SHINGLE_SIZE = 3
+NUM_PERM = 32
+BANDS = 8
+ROWS_PER_BAND = NUM_PERM // BANDS
+SIMILARITY_THRESHOLD = 0.8
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# Coeficientes fijos (deterministas entre procesos) para las permutaciones
+_PERMUTATIONS = [
+    (
+        int.from_bytes(hashlib.sha1(f"a{i}".encode()).digest()[:8], "big") % _MERSENNE_PRIME or 1,
+        int.from_bytes(hashlib.sha1(f"b{i}".encode()).digest()[:8], "big") % _MERSENNE_PRIME,
+    )
+    for i in range(NUM_PERM)
+]
+
+
+def normalize_review_text(text: str | None) -> str:
+    s = (text or "").strip().lower()
+    if not s:
+        return ""
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = _PUNCT_RE.sub(" ", s)
+    return _SPACES_RE.sub(" ", s).strip()
+
+
+def _shingles(normalized: str) -> set[str]:
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized}
+    return {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def _minhash(shingles: set[str]) -> tuple[int, ...]:
+    hashed = [
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "big")
+        for s in shingles
+    ]
+    return tuple(
+        min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashed)
+        for a, b in _PERMUTATIONS
+    )
+
+
+def _jaccard(a: set[str], b: set[str]) -> float:
+    if not a and not b:
+        return 1.0
+    inter = len(a & b)
+    return inter / (len(a) + len(b) - inter)
+
+
+def collapse_near_duplicates(
+    reviews: list[dict[str, Any]],
+    *,
+    text_key: str = "comment",
+    group_key: str | None = "star_rating",
+    threshold: float = SIMILARITY_THRESHOLD,
+) -> list[dict[str, Any]]:
+    """
+    Devuelve una lista de representantes (el primer elemento de cada grupo,
+    respetando el orden de entrada) con dos campos añadidos:
+    - "veces": nº de reseñas que representa
+    - "ids": ids de todas las reseñas del grupo (si tienen "id")
+
+    Solo se agrupan reseñas con el mismo `group_key` (por defecto las
+    estrellas), así "Excelente" de 5★ nunca se mezcla con uno de 1★.
+    """
+    groups: list[dict[str, Any]] = []
+    exact_index: dict[tuple[Any, str], int] = {}
+    lsh_buckets: dict[tuple[Any, int, tuple[int, ...]], list[int]] = {}
+    group_shingles: list[set[str]] = []
+
+    for r in reviews:
+        normalized = normalize_review_text(r.get(text_key))
+        gk = r.get(group_key) if group_key else None
+
+        # 1) Duplicado exacto tras normalizar (caso más común, O(1))
+        idx = exact_index.get((gk, normalized))
+
+        # 2) Casi duplicado vía LSH + verificación Jaccard real
+        shingles = None
+        signature = None
+        if idx is None and normalized:
+            shingles = _shingles(normalized)
+            signature = _minhash(shingles)
+            seen: set[int] = set()
+            for band in range(BANDS):
+                chunk = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+                for candidate in lsh_buckets.get((gk, band, chunk), []):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    if _jaccard(shingles, group_shingles[candidate]) >= threshold:
+                        idx = candidate
+                        break
+                if idx is not None:
+                    break
+
+        if idx is not None:
+            g = groups[idx]
+            g["veces"] += 1
+            if r.get("id") is not None:
+                g["ids"].append(r["id"])
+            exact_index.setdefault((gk, normalized), idx)
+            continue
+
+        idx = len(groups)
+        rep = dict(r)
+        rep["veces"] = 1
+        rep["ids"] = [r["id"]] if r.get("id") is not None else []
+        groups.append(rep)
+        group_shingles.append(shingles or _shingles(normalized))
+        exact_index[(gk, normalized)] = idx
+
+        if signature is not None:
+            for band in range(BANDS):
+                chunk = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+                lsh_buckets.setdefault((gk, band, chunk), []).append(idx)
+
+    return groups
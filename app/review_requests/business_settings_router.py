@@ -1,11 +1,12 @@
 from typing import Optional, Literal
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 
 from app.db import get_db
 from app.review_requests.models import BusinessSettings
+from app.review_requests.sender import invalidate_job_send_context, warm_job_send_context
 from app.review_requests.whatsapp_gateway_service import (
     start_job_whatsapp_session,
     get_job_whatsapp_session_status,
@@ -61,6 +62,7 @@ def get_business_settings(
 @router.patch("")
 def patch_business_settings(
     payload: BusinessSettingsPatchIn,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
 ):
     row = db.query(BusinessSettings).filter(BusinessSettings.job_id == payload.job_id).first()
@@ -98,6 +100,9 @@ def patch_business_settings(
     db.commit()
     db.refresh(row)
 
+    # la review URL se resuelve ahora y no en el primer envío
+    background_tasks.add_task(warm_job_send_context, payload.job_id)
+
     return {
         "job_id": row.job_id,
         "google_review_url": row.google_review_url,
@@ -131,6 +136,7 @@ def connect_whatsapp(
         row.whatsapp_last_error = result.get("last_error")
         db.add(row)
         db.commit()
+        invalidate_job_send_context(row.job_id)
 
         return result
     except WhatsAppGatewayError as e:
@@ -138,6 +144,7 @@ def connect_whatsapp(
         row.whatsapp_last_error = str(e)
         db.add(row)
         db.commit()
+        invalidate_job_send_context(row.job_id)
         raise HTTPException(status_code=400, detail=str(e))
 
 
@@ -161,6 +168,7 @@ def whatsapp_status(
         row.whatsapp_last_error = result.get("last_error")
         db.add(row)
         db.commit()
+        invalidate_job_send_context(row.job_id)
 
         return result
     except WhatsAppGatewayError as e:
@@ -168,4 +176,5 @@ def whatsapp_status(
         row.whatsapp_last_error = str(e)
         db.add(row)
         db.commit()
+        invalidate_job_send_context(row.job_id)
         raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
@@ -12,6 +12,8 @@ from sqlalchemy import (
     Date,
     Numeric,
     JSON,
+    LargeBinary,
+    UniqueConstraint,
 )
 from sqlalchemy.sql import func
 
@@ -35,6 +37,9 @@ class ReviewImportBatch(Base):
     )
     manual_review_reason = Column(Text, nullable=True)
 
+    # importaciones en segundo plano: {"stage", "files_total", "files_done", "rows_processed", "summary"}
+    progress_json = Column(JSON, nullable=True)
+
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
 
@@ -131,4 +136,43 @@ class ReviewAppointmentSource(Base):
     raw_time = Column(Text, nullable=True)
     confidence = Column(Numeric(4, 3), nullable=True)
 
-    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
\ No newline at end of file
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class ReviewImportExtraction(Base):
+    """
+    Resultado normalizado de la extracción (LLM) de un archivo, por contenido.
+    payload_gz = JSON {"appointments": [...], "unparsed": [...]} comprimido con gzip.
+    """
+    __tablename__ = "review_import_extractions"
+
+    id = Column(BigInteger, primary_key=True, index=True)
+    file_hash = Column(String(128), nullable=False, index=True)
+    extractor_version = Column(String(32), nullable=False)
+
+    payload_gz = Column(LargeBinary, nullable=False)
+    appointments_count = Column(Integer, nullable=False, default=0)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("file_hash", "extractor_version", name="uq_import_extraction_hash_version"),
+    )
+
+
+class ReviewImportClaim(Base):
+    """
+    Reserva de (job, sha256) mientras un archivo se importa: dos subidas
+    simultáneas del mismo archivo no se procesan a la vez. Se libera al
+    terminar (el archivo ya figura en review_import_files) o al fallar.
+    """
+    __tablename__ = "review_import_claims"
+
+    id = Column(BigInteger, primary_key=True, index=True)
+    job_id = Column(Integer, nullable=False, index=True)
+    file_hash = Column(String(128), nullable=False)
+    claimed_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("job_id", "file_hash", name="uq_import_claim_job_hash"),
+    )
@@ -3,9 +3,40 @@ from __future__ import annotations
 import re
 import unicodedata
 from datetime import date, datetime, time, timezone, timedelta
-from typing import Any, Optional
+from functools import lru_cache
+from typing import Any, Iterable, Optional
 from zoneinfo import ZoneInfo
 
+# Las mismas cadenas (teléfono, fecha, hora, nombre) se repiten muchas veces
+# en una agenda: los normalizadores de texto van memoizados.
+NORMALIZER_CACHE_SIZE = 65536
+
+_NAME_PUNCT_RE = re.compile(r"[,\.;:_\-]+")
+_NAME_TITLES_RE = re.compile(r"\b(sr|sra|dr|dra)\b\.?")
+_SPACES_RE = re.compile(r"\s+")
+_PHONE_KEEP_RE = re.compile(r"[^\d+]")
+_NON_DIGITS_RE = re.compile(r"\D")
+_DATE_PUNCT_RE = re.compile(r"[,.;]")
+_DATE_DE_RE = re.compile(r"\bde\b")
+_DAY_MONTH_RE = re.compile(r"^(\d{1,2})\s+([a-z]+)(?:\s+(\d{4}))?$")
+_MONTH_DAY_RE = re.compile(r"^([a-z]+)\s+(\d{1,2})(?:\s+(\d{4}))?$")
+_HH_MM_RE = re.compile(r"^(\d{1,2}):(\d{2})$")
+
+DATE_FORMATS = (
+    "%Y-%m-%d",
+    "%d/%m/%Y",
+    "%d-%m-%Y",
+    "%d/%m/%y",
+    "%d-%m-%y",
+    "%Y/%m/%d",
+)
+TIME_FORMATS = ("%H:%M", "%H:%M:%S", "%H%M")
+
+
+def _strip_accents(s: str) -> str:
+    s = unicodedata.normalize("NFKD", s)
+    return "".join(ch for ch in s if not unicodedata.combining(ch))
+
 SPANISH_MONTHS = {
     "enero": 1,
     "febrero": 2,
@@ -30,15 +61,19 @@ SPANISH_WEEKDAYS = {
 def normalize_name(value: Optional[str]) -> Optional[str]:
     if not value:
         return None
-    s = str(value).strip().lower()
+    return _normalize_name_str(str(value))
+
+
+@lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def _normalize_name_str(value: str) -> Optional[str]:
+    s = value.strip().lower()
     if not s:
         return None
 
-    s = unicodedata.normalize("NFKD", s)
-    s = "".join(ch for ch in s if not unicodedata.combining(ch))
-    s = re.sub(r"[,\.;:_\-]+", " ", s)
-    s = re.sub(r"\b(sr|sra|dr|dra)\b\.?", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _strip_accents(s)
+    s = _NAME_PUNCT_RE.sub(" ", s)
+    s = _NAME_TITLES_RE.sub(" ", s)
+    s = _SPACES_RE.sub(" ", s).strip()
     return s or None
 
 
@@ -57,19 +92,23 @@ def choose_display_name(current: Optional[str], new_value: Optional[str]) -> Opt
 def normalize_phone(value: Optional[str], default_country: str = "ES") -> Optional[str]:
     if not value:
         return None
+    return _normalize_phone_str(str(value), default_country)
 
-    s = str(value).strip()
+
+@lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def _normalize_phone_str(value: str, default_country: str) -> Optional[str]:
+    s = value.strip()
     if not s:
         return None
 
-    s = re.sub(r"[^\d+]", "", s)
+    s = _PHONE_KEEP_RE.sub("", s)
     if s.startswith("+"):
-        digits = re.sub(r"\D", "", s[1:])
+        digits = _NON_DIGITS_RE.sub("", s[1:])
         if 8 <= len(digits) <= 15:
             return "+" + digits
         return None
 
-    digits = re.sub(r"\D", "", s)
+    digits = _NON_DIGITS_RE.sub("", s)
     if not digits:
         return None
 
@@ -84,25 +123,27 @@ def normalize_phone(value: Optional[str], default_country: str = "ES") -> Option
 def _parse_spanish_text_date(value: Any) -> Optional[date]:
     if value is None or value == "":
         return None
+    return _parse_spanish_text_date_str(str(value), datetime.now().year)
 
-    s = str(value).strip().lower()
+
+@lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def _parse_spanish_text_date_str(value: str, current_year: int) -> Optional[date]:
+    s = value.strip().lower()
     if not s:
         return None
 
-    s = unicodedata.normalize("NFKD", s)
-    s = "".join(ch for ch in s if not unicodedata.combining(ch))
-    s = re.sub(r"[,.;]", " ", s)
-    s = re.sub(r"\bde\b", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _strip_accents(s)
+    s = _DATE_PUNCT_RE.sub(" ", s)
+    s = _DATE_DE_RE.sub(" ", s)
+    s = _SPACES_RE.sub(" ", s).strip()
 
     tokens = [tok for tok in s.split() if tok not in SPANISH_WEEKDAYS]
     if not tokens:
         return None
 
     s = " ".join(tokens)
-    current_year = datetime.now().year
 
-    m = re.match(r"^(\d{1,2})\s+([a-z]+)(?:\s+(\d{4}))?$", s)
+    m = _DAY_MONTH_RE.match(s)
     if m:
         day = int(m.group(1))
         month = SPANISH_MONTHS.get(m.group(2))
@@ -113,7 +154,7 @@ def _parse_spanish_text_date(value: Any) -> Optional[date]:
             except Exception:
                 return None
 
-    m = re.match(r"^([a-z]+)\s+(\d{1,2})(?:\s+(\d{4}))?$", s)
+    m = _MONTH_DAY_RE.match(s)
     if m:
         month = SPANISH_MONTHS.get(m.group(1))
         day = int(m.group(2))
@@ -127,7 +168,7 @@ def _parse_spanish_text_date(value: Any) -> Optional[date]:
     return None
 
 
-def _parse_date(value: Any) -> Optional[date]:
+def _parse_date(value: Any, date_format: Optional[str] = None) -> Optional[date]:
     if value is None or value == "":
         return None
 
@@ -141,14 +182,19 @@ def _parse_date(value: Any) -> Optional[date]:
     if not s:
         return None
 
-    for fmt in (
-        "%Y-%m-%d",
-        "%d/%m/%Y",
-        "%d-%m-%Y",
-        "%d/%m/%y",
-        "%d-%m-%y",
-        "%Y/%m/%d",
-    ):
+    # formato ya detectado para la columna: un único strptime
+    if date_format:
+        try:
+            return datetime.strptime(s, date_format).date()
+        except Exception:
+            pass
+
+    return _parse_date_str(s)
+
+
+@lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def _parse_date_str(s: str) -> Optional[date]:
+    for fmt in DATE_FORMATS:
         try:
             return datetime.strptime(s, fmt).date()
         except Exception:
@@ -164,6 +210,35 @@ def _parse_date(value: Any) -> Optional[date]:
         return None
 
 
+def sniff_date_format(values: Iterable[Any], sample_size: int = 50) -> Optional[str]:
+    """
+    Elige una vez (por archivo/columna) el primer formato de DATE_FORMATS que
+    encaja con todas las fechas de una muestra; None si no hay uno común.
+    """
+    sample: list[str] = []
+    for v in values:
+        if isinstance(v, (date, datetime)) or v is None:
+            continue
+        s = str(v).strip()
+        if s:
+            sample.append(s)
+        if len(sample) >= sample_size:
+            break
+
+    if not sample:
+        return None
+
+    for fmt in DATE_FORMATS:
+        try:
+            for s in sample:
+                datetime.strptime(s, fmt)
+        except Exception:
+            continue
+        return fmt
+
+    return None
+
+
 def _parse_time(value: Any) -> Optional[time]:
     if value is None or value == "":
         return None
@@ -174,20 +249,25 @@ def _parse_time(value: Any) -> Optional[time]:
     if isinstance(value, time):
         return value.replace(second=0, microsecond=0)
 
-    s = str(value).strip()
+    return _parse_time_str(str(value))
+
+
+@lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def _parse_time_str(value: str) -> Optional[time]:
+    s = value.strip()
     if not s:
         return None
 
     s = s.replace(".", ":")
-    s = re.sub(r"\s+", "", s)
+    s = _SPACES_RE.sub("", s)
 
-    for fmt in ("%H:%M", "%H:%M:%S", "%H%M"):
+    for fmt in TIME_FORMATS:
         try:
             return datetime.strptime(s, fmt).time().replace(second=0, microsecond=0)
         except Exception:
             continue
 
-    m = re.match(r"^(\d{1,2}):(\d{2})$", s)
+    m = _HH_MM_RE.match(s)
     if m:
         hh = int(m.group(1))
         mm = int(m.group(2))
@@ -196,8 +276,8 @@ def _parse_time(value: Any) -> Optional[time]:
 
     return None
 
-def normalize_date_str(value: Any) -> Optional[str]:
-    d = _parse_date(value)
+def normalize_date_str(value: Any, date_format: Optional[str] = None) -> Optional[str]:
+    d = _parse_date(value, date_format)
     return d.isoformat() if d else None
 
 
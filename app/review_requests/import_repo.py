@@ -1,14 +1,20 @@
 from __future__ import annotations
 
-from datetime import date
-from typing import Optional
-
-from sqlalchemy import and_, or_, select
+import gzip
+import json
+import os
+from datetime import date, timedelta
+from typing import Any, Optional
+
+from sqlalchemy import and_, delete, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from .import_models import (
     ReviewImportBatch,
+    ReviewImportClaim,
     ReviewImportFile,
+    ReviewImportExtraction,
     ReviewPatient,
     ReviewPatientSource,
     ReviewAppointment,
@@ -17,6 +23,11 @@ from .import_models import (
 from .utils import utcnow
 
 
+# un lote en 'processing' que no avanza en este tiempo se da por muerto
+# (el progreso se guarda por archivo/bloque, así que sobra margen)
+STALE_IMPORT_BATCH_SECONDS = int(os.getenv("IMPORT_STALE_BATCH_SECONDS", "1800"))
+
+
 def create_import_batch(db: Session, *, job_id: int, files_count: int) -> ReviewImportBatch:
     row = ReviewImportBatch(
         job_id=job_id,
@@ -34,20 +45,32 @@ def mark_import_batch_completed(
     batch_id: int,
     manual_review_required: bool = False,
     manual_review_reason: Optional[str] = None,
-) -> None:
-    row = db.get(ReviewImportBatch, batch_id)
-    if not row:
-        return
-    row.status = "completed"
-    row.manual_review_required = manual_review_required
-    row.manual_review_reason = manual_review_reason[:4000] if manual_review_reason else None
-    row.updated_at = utcnow()
-    
+) -> bool:
+    """
+    Solo si el lote sigue en 'processing': False si entretanto se marcó como
+    fallido (p. ej. fail_stale_import_batches), que no se sobrescribe.
+    """
+    result = db.execute(
+        update(ReviewImportBatch)
+        .where(
+            ReviewImportBatch.id == batch_id,
+            ReviewImportBatch.status == "processing",
+        )
+        .values(
+            status="completed",
+            manual_review_required=manual_review_required,
+            manual_review_reason=manual_review_reason[:4000] if manual_review_reason else None,
+            updated_at=utcnow(),
+        )
+    )
+    return (result.rowcount or 0) > 0
+
 
 
 def mark_import_batch_failed(db: Session, *, batch_id: int, error_message: str) -> None:
     row = db.get(ReviewImportBatch, batch_id)
-    if not row:
+    # ya fallido (p. ej. por el barrido de lotes colgados): se conserva el primer error
+    if not row or row.status == "failed":
         return
     row.status = "failed"
     row.error_message = error_message[:4000]
@@ -55,6 +78,50 @@ def mark_import_batch_failed(db: Session, *, batch_id: int, error_message: str)
     
 
 
+def touch_import_batches(db: Session, *, batch_ids: set[int]) -> set[int]:
+    """
+    Latido de importaciones en curso: renueva updated_at de los lotes que
+    siguen en 'processing' y devuelve sus ids (los que faltan ya no lo están).
+    """
+    if not batch_ids:
+        return set()
+
+    alive = db.execute(
+        update(ReviewImportBatch)
+        .where(
+            ReviewImportBatch.id.in_(batch_ids),
+            ReviewImportBatch.status == "processing",
+        )
+        .values(updated_at=utcnow())
+        .returning(ReviewImportBatch.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    db.commit()
+    return set(alive)
+
+
+def fail_stale_import_batches(db: Session, *, older_than_seconds: int = STALE_IMPORT_BATCH_SECONDS) -> int:
+    """
+    Lotes 'processing' sin actualizar desde hace older_than_seconds (el
+    proceso que los importaba murió): se marcan como fallidos.
+    """
+    cutoff = utcnow() - timedelta(seconds=older_than_seconds)
+    result = db.execute(
+        update(ReviewImportBatch)
+        .where(
+            ReviewImportBatch.status == "processing",
+            ReviewImportBatch.updated_at < cutoff,
+        )
+        .values(
+            status="failed",
+            error_message="Importación interrumpida (sin progreso)",
+            updated_at=utcnow(),
+        )
+    )
+    db.commit()
+    return result.rowcount or 0
+
+
 def create_import_file(
     db: Session,
     *,
@@ -83,6 +150,137 @@ def create_import_file(
     db.flush()
     return row
 
+def find_imported_file_by_hash(
+    db: Session,
+    *,
+    job_id: int,
+    file_hash: str,
+) -> Optional[ReviewImportFile]:
+    """
+    Último archivo con el mismo contenido ya importado (o importándose) en el job.
+    """
+    stmt = (
+        select(ReviewImportFile)
+        .join(ReviewImportBatch, ReviewImportBatch.id == ReviewImportFile.batch_id)
+        .where(
+            and_(
+                ReviewImportBatch.job_id == job_id,
+                ReviewImportBatch.status.in_(("completed", "processing")),
+                ReviewImportFile.file_hash == file_hash,
+            )
+        )
+        .order_by(ReviewImportFile.id.desc())
+        .limit(1)
+    )
+    return db.execute(stmt).scalar_one_or_none()
+
+
+def claim_import_file(db: Session, *, job_id: int, file_hash: str, ttl_seconds: int) -> bool:
+    """
+    Reserva (job, sha256) para esta importación; False si otra la tiene.
+    Una reserva más antigua que ttl_seconds (proceso caído) se toma. Hace commit.
+    """
+    now = utcnow()
+    db.add(ReviewImportClaim(job_id=job_id, file_hash=file_hash, claimed_at=now))
+    try:
+        db.commit()
+        return True
+    except IntegrityError:
+        db.rollback()
+
+    taken = db.execute(
+        update(ReviewImportClaim)
+        .where(
+            and_(
+                ReviewImportClaim.job_id == job_id,
+                ReviewImportClaim.file_hash == file_hash,
+                ReviewImportClaim.claimed_at < now - timedelta(seconds=ttl_seconds),
+            )
+        )
+        .values(claimed_at=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    return bool(taken)
+
+
+def release_import_claims(db: Session, *, job_id: int, file_hashes: list[str]) -> None:
+    if not file_hashes:
+        return
+    db.execute(
+        delete(ReviewImportClaim)
+        .where(
+            and_(
+                ReviewImportClaim.job_id == job_id,
+                ReviewImportClaim.file_hash.in_(file_hashes),
+            )
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+
+def update_import_file_storage(
+    db: Session,
+    *,
+    batch_id: int,
+    file_hash: str,
+    storage_key: str,
+) -> None:
+    rows = db.execute(
+        select(ReviewImportFile).where(
+            and_(
+                ReviewImportFile.batch_id == batch_id,
+                ReviewImportFile.file_hash == file_hash,
+            )
+        )
+    ).scalars().all()
+    for row in rows:
+        row.storage_key = storage_key
+
+
+def get_cached_extraction(
+    db: Session,
+    *,
+    file_hash: str,
+    extractor_version: str,
+) -> Optional[dict[str, Any]]:
+    row = db.execute(
+        select(ReviewImportExtraction).where(
+            and_(
+                ReviewImportExtraction.file_hash == file_hash,
+                ReviewImportExtraction.extractor_version == extractor_version,
+            )
+        )
+    ).scalar_one_or_none()
+    if not row:
+        return None
+    return json.loads(gzip.decompress(row.payload_gz).decode("utf-8"))
+
+
+def save_cached_extraction(
+    db: Session,
+    *,
+    file_hash: str,
+    extractor_version: str,
+    data: dict[str, Any],
+) -> None:
+    raw = json.dumps(data, ensure_ascii=False, default=str).encode("utf-8")
+    db.add(
+        ReviewImportExtraction(
+            file_hash=file_hash,
+            extractor_version=extractor_version,
+            payload_gz=gzip.compress(raw),
+            appointments_count=len(data.get("appointments") or []),
+        )
+    )
+    try:
+        db.commit()
+    except IntegrityError:
+        # otra importación del mismo archivo la guardó a la vez
+        db.rollback()
+
+
 def find_patient_by_phone(db: Session, *, job_id: int, phone_e164: str) -> Optional[ReviewPatient]:
     stmt = (
         select(ReviewPatient)
@@ -111,6 +309,43 @@ def find_patient_by_name(db: Session, *, job_id: int, normalized_name: str) -> O
     return db.execute(stmt).scalar_one_or_none()
 
 
+def new_patient(
+    *,
+    job_id: int,
+    display_name: Optional[str],
+    normalized_name: Optional[str],
+    phone_e164: Optional[str],
+) -> ReviewPatient:
+    """Paciente sin añadir a la sesión (para inserciones masivas)."""
+    return ReviewPatient(
+        job_id=job_id,
+        display_name=display_name,
+        normalized_name=normalized_name,
+        phone_e164=phone_e164,
+        last_seen_at=utcnow(),
+    )
+
+
+def merge_patient_fields(
+    patient: ReviewPatient,
+    *,
+    display_name: Optional[str],
+    normalized_name: Optional[str],
+    phone_e164: Optional[str],
+) -> str:
+    if display_name and (not patient.display_name or len(display_name) > len(patient.display_name or "")):
+        patient.display_name = display_name
+
+    if normalized_name and not patient.normalized_name:
+        patient.normalized_name = normalized_name
+
+    if phone_e164 and not patient.phone_e164:
+        patient.phone_e164 = phone_e164
+
+    patient.last_seen_at = utcnow()
+    return "updated"
+
+
 def upsert_patient(
     db: Session,
     *,
@@ -128,38 +363,23 @@ def upsert_patient(
         patient = find_patient_by_name(db, job_id=job_id, normalized_name=normalized_name)
 
     if not patient:
-        patient = ReviewPatient(
+        patient = new_patient(
             job_id=job_id,
             display_name=display_name,
             normalized_name=normalized_name,
             phone_e164=phone_e164,
-            last_seen_at=utcnow(),
         )
         db.add(patient)
         db.flush()
         return patient, "created"
 
-    changed = False
-
-    if display_name and (not patient.display_name or len(display_name) > len(patient.display_name or "")):
-        patient.display_name = display_name
-        changed = True
-
-    if normalized_name and not patient.normalized_name:
-        patient.normalized_name = normalized_name
-        changed = True
-
-    if phone_e164 and not patient.phone_e164:
-        patient.phone_e164 = phone_e164
-        changed = True
-
-    patient.last_seen_at = utcnow()
-    changed = True
-
-    if changed:
-        return patient, "updated"
-
-    return patient, "unchanged"
+    state = merge_patient_fields(
+        patient,
+        display_name=display_name,
+        normalized_name=normalized_name,
+        phone_e164=phone_e164,
+    )
+    return patient, state
 
 def add_patient_source(
     db: Session,
@@ -180,6 +400,12 @@ def add_patient_source(
     db.add(row)
 
 
+def bulk_insert_patient_sources(db: Session, *, rows: list[dict[str, Any]]) -> None:
+    """Un único INSERT (executemany) para todos los orígenes del bloque."""
+    if rows:
+        db.execute(insert(ReviewPatientSource), rows)
+
+
 def find_matching_appointment(
     db: Session,
     *,
@@ -266,8 +492,7 @@ def find_matching_appointment(
     return None
 
 
-def create_appointment(
-    db: Session,
+def new_appointment(
     *,
     job_id: int,
     patient_id: Optional[int],
@@ -285,7 +510,8 @@ def create_appointment(
     is_duplicate: bool,
     is_too_old: bool,
 ) -> ReviewAppointment:
-    row = ReviewAppointment(
+    """Cita sin añadir a la sesión (para inserciones masivas)."""
+    return ReviewAppointment(
         job_id=job_id,
         patient_id=patient_id,
         display_name=display_name,
@@ -302,6 +528,44 @@ def create_appointment(
         is_duplicate=is_duplicate,
         is_too_old=is_too_old,
     )
+
+
+def create_appointment(
+    db: Session,
+    *,
+    job_id: int,
+    patient_id: Optional[int],
+    display_name: Optional[str],
+    normalized_name: Optional[str],
+    phone_e164: Optional[str],
+    appointment_date: Optional[date],
+    appointment_time: Optional[str],
+    appointment_at,
+    timezone: Optional[str],
+    missing_fields: list[str],
+    issues: list[str],
+    merge_confidence: Optional[float],
+    status: str,
+    is_duplicate: bool,
+    is_too_old: bool,
+) -> ReviewAppointment:
+    row = new_appointment(
+        job_id=job_id,
+        patient_id=patient_id,
+        display_name=display_name,
+        normalized_name=normalized_name,
+        phone_e164=phone_e164,
+        appointment_date=appointment_date,
+        appointment_time=appointment_time,
+        appointment_at=appointment_at,
+        timezone=timezone,
+        missing_fields=missing_fields,
+        issues=issues,
+        merge_confidence=merge_confidence,
+        status=status,
+        is_duplicate=is_duplicate,
+        is_too_old=is_too_old,
+    )
     db.add(row)
     db.flush()
     return row
@@ -405,6 +669,12 @@ def add_appointment_source(
     db.add(row)
 
 
+def bulk_insert_appointment_sources(db: Session, *, rows: list[dict[str, Any]]) -> None:
+    """Un único INSERT (executemany) para todos los orígenes del bloque."""
+    if rows:
+        db.execute(insert(ReviewAppointmentSource), rows)
+
+
 def attach_review_request_to_appointment(
     db: Session,
     *,
@@ -453,6 +723,32 @@ def load_patients_for_job_matching(
     return list(db.execute(stmt).scalars().all())
 
 
+def load_patients_by_ids(db: Session, *, job_id: int, ids: set[int]) -> list[ReviewPatient]:
+    if not ids:
+        return []
+    stmt = select(ReviewPatient).where(
+        and_(
+            ReviewPatient.job_id == job_id,
+            ReviewPatient.id.in_(ids),
+        )
+    )
+    return list(db.execute(stmt).scalars().all())
+
+
+def load_patient_identities_for_job(db: Session, *, job_id: int) -> list[tuple[int, Optional[str], Optional[str]]]:
+    """(id, normalized_name, phone_e164) de todos los pacientes del job, sin cargar objetos ORM."""
+    stmt = (
+        select(ReviewPatient.id, ReviewPatient.normalized_name, ReviewPatient.phone_e164)
+        .where(
+            and_(
+                ReviewPatient.job_id == job_id,
+                ReviewPatient.normalized_name.is_not(None),
+            )
+        )
+    )
+    return [tuple(r) for r in db.execute(stmt).all()]
+
+
 def load_appointments_for_job_matching(
     db: Session,
     *,
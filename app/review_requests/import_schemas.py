@@ -45,10 +45,12 @@ class ImportSummaryOut(BaseModel):
     duplicates: int
     too_old: int
     conflicts: int
+    duplicate_files: int = 0
 
 
 class ImportBatchOut(BaseModel):
     batch_id: int
+    dry_run: bool = False
     summary: ImportSummaryOut
     items: list[ImportItemOut]
 
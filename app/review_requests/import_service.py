@@ -1,24 +1,27 @@
 from __future__ import annotations
 
 from datetime import datetime
-from typing import Any
+from typing import Any, Optional
 
 from sqlalchemy.orm import Session
-from .import_models import ReviewAppointment
+from .import_models import ReviewAppointment, ReviewImportBatch, ReviewPatient
 from . import repo as review_repo
 from .import_repo import (
     create_import_batch,
     create_import_file,
     mark_import_batch_completed,
     mark_import_batch_failed,
-    upsert_patient,
-    add_patient_source,
-    create_appointment,
+    new_patient,
+    merge_patient_fields,
+    new_appointment,
     update_appointment,
-    add_appointment_source,
+    bulk_insert_patient_sources,
+    bulk_insert_appointment_sources,
     attach_review_request_to_appointment,
     load_patients_for_job_matching,
     load_appointments_for_job_matching,
+    load_patients_by_ids,
+    load_patient_identities_for_job,
 )
 from .import_normalizers import (
     normalize_name,
@@ -29,8 +32,14 @@ from .import_normalizers import (
     build_appointment_at,
     detect_missing_fields,
     is_older_than_24h,
+    sniff_date_format,
 )
+from .patient_index import PatientIndex, fuzzy_candidate_ids, remember_job_patients
 from .utils import compute_send_at
+DUPLICATE_FILES_USER_MESSAGE = (
+    "Este archivo ya se había importado y no contiene cambios. No se ha procesado de nuevo."
+)
+
 MANUAL_REVIEW_USER_MESSAGE = (
     "Tu archivo se ha recibido correctamente. En menos de 24 horas, "
     "uno de nuestros especialistas configurará el flujo adecuado para tu negocio."
@@ -61,6 +70,55 @@ def _decide_status(
 
 
 
+def _iter_appointment_chunks(file_payload: dict[str, Any]):
+    """
+    Un archivo puede traer sus citas ya extraídas ("appointments") o, si es un
+    CSV/Excel grande, un generador de listas ("appointment_chunks").
+    """
+    chunks = file_payload.get("appointment_chunks")
+    if chunks is not None:
+        yield from chunks
+        return
+
+    appointments = file_payload.get("appointments") or []
+    if appointments:
+        yield appointments
+
+
+def _chunk_keys(chunk: list[dict[str, Any]]) -> tuple[set[str], set[str]]:
+    phones: set[str] = set()
+    names: set[str] = set()
+
+    for raw in chunk:
+        phone = normalize_phone(raw.get("phone"))
+        name = normalize_name(raw.get("name"))
+        if phone:
+            phones.add(phone)
+        if name:
+            names.add(name)
+
+    return phones, names
+
+
+def _write_progress(
+    batch: ReviewImportBatch,
+    *,
+    stage: str,
+    files_total: int,
+    files_done: int,
+    rows_processed: int,
+    summary: dict[str, Any],
+) -> None:
+    # dict nuevo en cada escritura: SQLAlchemy no detecta mutaciones de JSON
+    batch.progress_json = {
+        "stage": stage,
+        "files_total": files_total,
+        "files_done": files_done,
+        "rows_processed": rows_processed,
+        "summary": dict(summary),
+    }
+
+
 def import_appointments_payloads(
     db: Session,
     *,
@@ -68,14 +126,35 @@ def import_appointments_payloads(
     files_payload: list[dict[str, Any]],
     preload_phones: set[str] | None = None,
     preload_names: set[str] | None = None,
+    duplicate_files: int = 0,
+    batch_id: int | None = None,
+    dry_run: bool = False,
 ) -> dict[str, Any]:
+    """
+    Importa las filas extraídas: matching contra pacientes/citas del job,
+    volcado por bloques y programación de review requests.
+
+    dry_run=True (vista previa): mismo matching y mismo resumen/items, pero
+    solo lecturas. El lote no se guarda (batch_id 0), los cambios quedan en
+    objetos en memoria y al final se hace rollback de la sesión.
+    """
     CHUNK_FLUSH_EVERY = 1000
     MAX_RESPONSE_ITEMS = 200
 
-    batch = create_import_batch(db, job_id=job_id, files_count=len(files_payload))
+    if dry_run:
+        # lote transitorio (no se añade a la sesión) y sin autoflush: las
+        # consultas de precarga no deben volcar los objetos modificados
+        batch = ReviewImportBatch(job_id=job_id, status="preview", files_count=len(files_payload))
+        previous_autoflush = db.autoflush
+        db.autoflush = False
+    else:
+        # importación en segundo plano: el lote ya existe (creado por el endpoint)
+        batch = db.get(ReviewImportBatch, batch_id) if batch_id is not None else None
+        if batch is None:
+            batch = create_import_batch(db, job_id=job_id, files_count=len(files_payload))
 
     summary = {
-        "files_received": len(files_payload),
+        "files_received": len(files_payload) + duplicate_files,
         "rows_extracted": 0,
         "patients_created": 0,
         "patients_updated": 0,
@@ -87,21 +166,102 @@ def import_appointments_payloads(
         "duplicates": 0,
         "too_old": 0,
         "conflicts": 0,
+        "duplicate_files": duplicate_files,
     }
 
     items: list[dict[str, Any]] = []
     items_truncated = False
 
-    ready_appointment_ids: list[int] = []
-    item_index_by_appointment_id: dict[int, int] = {}
-
-    try:
-        existing_patients = load_patients_for_job_matching(
+    ready_appointments: list[ReviewAppointment] = []
+    item_index_by_appointment: dict[ReviewAppointment, int] = {}
+
+    # Motor por conjuntos: las filas se resuelven contra los índices en memoria
+    # y las escrituras se acumulan; cada bloque se vuelca con un INSERT masivo
+    # por tabla (pacientes, citas, orígenes) en vez de un flush por fila.
+    pending_patients: list[ReviewPatient] = []
+    pending_appointments: list[ReviewAppointment] = []
+    pending_appointment_patients: list[tuple[ReviewAppointment, ReviewPatient]] = []
+    pending_patient_sources: list[tuple[ReviewPatient, dict[str, Any]]] = []
+    pending_appointment_sources: list[tuple[ReviewAppointment, dict[str, Any]]] = []
+    pending_item_ids: list[tuple[dict[str, Any], Any, Any]] = []
+    # pacientes escritos por esta importación: id -> (nombre, teléfono)
+    touched_identities: dict[int, tuple[Optional[str], Optional[str]]] = {}
+
+    def _flush_pending() -> None:
+        if dry_run:
+            for item, patient, appointment in pending_item_ids:
+                if appointment is not None:
+                    item["appointment_id"] = appointment.id
+                    item["patient_id"] = appointment.patient_id or (patient.id if patient else None)
+                elif patient is not None:
+                    item["patient_id"] = patient.id
+
+            pending_patients.clear()
+            pending_appointments.clear()
+            pending_appointment_patients.clear()
+            pending_patient_sources.clear()
+            pending_appointment_sources.clear()
+            pending_item_ids.clear()
+            return
+
+        if pending_patients:
+            db.add_all(pending_patients)
+            db.flush()
+
+        for appointment, patient in pending_appointment_patients:
+            if appointment.patient_id is None and patient.id is not None:
+                appointment.patient_id = patient.id
+
+        if pending_appointments:
+            db.add_all(pending_appointments)
+        db.flush()
+
+        bulk_insert_patient_sources(
             db,
-            job_id=job_id,
-            phones=preload_phones or set(),
-            names=preload_names or set(),
+            rows=[{**src, "patient_id": p.id} for p, src in pending_patient_sources],
+        )
+        for p, _ in pending_patient_sources:
+            touched_identities[p.id] = (p.normalized_name, p.phone_e164)
+        bulk_insert_appointment_sources(
+            db,
+            rows=[{**src, "appointment_id": a.id} for a, src in pending_appointment_sources],
         )
+
+        for item, patient, appointment in pending_item_ids:
+            if appointment is not None:
+                item["appointment_id"] = appointment.id
+                item["patient_id"] = appointment.patient_id
+            elif patient is not None:
+                item["patient_id"] = patient.id
+
+        pending_patients.clear()
+        pending_appointments.clear()
+        pending_appointment_patients.clear()
+        pending_patient_sources.clear()
+        pending_appointment_sources.clear()
+        pending_item_ids.clear()
+
+    try:
+        patient_index = PatientIndex()
+
+        def _load_patients(phones: set[str], names: set[str]) -> list[Any]:
+            """
+            Pacientes con el mismo teléfono/nombre y, si el matching aproximado
+            está activo, los candidatos por nombre parecido (índice de
+            identidades cacheado por job): solo se cargan los que pueden coincidir.
+            """
+            patients = load_patients_for_job_matching(db, job_id=job_id, phones=phones, names=names)
+            if patient_index.threshold < 1.0 and names:
+                ids = fuzzy_candidate_ids(
+                    job_id,
+                    names,
+                    load_identities=lambda: load_patient_identities_for_job(db, job_id=job_id),
+                )
+                ids -= {p.id for p in patients}
+                patients.extend(load_patients_by_ids(db, job_id=job_id, ids=ids))
+            return patients
+
+        existing_patients = _load_patients(preload_phones or set(), preload_names or set())
         existing_appointments = load_appointments_for_job_matching(
             db,
             job_id=job_id,
@@ -113,33 +273,79 @@ def import_appointments_payloads(
         patients_by_phone: dict[str, Any] = {}
         patients_by_name: dict[str, Any] = {}
 
-        for p in existing_patients:
-            if p.phone_e164:
-                patients_by_phone[p.phone_e164] = p
-            if p.normalized_name:
-                patients_by_name[p.normalized_name] = p
-
         appointments_by_phone_key: dict[tuple[str, str, str], Any] = {}
         appointments_by_name_key: dict[tuple[str, str, str], Any] = {}
         incomplete_appointments_by_phone: dict[str, list[Any]] = {}
         incomplete_appointments_by_name: dict[str, list[Any]] = {}
 
-        for a in existing_appointments:
-            if a.phone_e164 and a.appointment_date and a.appointment_time:
-                appointments_by_phone_key[
-                    (a.phone_e164, a.appointment_date.isoformat(), a.appointment_time)
-                ] = a
-
-            if a.normalized_name and a.appointment_date and a.appointment_time:
-                appointments_by_name_key[
-                    (a.normalized_name, a.appointment_date.isoformat(), a.appointment_time)
-                ] = a
+        def _index_existing(patients: list[Any], appointments: list[Any]) -> None:
+            for p in patients:
+                if p.phone_e164:
+                    patients_by_phone[p.phone_e164] = p
+                if p.normalized_name:
+                    patients_by_name[p.normalized_name] = p
+                patient_index.add(p, normalized_name=p.normalized_name, phone_e164=p.phone_e164)
 
-            if a.phone_e164 and (a.appointment_date is None or a.appointment_time is None):
-                incomplete_appointments_by_phone.setdefault(a.phone_e164, []).append(a)
+            for a in appointments:
+                if a.phone_e164 and a.appointment_date and a.appointment_time:
+                    appointments_by_phone_key[
+                        (a.phone_e164, a.appointment_date.isoformat(), a.appointment_time)
+                    ] = a
 
-            if a.normalized_name and (a.appointment_date is None or a.appointment_time is None):
-                incomplete_appointments_by_name.setdefault(a.normalized_name, []).append(a)
+                if a.normalized_name and a.appointment_date and a.appointment_time:
+                    appointments_by_name_key[
+                        (a.normalized_name, a.appointment_date.isoformat(), a.appointment_time)
+                    ] = a
+
+                if a.phone_e164 and (a.appointment_date is None or a.appointment_time is None):
+                    bucket = incomplete_appointments_by_phone.setdefault(a.phone_e164, [])
+                    if a not in bucket:
+                        bucket.append(a)
+
+                if a.normalized_name and (a.appointment_date is None or a.appointment_time is None):
+                    bucket = incomplete_appointments_by_name.setdefault(a.normalized_name, [])
+                    if a not in bucket:
+                        bucket.append(a)
+
+        _index_existing(existing_patients, existing_appointments)
+
+        loaded_phones: set[str] = set(preload_phones or set())
+        loaded_names: set[str] = set(preload_names or set())
+
+        row_context: dict[str, Any] = {"date_format": None}
+
+        def _rows(file_payload: dict[str, Any]):
+            """
+            Filas del archivo. En archivos en streaming se precargan, chunk a
+            chunk, los pacientes/citas de las claves que aún no estaban en memoria.
+            """
+            row_context["date_format"] = None
+
+            for chunk_no, chunk in enumerate(_iter_appointment_chunks(file_payload)):
+                summary["rows_extracted"] += len(chunk)
+
+                if chunk_no == 0:
+                    # formato de fecha detectado una vez por archivo, no por celda
+                    row_context["date_format"] = sniff_date_format(r.get("date") for r in chunk)
+
+                if "appointment_chunks" in file_payload:
+                    chunk_phones, chunk_names = _chunk_keys(chunk)
+                    new_phones = chunk_phones - loaded_phones
+                    new_names = chunk_names - loaded_names
+
+                    if new_phones or new_names:
+                        if not dry_run:
+                            db.flush()
+                        _index_existing(
+                            _load_patients(new_phones, new_names),
+                            load_appointments_for_job_matching(
+                                db, job_id=job_id, phones=new_phones, names=new_names
+                            ),
+                        )
+                        loaded_phones.update(new_phones)
+                        loaded_names.update(new_names)
+
+                yield from chunk
 
         existing_rr_keys: set[tuple[str, str]] = set()
         for rr in existing_rrs:
@@ -148,29 +354,48 @@ def import_appointments_payloads(
 
         pending_rr_keys = set(existing_rr_keys)
 
-        for file_payload in files_payload:
-            file_row = create_import_file(
-                db,
-                batch_id=batch.id,
-                original_filename=file_payload["original_filename"],
-                mime_type=file_payload.get("mime_type"),
-                file_hash=file_payload["file_hash"],
-                storage_provider=file_payload.get("storage_provider"),
-                storage_bucket=file_payload.get("storage_bucket"),
-                storage_key=file_payload.get("storage_key"),
-                storage_url=file_payload.get("storage_url"),
-                size_bytes=file_payload.get("size_bytes"),
-            )
+        rows_processed = 0
 
-            appointments = file_payload.get("appointments") or []
-            summary["rows_extracted"] += len(appointments)
+        for files_done, file_payload in enumerate(files_payload):
+            _write_progress(
+                batch,
+                stage="importing",
+                files_total=len(files_payload),
+                files_done=files_done,
+                rows_processed=rows_processed,
+                summary=summary,
+            )
 
-            for idx, raw in enumerate(appointments, start=1):
+            file_row_id = None
+            if not dry_run:
+                file_row_id = create_import_file(
+                    db,
+                    batch_id=batch.id,
+                    original_filename=file_payload["original_filename"],
+                    mime_type=file_payload.get("mime_type"),
+                    file_hash=file_payload["file_hash"],
+                    storage_provider=file_payload.get("storage_provider"),
+                    storage_bucket=file_payload.get("storage_bucket"),
+                    storage_key=file_payload.get("storage_key"),
+                    storage_url=file_payload.get("storage_url"),
+                    size_bytes=file_payload.get("size_bytes"),
+                ).id
+
+            for idx, raw in enumerate(_rows(file_payload), start=1):
+                rows_processed += 1
                 if idx % CHUNK_FLUSH_EVERY == 0:
-                    print(f"⏳ procesadas {idx}/{len(appointments)} filas")
-                    db.flush()
-                    db.commit()
-
+                    print(f"⏳ procesadas {idx}/{summary['rows_extracted']} filas")
+                    _write_progress(
+                        batch,
+                        stage="importing",
+                        files_total=len(files_payload),
+                        files_done=files_done,
+                        rows_processed=rows_processed,
+                        summary=summary,
+                    )
+                    _flush_pending()
+                    if not dry_run:
+                        db.commit()
 
                 raw_name = raw.get("name")
                 raw_phone = raw.get("phone")
@@ -183,69 +408,68 @@ def import_appointments_payloads(
                 display_name = (raw_name or "").strip() or None
                 normalized_name = normalize_name(raw_name)
                 phone_e164 = normalize_phone(raw_phone)
-                date_str = normalize_date_str(raw_date)
+                date_str = normalize_date_str(raw_date, row_context["date_format"])
                 time_str = normalize_time_str(raw_time)
                 appointment_at = build_appointment_at(date_str, time_str, timezone_str)
 
                 patient = None
-                patient_state = None
 
                 if phone_e164:
                     patient = patients_by_phone.get(phone_e164)
                 if not patient and normalized_name:
                     patient = patients_by_name.get(normalized_name)
 
+                name_match_score = None
+                if not patient and normalized_name:
+                    candidate, score = patient_index.match(normalized_name, phone_e164=phone_e164)
+                    if candidate is not None:
+                        patient = candidate
+                        name_match_score = round(score, 3)
+                        # la fila adopta la identidad del paciente encontrado
+                        normalized_name = patient.normalized_name or normalized_name
+
                 if not patient and (normalized_name or phone_e164):
-                    patient, patient_state = upsert_patient(
-                        db,
+                    patient = new_patient(
                         job_id=job_id,
                         display_name=display_name,
                         normalized_name=normalized_name,
                         phone_e164=phone_e164,
                     )
-                    if patient_state == "created":
-                        summary["patients_created"] += 1
-                    elif patient_state == "updated":
-                        summary["patients_updated"] += 1
-
-                    if patient:
-                        if patient.phone_e164:
-                            patients_by_phone[patient.phone_e164] = patient
-                        if patient.normalized_name:
-                            patients_by_name[patient.normalized_name] = patient
+                    pending_patients.append(patient)
+                    summary["patients_created"] += 1
 
                 elif patient:
-                    patient, patient_state = upsert_patient(
-                        db,
-                        job_id=job_id,
+                    merge_patient_fields(
+                        patient,
                         display_name=display_name,
                         normalized_name=normalized_name,
                         phone_e164=phone_e164,
                     )
-                    if patient_state == "updated":
-                        summary["patients_updated"] += 1
-
-                    if patient:
-                        if patient.phone_e164:
-                            patients_by_phone[patient.phone_e164] = patient
-                        if patient.normalized_name:
-                            patients_by_name[patient.normalized_name] = patient
+                    summary["patients_updated"] += 1
 
                 if patient:
-                    add_patient_source(
-                        db,
-                        patient_id=patient.id,
-                        import_file_id=file_row.id,
-                        raw_name=raw_name,
-                        raw_phone=raw_phone,
-                        confidence=confidence,
+                    if patient.phone_e164:
+                        patients_by_phone[patient.phone_e164] = patient
+                    if patient.normalized_name:
+                        patients_by_name[patient.normalized_name] = patient
+                    patient_index.add(
+                        patient,
+                        normalized_name=patient.normalized_name,
+                        phone_e164=patient.phone_e164,
                     )
 
+                    pending_patient_sources.append((patient, {
+                        "import_file_id": file_row_id,
+                        "raw_name": raw_name,
+                        "raw_phone": raw_phone,
+                        "confidence": confidence,
+                    }))
+
                 if not date_str and not time_str:
                     summary["patient_only_saved"] += 1
                     patient_item = {
                         "kind": "patient",
-                        "patient_id": patient.id if patient else None,
+                        "patient_id": None,
                         "appointment_id": None,
                         "review_request_id": None,
                         "customer_name": patient.display_name if patient else display_name,
@@ -258,6 +482,7 @@ def import_appointments_payloads(
                     }
                     if len(items) < MAX_RESPONSE_ITEMS:
                         items.append(patient_item)
+                        pending_item_ids.append((patient_item, patient, None))
                     else:
                         items_truncated = True
                     continue
@@ -300,6 +525,10 @@ def import_appointments_payloads(
 
                 too_old = is_older_than_24h(appointment_at)
 
+                # si el paciente se resolvió por nombre aproximado, la confianza
+                # de la fusión es el score de esa coincidencia
+                merge_confidence = name_match_score if name_match_score is not None else confidence
+
                 duplicate_exists = False
                 if not final_missing and final_phone and appointment_at:
                     rr_key = (final_phone, appointment_at.isoformat())
@@ -313,8 +542,7 @@ def import_appointments_payloads(
                 )
 
                 if appointment is None:
-                    appointment = create_appointment(
-                        db,
+                    appointment = new_appointment(
                         job_id=job_id,
                         patient_id=patient.id if patient else None,
                         display_name=final_display_name,
@@ -326,11 +554,12 @@ def import_appointments_payloads(
                         timezone=timezone_str,
                         missing_fields=final_missing,
                         issues=raw_issues,
-                        merge_confidence=confidence,
+                        merge_confidence=merge_confidence,
                         status=status,
                         is_duplicate=duplicate_exists,
                         is_too_old=too_old,
                     )
+                    pending_appointments.append(appointment)
                     summary["appointments_created"] += 1
                 else:
                     appointment = update_appointment(
@@ -346,7 +575,7 @@ def import_appointments_payloads(
                         timezone=timezone_str,
                         missing_fields=final_missing,
                         issues=raw_issues,
-                        merge_confidence=confidence,
+                        merge_confidence=merge_confidence,
                         status=status,
                         is_duplicate=duplicate_exists,
                         is_too_old=too_old,
@@ -373,16 +602,18 @@ def import_appointments_payloads(
                     if appointment not in lst:
                         lst.append(appointment)
 
-                add_appointment_source(
-                    db,
-                    appointment_id=appointment.id,
-                    import_file_id=file_row.id,
-                    raw_name=raw_name,
-                    raw_phone=raw_phone,
-                    raw_date=str(raw_date) if raw_date is not None else None,
-                    raw_time=str(raw_time) if raw_time is not None else None,
-                    confidence=confidence,
-                )
+                if patient is not None and appointment.patient_id is None:
+                    # paciente nuevo: su id se asigna al volcar el bloque
+                    pending_appointment_patients.append((appointment, patient))
+
+                pending_appointment_sources.append((appointment, {
+                    "import_file_id": file_row_id,
+                    "raw_name": raw_name,
+                    "raw_phone": raw_phone,
+                    "raw_date": str(raw_date) if raw_date is not None else None,
+                    "raw_time": str(raw_time) if raw_time is not None else None,
+                    "confidence": confidence,
+                }))
 
                 if (
                     appointment.status == "ready"
@@ -392,7 +623,7 @@ def import_appointments_payloads(
                 ):
                     key = (appointment.phone_e164, appointment.appointment_at.isoformat())
                     if key not in pending_rr_keys:
-                        ready_appointment_ids.append(appointment.id)
+                        ready_appointments.append(appointment)
                         pending_rr_keys.add(key)
 
                 if appointment.status == "incomplete":
@@ -406,8 +637,8 @@ def import_appointments_payloads(
 
                 appointment_item = {
                     "kind": "appointment",
-                    "patient_id": appointment.patient_id,
-                    "appointment_id": appointment.id,
+                    "patient_id": None,
+                    "appointment_id": None,
                     "review_request_id": appointment.review_request_id,
                     "customer_name": appointment.display_name,
                     "phone_e164": appointment.phone_e164,
@@ -420,14 +651,17 @@ def import_appointments_payloads(
 
                 if len(items) < MAX_RESPONSE_ITEMS:
                     items.append(appointment_item)
-                    item_index_by_appointment_id[appointment.id] = len(items) - 1
+                    pending_item_ids.append((appointment_item, patient, appointment))
+                    item_index_by_appointment[appointment] = len(items) - 1
                 else:
                     items_truncated = True
 
+            _flush_pending()
+
         manual_review_required = False
         manual_review_reason = None
 
-        ready_candidates = len(ready_appointment_ids)
+        ready_candidates = len(ready_appointments)
 
         if summary["rows_extracted"] == 0:
             manual_review_required = True
@@ -443,48 +677,82 @@ def import_appointments_payloads(
             manual_review_required = True
             manual_review_reason = "Más del 50% de los registros están incompletos y no hay ninguna cita programable"
 
-        if not manual_review_required:
-            for appointment_id in ready_appointment_ids:
-                appointment = db.get(ReviewAppointment, appointment_id)
-                if not appointment:
+        if not manual_review_required and dry_run:
+            # vista previa: se contaría como programada cada cita lista
+            for appointment in ready_appointments:
+                summary["scheduled_now"] += 1
+                idx = item_index_by_appointment.get(appointment)
+                if idx is not None:
+                    items[idx]["status"] = "scheduled"
+
+        elif not manual_review_required:
+            to_schedule = [
+                a for a in ready_appointments
+                if a.status == "ready"
+                and a.review_request_id is None
+                and a.phone_e164
+                and a.appointment_at
+            ]
+
+            # una sola transacción: ajustes + envíos previos + INSERT masivo
+            rr_ids = review_repo.bulk_create_review_requests(
+                db,
+                job_id=job_id,
+                rows=[
+                    {
+                        "customer_name": a.display_name or "Paciente",
+                        "phone_e164": a.phone_e164,
+                        "appointment_at": a.appointment_at,
+                        "send_at": compute_send_at(a.appointment_at),
+                    }
+                    for a in to_schedule
+                ],
+            )
+
+            for appointment, rr_id in zip(to_schedule, rr_ids):
+                if rr_id is None:
                     continue
 
-                if (
-                    appointment.status == "ready"
-                    and appointment.review_request_id is None
-                    and appointment.phone_e164
-                    and appointment.appointment_at
-                ):
-                    rr = review_repo.create_review_request(
-                        db,
-                        job_id=job_id,
-                        customer_name=appointment.display_name or "Paciente",
-                        phone_e164=appointment.phone_e164,
-                        appointment_at=appointment.appointment_at,
-                        send_at=compute_send_at(appointment.appointment_at),
-                    )
-                    attach_review_request_to_appointment(
-                        db,
-                        appointment=appointment,
-                        review_request_id=rr.id,
-                    )
-                    summary["scheduled_now"] += 1
+                attach_review_request_to_appointment(
+                    db,
+                    appointment=appointment,
+                    review_request_id=rr_id,
+                )
+                summary["scheduled_now"] += 1
 
-                    idx = item_index_by_appointment_id.get(appointment.id)
-                    if idx is not None:
-                        items[idx]["status"] = "scheduled"
-                        items[idx]["review_request_id"] = rr.id
+                idx = item_index_by_appointment.get(appointment)
+                if idx is not None:
+                    items[idx]["status"] = "scheduled"
+                    items[idx]["review_request_id"] = rr_id
 
-        mark_import_batch_completed(
-            db,
-            batch_id=batch.id,
-            manual_review_required=manual_review_required,
-            manual_review_reason=manual_review_reason,
-        )
-        db.commit()
+        if dry_run:
+            # nada se ha volcado: el rollback descarta los cambios en memoria
+            db.rollback()
+        else:
+            completed = mark_import_batch_completed(
+                db,
+                batch_id=batch.id,
+                manual_review_required=manual_review_required,
+                manual_review_reason=manual_review_reason,
+            )
+            if not completed:
+                raise RuntimeError("El lote se marcó como fallido durante la importación")
+            _write_progress(
+                batch,
+                stage="completed",
+                files_total=len(files_payload),
+                files_done=len(files_payload),
+                rows_processed=rows_processed,
+                summary=summary,
+            )
+            db.commit()
+            remember_job_patients(
+                job_id,
+                [(pid, name, phone) for pid, (name, phone) in touched_identities.items()],
+            )
 
-        print("✅ import completado", {
-            "batch_id": batch.id,
+        print("✅ vista previa completada" if dry_run else "✅ import completado", {
+            "batch_id": batch.id or 0,
             "rows_extracted": summary["rows_extracted"],
             "scheduled_now": summary["scheduled_now"],
             "manual_review_required": manual_review_required,
@@ -493,7 +761,8 @@ def import_appointments_payloads(
         })
 
         return {
-            "batch_id": batch.id,
+            "batch_id": batch.id or 0,
+            "dry_run": dry_run,
             "summary": summary,
             "items": items,
             "items_truncated": items_truncated,
@@ -508,10 +777,70 @@ def import_appointments_payloads(
         except Exception:
             pass
 
+        if dry_run:
+            raise
+
         try:
             mark_import_batch_failed(db, batch_id=batch.id, error_message=str(e))
+            # se conserva el último progreso confirmado
+            batch.progress_json = {**(batch.progress_json or {}), "stage": "failed"}
             db.commit()
         except Exception:
             pass
 
-        raise
\ No newline at end of file
+        raise
+
+    finally:
+        if dry_run:
+            db.autoflush = previous_autoflush
+
+
+def _empty_summary(*, files_received: int, duplicate_files: int) -> dict[str, Any]:
+    return {
+        "files_received": files_received,
+        "rows_extracted": 0,
+        "patients_created": 0,
+        "patients_updated": 0,
+        "appointments_created": 0,
+        "appointments_updated": 0,
+        "patient_only_saved": 0,
+        "scheduled_now": 0,
+        "incomplete": 0,
+        "duplicates": 0,
+        "too_old": 0,
+        "conflicts": 0,
+        "duplicate_files": duplicate_files,
+    }
+
+
+def duplicate_files_result(*, batch_id: int, files_received: int) -> dict[str, Any]:
+    """
+    Respuesta cuando todos los archivos subidos ya se importaron antes
+    (mismo sha256): no se crea lote ni se toca S3/OpenAI.
+    """
+    return {
+        "batch_id": batch_id,
+        "summary": _empty_summary(files_received=files_received, duplicate_files=files_received),
+        "items": [],
+        "items_truncated": False,
+        "manual_review_required": False,
+        "manual_review_reason": None,
+        "user_message": DUPLICATE_FILES_USER_MESSAGE,
+    }
+
+
+def processing_result(*, batch_id: int, files_received: int, duplicate_files: int) -> dict[str, Any]:
+    """
+    Respuesta inmediata de una importación en segundo plano: el lote queda
+    en "processing" y el progreso se consulta por su endpoint de estado.
+    """
+    return {
+        "batch_id": batch_id,
+        "status": "processing",
+        "summary": _empty_summary(files_received=files_received, duplicate_files=duplicate_files),
+        "items": [],
+        "items_truncated": False,
+        "manual_review_required": False,
+        "manual_review_reason": None,
+        "user_message": None,
+    }
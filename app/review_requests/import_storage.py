@@ -0,0 +1,218 @@
+"""
+Archivado de los archivos originales de importación (write-behind).
+
+La subida a S3 no bloquea la importación: se encola en un pool de hilos
+(multipart para archivos grandes, con reintentos) y, cuando termina, se
+guarda el storage_key en review_import_files. Con STORAGE_BACKEND=local
+los archivos se copian a disco (sustituto de S3 para desarrollo/tests).
+"""
+
+from __future__ import annotations
+
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Optional
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.client import Config
+
+from app.db import SessionLocal
+from .import_repo import update_import_file_storage
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3").lower()
+STORAGE_BUCKET = os.getenv("REVIEW_IMPORTS_BUCKET")
+STORAGE_REGION = os.getenv("AWS_REGION", "us-east-1")
+STORAGE_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+STORAGE_LOCAL_DIR = os.getenv("STORAGE_LOCAL_DIR", "./data/review_imports")
+
+STORAGE_UPLOAD_WORKERS = int(os.getenv("STORAGE_UPLOAD_WORKERS", "4"))
+STORAGE_UPLOAD_RETRIES = int(os.getenv("STORAGE_UPLOAD_RETRIES", "3"))
+
+_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+)
+
+_upload_executor = ThreadPoolExecutor(
+    max_workers=STORAGE_UPLOAD_WORKERS,
+    thread_name_prefix="import-storage",
+)
+
+
+@lru_cache(maxsize=1)
+def get_s3_client():
+    if not STORAGE_BUCKET or not AWS_ACCESS_KEY_ID or not AWS_SECRET_ACCESS_KEY or not STORAGE_ENDPOINT_URL:
+        raise RuntimeError(
+            "Storage no configurado: faltan REVIEW_IMPORTS_BUCKET / AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY / S3_ENDPOINT_URL"
+        )
+
+    # un único cliente por proceso (los clientes de botocore son thread-safe);
+    # sesión propia porque la sesión por defecto no lo es
+    return boto3.session.Session().client(
+        "s3",
+        endpoint_url=STORAGE_ENDPOINT_URL,
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        region_name=STORAGE_REGION,
+        config=Config(
+            signature_version="s3v4",
+            retries={"max_attempts": 5, "mode": "standard"},
+        ),
+    )
+
+
+def _safe_filename(filename: str) -> str:
+    name = os.path.basename(filename or "upload")
+    name = re.sub(r"[^A-Za-z0-9._-]+", "_", name)
+    return name[:180] or "upload"
+
+
+def _storage_key(*, job_id: int, filename: str, file_hash: str) -> str:
+    now = datetime.now(timezone.utc)
+    return (
+        f"review-imports/job_{job_id}/"
+        f"{now.strftime('%Y/%m/%d/%H%M%S')}_{file_hash[:12]}_{_safe_filename(filename)}"
+    )
+
+
+def _storage_location() -> tuple[str, Optional[str]]:
+    if STORAGE_BACKEND == "local":
+        return "local", STORAGE_BUCKET or "review-imports"
+    return "supabase_s3", STORAGE_BUCKET
+
+
+def _private_copy(file_path: str) -> str:
+    """
+    Copia propia del temporal para el uploader (hardlink si se puede): la
+    importación puede borrar el original antes de que termine la subida.
+    """
+    fd, copy_path = tempfile.mkstemp(suffix=os.path.splitext(file_path)[1])
+    os.close(fd)
+    os.unlink(copy_path)
+    try:
+        os.link(file_path, copy_path)
+    except OSError:
+        shutil.copyfile(file_path, copy_path)
+    return copy_path
+
+
+def _upload(*, file_path: str, key: str, content_type: str) -> None:
+    provider, bucket = _storage_location()
+
+    if provider == "local":
+        dest = os.path.join(STORAGE_LOCAL_DIR, bucket, key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(file_path, dest)
+        return
+
+    get_s3_client().upload_file(
+        file_path,
+        bucket,
+        key,
+        ExtraArgs={"ContentType": content_type},
+        Config=_TRANSFER_CONFIG,
+    )
+
+
+def _upload_with_retries(*, file_path: str, key: str, content_type: str) -> str:
+    try:
+        for attempt in range(1, STORAGE_UPLOAD_RETRIES + 1):
+            try:
+                _upload(file_path=file_path, key=key, content_type=content_type)
+                return key
+            except Exception as e:
+                if attempt == STORAGE_UPLOAD_RETRIES:
+                    raise
+                print(f"⚠️ subida de {key} falló (intento {attempt}):", repr(e))
+                time.sleep(2 ** attempt)
+    finally:
+        try:
+            os.unlink(file_path)
+        except Exception:
+            pass
+
+
+def enqueue_original_upload(
+    *,
+    job_id: int,
+    filename: str,
+    file_path: str,
+    content_type: Optional[str],
+    file_hash: str,
+) -> dict[str, Any]:
+    """
+    Encola la subida del original y devuelve enseguida los datos de storage.
+    storage_key queda a None hasta que la subida termine (ver
+    persist_storage_keys_when_done); "storage_upload" es el Future.
+    """
+    if STORAGE_BACKEND != "local":
+        # error de configuración: mejor fallar ya que en segundo plano
+        get_s3_client()
+
+    provider, bucket = _storage_location()
+    key = _storage_key(job_id=job_id, filename=filename, file_hash=file_hash)
+    guessed_type = (
+        content_type
+        or mimetypes.guess_type(_safe_filename(filename))[0]
+        or "application/octet-stream"
+    )
+
+    future = _upload_executor.submit(
+        _upload_with_retries,
+        file_path=_private_copy(file_path),
+        key=key,
+        content_type=guessed_type,
+    )
+
+    return {
+        "storage_provider": provider,
+        "storage_bucket": bucket,
+        "storage_key": None,
+        "storage_url": None,
+        "size_bytes": os.path.getsize(file_path),
+        "storage_upload": future,
+    }
+
+
+def _persist_storage_key(batch_id: int, file_hash: str, future: Future) -> None:
+    try:
+        key = future.result()
+    except Exception as e:
+        print(f"❌ original no archivado (batch={batch_id}, {file_hash[:12]}):", repr(e))
+        return
+
+    db = SessionLocal()
+    try:
+        update_import_file_storage(db, batch_id=batch_id, file_hash=file_hash, storage_key=key)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"⚠️ no se pudo guardar storage_key (batch={batch_id}):", repr(e))
+    finally:
+        db.close()
+
+
+def persist_storage_keys_when_done(*, batch_id: int, files_payload: list[dict[str, Any]]) -> None:
+    """
+    Cuando cada subida termine, guarda su storage_key en la fila del archivo
+    (si ya terminó, se guarda ahora mismo).
+    """
+    for fp in files_payload:
+        future = fp.get("storage_upload")
+        if future is None:
+            continue
+        file_hash = fp["file_hash"]
+        future.add_done_callback(
+            lambda fut, file_hash=file_hash: _persist_storage_key(batch_id, file_hash, fut)
+        )
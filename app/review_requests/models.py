@@ -17,6 +17,7 @@ from app.db import Base
 
 class ReviewRequestStatus(str, enum.Enum):
     scheduled = "scheduled"
+    sending = "sending"
     sent = "sent"
     cancelled = "cancelled"
     failed = "failed"
@@ -49,6 +50,14 @@ class ReviewRequest(Base):
     )
 
     sent_at = Column(DateTime(timezone=True), nullable=True)
+    # reclamada por un worker (status=sending) hasta esta fecha
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    # clave de idempotencia del envío (se fija al reclamar y no cambia)
+    send_key = Column(String(64), nullable=True)
+    # justo antes de la llamada HTTP: con lease caducado, distingue "no se
+    # llegó a enviar" (se reprograma) de "puede haberse enviado" (IN_DOUBT)
+    dispatched_at = Column(DateTime(timezone=True), nullable=True)
+    send_provider = Column(String(32), nullable=True)
     cancelled_at = Column(DateTime(timezone=True), nullable=True)
     error_message = Column(Text, nullable=True)
 
@@ -0,0 +1,203 @@
+"""
+Índice de identidad de pacientes por job para el matching aproximado por nombre.
+
+"Mª José García", "Maria Jose Garcia" y "García, María José" acaban con la
+misma clave (tokens canónicos ordenados). Para variantes con erratas se usa
+bloqueo por trigramas (índice invertido) y solo se compara contra los pocos
+candidatos que comparten más trigramas, así cada búsqueda es sub-milisegundo
+aunque el job tenga decenas de miles de pacientes.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from difflib import SequenceMatcher
+from typing import Any, Callable, Iterable, Optional
+
+IMPORT_NAME_MERGE_THRESHOLD = float(os.getenv("IMPORT_NAME_MERGE_THRESHOLD", "0.9"))
+
+# índice de identidades (id, nombre, teléfono) por job reutilizado entre
+# importaciones; lo creado por otra réplica entra al caducar
+JOB_INDEX_TTL_SECONDS = int(os.getenv("IMPORT_PATIENT_INDEX_TTL_SECONDS", "600"))
+
+# abreviaturas habituales en agendas (ya sin acentos: "mª" -> "ma")
+NAME_TOKEN_ALIASES = {
+    "ma": "maria",
+    "mari": "maria",
+    "fco": "francisco",
+    "fdo": "fernando",
+    "jm": "jose maria",
+    "mj": "maria jose",
+}
+
+# partículas que no aportan a la identidad
+NAME_STOPWORDS = {"de", "del", "la", "las", "los", "y", "i"}
+
+MAX_CANDIDATES = 8
+# trigramas demasiado frecuentes ("ari", "nez"...) no sirven para bloquear
+MAX_POSTING_SIZE = 5000
+
+
+def name_key(normalized_name: Optional[str]) -> Optional[str]:
+    """Clave canónica: tokens expandidos, sin partículas y ordenados."""
+    if not normalized_name:
+        return None
+
+    tokens: list[str] = []
+    for tok in normalized_name.split():
+        tokens.extend(NAME_TOKEN_ALIASES.get(tok, tok).split())
+
+    tokens = sorted(t for t in tokens if t not in NAME_STOPWORDS)
+    return " ".join(tokens) or None
+
+
+def _trigrams(key: str) -> set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class PatientIndex:
+    """
+    Guarda (clave de nombre -> paciente) y resuelve coincidencias
+    aproximadas. Nunca devuelve un paciente con un teléfono distinto.
+    """
+
+    def __init__(self, threshold: float = IMPORT_NAME_MERGE_THRESHOLD) -> None:
+        self.threshold = threshold
+        self._by_key: dict[str, list[tuple[Any, Optional[str]]]] = {}
+        self._postings: dict[str, set[str]] = {}
+
+    def add(self, patient: Any, *, normalized_name: Optional[str], phone_e164: Optional[str]) -> None:
+        key = name_key(normalized_name)
+        if not key:
+            return
+
+        entries = self._by_key.setdefault(key, [])
+        for i, (existing, _) in enumerate(entries):
+            if existing is patient or existing == patient:
+                entries[i] = (patient, phone_e164)
+                return
+        entries.append((patient, phone_e164))
+
+        if len(entries) == 1:
+            for tg in _trigrams(key):
+                self._postings.setdefault(tg, set()).add(key)
+
+    def _compatible(self, key: str, phone_e164: Optional[str]) -> Optional[Any]:
+        for patient, patient_phone in self._by_key.get(key, []):
+            if not phone_e164 or not patient_phone or patient_phone == phone_e164:
+                return patient
+        return None
+
+    def match(
+        self,
+        normalized_name: Optional[str],
+        *,
+        phone_e164: Optional[str] = None,
+    ) -> tuple[Optional[Any], float]:
+        """
+        Devuelve (paciente, score) del mejor candidato por encima del
+        umbral, o (None, 0.0). Solo nombres de 2+ tokens: un nombre de pila
+        suelto no basta para fusionar pacientes.
+        """
+        key = name_key(normalized_name)
+        if not key or " " not in key:
+            return None, 0.0
+
+        exact = self._compatible(key, phone_e164)
+        if exact is not None:
+            return exact, 1.0
+
+        if self.threshold >= 1.0:
+            return None, 0.0
+
+        best: tuple[Optional[Any], float] = (None, 0.0)
+        for candidate, score in self._similar_keys(key):
+            if score <= best[1]:
+                continue
+            patient = self._compatible(candidate, phone_e164)
+            if patient is not None:
+                best = (patient, score)
+
+        return best
+
+    def candidates(self, normalized_name: Optional[str]) -> list[Any]:
+        """
+        Todos los pacientes que match() podría devolver para este nombre,
+        sea cual sea el teléfono (para precargarlos antes del matching real).
+        """
+        key = name_key(normalized_name)
+        if not key or " " not in key:
+            return []
+
+        keys = [key] if key in self._by_key else []
+        if self.threshold < 1.0:
+            keys.extend(candidate for candidate, _ in self._similar_keys(key) if candidate != key)
+
+        return [patient for k in keys for patient, _ in self._by_key.get(k, [])]
+
+    def _similar_keys(self, key: str) -> list[tuple[str, float]]:
+        """Claves por encima del umbral entre las que más trigramas comparten."""
+        grams = _trigrams(key)
+        shared: dict[str, int] = {}
+        for tg in grams:
+            posting = self._postings.get(tg)
+            if not posting or len(posting) > MAX_POSTING_SIZE:
+                continue
+            for candidate in posting:
+                shared[candidate] = shared.get(candidate, 0) + 1
+
+        top = sorted(shared.items(), key=lambda kv: kv[1], reverse=True)[:MAX_CANDIDATES]
+        scored = []
+        for candidate, _ in top:
+            score = SequenceMatcher(None, key, candidate).ratio()
+            if score >= self.threshold:
+                scored.append((candidate, score))
+        return scored
+
+
+_job_indexes: dict[int, tuple[float, PatientIndex]] = {}
+_job_indexes_lock = threading.Lock()
+
+
+def fuzzy_candidate_ids(
+    job_id: int,
+    names: Iterable[str],
+    *,
+    load_identities: Callable[[], Iterable[tuple[int, Optional[str], Optional[str]]]],
+) -> set[int]:
+    """
+    ids de pacientes del job cuyo nombre coincide aproximadamente con alguno
+    de names. El índice de identidades del job se construye con
+    load_identities() una vez y se cachea JOB_INDEX_TTL_SECONDS.
+    """
+    now = time.monotonic()
+    with _job_indexes_lock:
+        cached = _job_indexes.get(job_id)
+        if cached is None or cached[0] <= now:
+            index = PatientIndex()
+            for pid, pname, pphone in load_identities():
+                index.add(pid, normalized_name=pname, phone_e164=pphone)
+            _job_indexes[job_id] = (now + JOB_INDEX_TTL_SECONDS, index)
+        else:
+            index = cached[1]
+
+        ids: set[int] = set()
+        for name in names:
+            ids.update(index.candidates(name))
+        return ids
+
+
+def remember_job_patients(
+    job_id: int,
+    identities: Iterable[tuple[int, Optional[str], Optional[str]]],
+) -> None:
+    """Tras confirmar una importación: añade sus pacientes al índice cacheado."""
+    with _job_indexes_lock:
+        cached = _job_indexes.get(job_id)
+        if cached is None:
+            return
+        for pid, pname, pphone in identities:
+            cached[1].add(pid, normalized_name=pname, phone_e164=pphone)
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+
+class AsyncTokenBucket:
+    """
+    Límite de envíos por segundo para corrutinas: `await acquire()` espera
+    hasta que haya un token; `try_acquire()` no espera. rate <= 0 desactiva
+    el límite.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def has_token(self) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill()
+        return self._tokens >= 1
+
+    def seconds_until_token(self) -> float:
+        if self.has_token():
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def try_acquire(self) -> bool:
+        if not self.has_token():
+            return False
+        if self.rate > 0:
+            self._tokens -= 1
+        return True
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+
+        async with self._lock:
+            while True:
+                self._refill()
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
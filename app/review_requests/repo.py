@@ -1,20 +1,31 @@
 from __future__ import annotations
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 import re
 import os
 import requests
 
 from sqlalchemy.orm import Session
-from sqlalchemy import select, and_, func
+from sqlalchemy import String, bindparam, cast, select, and_, func, update
 from sqlalchemy.exc import IntegrityError
 
 from .models import ReviewRequest, ReviewRequestStatus, BusinessSettings
 from .utils import utcnow
+from .wakeup import notify_review_requests_scheduled
 
 from app.models import ScrapeJob, Review
 
+BULK_INSERT_ROWS = 1000
+
+# tiempo que un worker tiene para enviar lo que reclama; si muere, otro lo
+# vuelve a reclamar al caducar
+SEND_LEASE_SECONDS = int(os.getenv("REVIEW_SENDER_LEASE_SECONDS", "300"))
+
+
+class ReviewUrlConfigError(RuntimeError):
+    """No hay datos para resolver la review URL: reintentar no lo arregla."""
+
 
 def find_existing_review_request(
     db: Session,
@@ -95,6 +106,7 @@ def create_review_request(
         status=ReviewRequestStatus.scheduled,
     )
     db.add(rr)
+    notify_review_requests_scheduled(db)
     try:
         db.commit()
     except IntegrityError:
@@ -113,6 +125,121 @@ def create_review_request(
     return rr
 
 
+def _rr_key_variants(phone_e164: str, appointment_at: datetime) -> list[tuple[str, datetime]]:
+    # Postgres devuelve datetimes con zona; SQLite, naive (hora local guardada)
+    if appointment_at.tzinfo is None:
+        return [(phone_e164, appointment_at)]
+    return [
+        (phone_e164, appointment_at.astimezone(timezone.utc).replace(tzinfo=None)),
+        (phone_e164, appointment_at.replace(tzinfo=None)),
+    ]
+
+
+def bulk_create_review_requests(
+    db: Session,
+    *,
+    job_id: int,
+    rows: list[dict],
+) -> list[Optional[int]]:
+    """
+    Versión masiva de create_review_request para las importaciones.
+
+    rows: dicts con customer_name, phone_e164, appointment_at, send_at.
+    Devuelve el id de la review request de cada fila (nueva o ya existente),
+    en el mismo orden. 1 lectura de ajustes + 1 consulta de envíos previos +
+    1 INSERT ... ON CONFLICT DO NOTHING RETURNING + 1 SELECT de conflictos.
+    No hace commit.
+    """
+    if not rows:
+        return []
+
+    phones = {r["phone_e164"] for r in rows}
+
+    bs = db.get(BusinessSettings, job_id)
+    prevent = bool(getattr(bs, "prevent_duplicate_whatsapp", False)) if bs else False
+
+    sent_phones: set[str] = set()
+    if prevent:
+        sent_phones = set(
+            db.execute(
+                select(ReviewRequest.phone_e164)
+                .where(
+                    and_(
+                        ReviewRequest.job_id == job_id,
+                        ReviewRequest.phone_e164.in_(phones),
+                        ReviewRequest.status == ReviewRequestStatus.sent,
+                    )
+                )
+                .distinct()
+            ).scalars().all()
+        )
+
+    now = utcnow()
+    values = []
+    for r in rows:
+        value = {
+            "job_id": job_id,
+            "customer_name": r["customer_name"],
+            "phone_e164": r["phone_e164"],
+            "appointment_at": r["appointment_at"],
+            "send_at": r["send_at"],
+            "status": ReviewRequestStatus.scheduled,
+            "cancelled_at": None,
+            "error_message": None,
+        }
+        if r["phone_e164"] in sent_phones:
+            value["status"] = ReviewRequestStatus.cancelled
+            value["cancelled_at"] = now
+            value["error_message"] = "ALREADY_SENT"
+        values.append(value)
+
+    if db.bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+
+    ids_by_key: dict[tuple[str, datetime], int] = {}
+
+    # por tramos, para no pasar el límite de parámetros por sentencia
+    for start in range(0, len(values), BULK_INSERT_ROWS):
+        stmt = (
+            dialect_insert(ReviewRequest)
+            .values(values[start:start + BULK_INSERT_ROWS])
+            .on_conflict_do_nothing(index_elements=["job_id", "phone_e164", "appointment_at"])
+            .returning(ReviewRequest.id, ReviewRequest.phone_e164, ReviewRequest.appointment_at)
+        )
+        for rr_id, phone, appointment_at in db.execute(stmt).all():
+            for key in _rr_key_variants(phone, appointment_at):
+                ids_by_key[key] = rr_id
+
+    def _lookup(r: dict) -> Optional[int]:
+        for key in _rr_key_variants(r["phone_e164"], r["appointment_at"]):
+            if key in ids_by_key:
+                return ids_by_key[key]
+        return None
+
+    if ids_by_key and any(v["status"] == ReviewRequestStatus.scheduled for v in values):
+        # se entrega con el commit de la importación
+        notify_review_requests_scheduled(db)
+
+    # las que chocaron con una review request ya existente
+    if any(_lookup(r) is None for r in rows):
+        existing = db.execute(
+            select(ReviewRequest.id, ReviewRequest.phone_e164, ReviewRequest.appointment_at)
+            .where(
+                and_(
+                    ReviewRequest.job_id == job_id,
+                    ReviewRequest.phone_e164.in_(phones),
+                )
+            )
+        ).all()
+        for rr_id, phone, appointment_at in existing:
+            for key in _rr_key_variants(phone, appointment_at):
+                ids_by_key.setdefault(key, rr_id)
+
+    return [_lookup(r) for r in rows]
+
+
 def already_sent_to_phone(db: Session, *, job_id: int, phone_e164: str) -> bool:
     stmt = (
         select(ReviewRequest.id)
@@ -167,19 +294,255 @@ def get_due_scheduled(db: Session, *, batch_size: int = 25) -> list[ReviewReques
     return list(db.execute(stmt).scalars().all())
 
 
-def mark_sent(db: Session, *, rr: ReviewRequest) -> None:
-    rr.status = ReviewRequestStatus.sent
-    rr.sent_at = utcnow()
-    rr.error_message = None
+def claim_due(
+    db: Session,
+    *,
+    batch_size: int = 25,
+    lease_seconds: int = SEND_LEASE_SECONDS,
+    exclude_job_ids: Optional[set[int]] = None,
+) -> tuple[Optional[datetime], list[ReviewRequest]]:
+    """
+    Reclama de forma atómica hasta batch_size envíos vencidos: pasan a
+    'sending' con lease y send_key (clave de idempotencia estable) y se hace
+    commit. Postgres: FOR UPDATE SKIP LOCKED, varios workers/cron no se pisan.
+    SQLite: el UPDATE ... RETURNING único ya es atómico (bloqueo de escritura).
+
+    Devuelve (lease_expires_at, filas). El lease es común a todo el lote y
+    sirve de "propietario" en mark_dispatched / release_claims /
+    record_send_outcomes. Las filas salen de la sesión (expunge): los commits
+    posteriores del lote no las caducan y se pueden leer desde hilos.
+
+    exclude_job_ids: jobs sin cupo en su límite por minuto (se quedan en
+    'scheduled' para la siguiente vuelta).
+
+    'sending' con lease caducado (el worker murió o se quedó colgado):
+    - sin dispatched_at (no se llegó a enviar): vuelven a 'scheduled';
+    - despachados (pueden haberse enviado; ni Twilio ni el gateway del número
+      propio garantizan deduplicar): failed IN_DOUBT, no se reenvían.
+    """
+    now = utcnow()
+
+    expired = and_(
+        ReviewRequest.status == ReviewRequestStatus.sending,
+        ReviewRequest.lease_expires_at < now,
+    )
+    db.execute(
+        update(ReviewRequest)
+        .where(and_(expired, ReviewRequest.dispatched_at.is_(None)))
+        .values(status=ReviewRequestStatus.scheduled, lease_expires_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.execute(
+        update(ReviewRequest)
+        .where(expired)
+        .values(
+            status=ReviewRequestStatus.failed,
+            lease_expires_at=None,
+            error_message="IN_DOUBT: lease caducado tras despachar el envío sin confirmarlo",
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+    conditions = [
+        ReviewRequest.status == ReviewRequestStatus.scheduled,
+        ReviewRequest.send_at <= now,
+    ]
+    if exclude_job_ids:
+        conditions.append(ReviewRequest.job_id.not_in(exclude_job_ids))
+
+    lease_expires_at = now + timedelta(seconds=lease_seconds)
+
+    candidates = (
+        select(ReviewRequest.id)
+        .where(and_(*conditions))
+        .order_by(ReviewRequest.send_at.asc())
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+
+    stmt = (
+        update(ReviewRequest)
+        .where(ReviewRequest.id.in_(candidates.scalar_subquery()))
+        .values(
+            status=ReviewRequestStatus.sending,
+            lease_expires_at=lease_expires_at,
+            dispatched_at=None,
+            send_provider=None,
+            send_key=func.coalesce(
+                ReviewRequest.send_key,
+                "review-request-" + cast(ReviewRequest.id, String),
+            ),
+        )
+        .returning(ReviewRequest.id)
+        .execution_options(synchronize_session=False)
+    )
+
+    ids = list(db.execute(stmt).scalars().all())
     db.commit()
 
+    if not ids:
+        return None, []
+
+    rows = list(
+        db.execute(
+            select(ReviewRequest)
+            .where(ReviewRequest.id.in_(ids))
+            .order_by(ReviewRequest.send_at.asc())
+        ).scalars().all()
+    )
+    for row in rows:
+        db.expunge(row)
+    return lease_expires_at, rows
+
 
-def mark_failed(db: Session, *, rr: ReviewRequest, error_message: str) -> None:
-    rr.status = ReviewRequestStatus.failed
-    rr.error_message = error_message[:4000]
+def mark_dispatched(
+    db: Session,
+    *,
+    request_id: int,
+    provider: str,
+    lease_expires_at: datetime,
+) -> bool:
+    """
+    Registra (con commit) que la fila se va a enviar ya. lease_expires_at es
+    el del reclamo: si no coincide, otra pasada la ha recuperado o
+    reclamado y no se debe enviar (devuelve False).
+    """
+    result = db.execute(
+        update(ReviewRequest)
+        .where(
+            and_(
+                ReviewRequest.id == request_id,
+                ReviewRequest.status == ReviewRequestStatus.sending,
+                ReviewRequest.lease_expires_at == lease_expires_at,
+            )
+        )
+        .values(dispatched_at=utcnow(), send_provider=provider)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return (result.rowcount or 0) > 0
+
+
+def release_claims(db: Session, *, ids: list[int], lease_expires_at: datetime) -> None:
+    """
+    Devuelve a 'scheduled' filas reclamadas (con este lease) que no se
+    llegaron a enviar.
+    """
+    if not ids:
+        return
+
+    db.execute(
+        update(ReviewRequest)
+        .where(
+            and_(
+                ReviewRequest.id.in_(ids),
+                ReviewRequest.status == ReviewRequestStatus.sending,
+                ReviewRequest.lease_expires_at == lease_expires_at,
+            )
+        )
+        .values(status=ReviewRequestStatus.scheduled, lease_expires_at=None)
+        .execution_options(synchronize_session=False)
+    )
     db.commit()
 
 
+def seconds_until_next_due(
+    db: Session,
+    *,
+    max_seconds: float,
+    exclude_job_ids: Optional[set[int]] = None,
+) -> float:
+    """
+    Segundos hasta el próximo envío programado o lease que caduca (acotado a
+    max_seconds): el worker duerme justo eso en vez de sondear a intervalo fijo.
+    exclude_job_ids: los mismos que se excluyeron en claim_due.
+    """
+    conditions = [ReviewRequest.status == ReviewRequestStatus.scheduled]
+    if exclude_job_ids:
+        conditions.append(ReviewRequest.job_id.not_in(exclude_job_ids))
+
+    next_send_at = db.execute(
+        select(func.min(ReviewRequest.send_at)).where(and_(*conditions))
+    ).scalar()
+    next_lease_at = db.execute(
+        select(func.min(ReviewRequest.lease_expires_at))
+        .where(ReviewRequest.status == ReviewRequestStatus.sending)
+    ).scalar()
+
+    now = utcnow()
+    wait = max_seconds
+    for at in (next_send_at, next_lease_at):
+        if at is None:
+            continue
+        if at.tzinfo is None:
+            at = at.replace(tzinfo=timezone.utc)
+        wait = min(wait, (at - now).total_seconds())
+
+    return max(0.0, wait)
+
+
+def record_send_outcomes(
+    db: Session,
+    *,
+    sent_ids: list[int],
+    failed: list[tuple[int, str]],
+    lease_expires_at: datetime,
+) -> None:
+    """
+    Guarda el resultado de un lote de envíos (executemany) con un único
+    commit. failed: (id, mensaje de error).
+
+    Un envío confirmado se guarda como 'sent' aunque el lease haya caducado
+    entretanto (fila vuelta a 'scheduled' o marcada IN_DOUBT). Los fallos solo
+    se guardan si la fila sigue reclamada por este lote (mismo lease).
+    """
+    now = utcnow()
+    table = ReviewRequest.__table__
+
+    if sent_ids:
+        db.execute(
+            update(table)
+            .where(
+                and_(
+                    table.c.id == bindparam("rr_id"),
+                    table.c.status.in_((
+                        ReviewRequestStatus.sending,
+                        ReviewRequestStatus.scheduled,
+                        ReviewRequestStatus.failed,
+                    )),
+                )
+            )
+            .values(
+                status=ReviewRequestStatus.sent,
+                sent_at=now,
+                error_message=None,
+                lease_expires_at=None,
+            ),
+            [{"rr_id": rr_id} for rr_id in sent_ids],
+        )
+
+    if failed:
+        db.execute(
+            update(table)
+            .where(
+                and_(
+                    table.c.id == bindparam("rr_id"),
+                    table.c.status == ReviewRequestStatus.sending,
+                    table.c.lease_expires_at == lease_expires_at,
+                )
+            )
+            .values(
+                status=ReviewRequestStatus.failed,
+                error_message=bindparam("new_error"),
+                lease_expires_at=None,
+            ),
+            [{"rr_id": rr_id, "new_error": error[:4000]} for rr_id, error in failed],
+        )
+
+    if sent_ids or failed:
+        db.commit()
+
+
 def get_business_settings(db: Session, *, job_id: int) -> Optional[BusinessSettings]:
     return db.get(BusinessSettings, job_id)
 
@@ -338,8 +701,13 @@ def resolve_place_id_via_places_api(query: str) -> str | None:
         },
         timeout=15,
     )
+    r.raise_for_status()
     data = r.json() if r.content else {}
-    if data.get("status") != "OK":
+    status = data.get("status")
+    # cuota / error interno de Google: temporal, quien llama reintenta
+    if status in ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR"):
+        raise RuntimeError(f"Places API temporalmente no disponible (status={status})")
+    if status != "OK":
         return None
 
     candidates = data.get("candidates") or []
@@ -376,14 +744,14 @@ def ensure_business_review_url(db: Session, *, job_id: int) -> str:
         name = (bs.business_name or "").strip()
 
     if not name:
-        raise RuntimeError(
+        raise ReviewUrlConfigError(
             "No puedo resolver place_id: falta ScrapeJob.place_name y business_settings.business_name"
         )
 
     resolved = resolve_place_id_via_places_api(name)
 
     if not resolved:
-        raise RuntimeError(
+        raise ReviewUrlConfigError(
             f"No pude obtener place_id desde Places API (query='{name}')"
         )
 
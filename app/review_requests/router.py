@@ -1,9 +1,9 @@
 from __future__ import annotations
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 from app.billing_service import maybe_activate_subscription_after_25_reviews
-from .sender import process_pending
+from .sender import process_pending, warm_job_send_context
 from app.db import get_db
 from app.reviews_service import check_and_store_latest_reviews
 from sqlalchemy import text
@@ -91,7 +91,11 @@ def get_settings(job_id: int = Query(...), db: Session = Depends(get_db)):
 
 
 @router.patch("/business-settings", response_model=BusinessSettingsOut)
-def upsert_settings(payload: BusinessSettingsUpsert, db: Session = Depends(get_db)):
+def upsert_settings(
+    payload: BusinessSettingsUpsert,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+):
     bs = repo.upsert_business_settings(
         db,
         job_id=payload.job_id,
@@ -104,6 +108,9 @@ def upsert_settings(payload: BusinessSettingsUpsert, db: Session = Depends(get_d
     if not bs:
         raise HTTPException(status_code=500, detail="No se pudo guardar configuración")
 
+    # la review URL se resuelve ahora y no en el primer envío
+    background_tasks.add_task(warm_job_send_context, payload.job_id)
+
     return bs
 
 
@@ -1,9 +1,259 @@
 import os
 import json
+import threading
+import time
+from dataclasses import dataclass
+from datetime import timedelta, timezone
+from typing import Optional
 
+from app.db import SessionLocal
 from .twilio_service import send_whatsapp_template
 from .whatsapp_gateway_service import send_whatsapp_review_message
 from . import repo
+from .utils import utcnow
+
+
+# ajustes + review URL por job: se resuelven una vez y se reutilizan en el
+# bucle de envío (ensure_business_review_url puede llamar a Places y hacer commit)
+SETTINGS_CACHE_TTL_SECONDS = int(os.getenv("REVIEW_SENDER_SETTINGS_TTL_SECONDS", "60"))
+# un error (p. ej. Places caído) se recuerda poco: solo evita repetir la
+# resolución para cada fila del mismo job en el mismo lote
+SETTINGS_ERROR_TTL_SECONDS = int(os.getenv("REVIEW_SENDER_SETTINGS_ERROR_TTL_SECONDS", "15"))
+# con errores temporales una fila se aplaza como mucho este tiempo tras su send_at
+MAX_DEFER_SECONDS = int(os.getenv("REVIEW_SENDER_MAX_DEFER_SECONDS", str(24 * 3600)))
+
+
+@dataclass(frozen=True)
+class JobSendContext:
+    review_url: Optional[str]
+    business_name: Optional[str]
+    whatsapp_provider: Optional[str]
+    whatsapp_personal_enabled: bool
+    whatsapp_session_status: Optional[str]
+    # si no se pudo resolver la review URL; los temporales (Places/HTTP) se
+    # reintentan tras SETTINGS_ERROR_TTL_SECONDS, los de configuración no
+    error: Optional[str] = None
+    error_permanent: bool = False
+
+
+_job_context_cache: dict[int, tuple[float, JobSendContext]] = {}
+_job_context_lock = threading.Lock()
+
+
+def _load_job_send_context(db, job_id: int) -> JobSendContext:
+    error = None
+    error_permanent = False
+    try:
+        review_url = repo.ensure_business_review_url(db, job_id=job_id)
+    except Exception as e:
+        db.rollback()
+        review_url = None
+        error = str(e)
+        error_permanent = isinstance(e, repo.ReviewUrlConfigError)
+
+    settings = repo.get_business_settings(db, job_id=job_id)
+
+    return JobSendContext(
+        review_url=review_url,
+        business_name=getattr(settings, "business_name", None),
+        whatsapp_provider=getattr(settings, "whatsapp_provider", None),
+        whatsapp_personal_enabled=bool(getattr(settings, "whatsapp_personal_enabled", False)),
+        whatsapp_session_status=getattr(settings, "whatsapp_session_status", None),
+        error=error,
+        error_permanent=error_permanent,
+    )
+
+
+def get_job_send_context(db, job_id: int) -> JobSendContext:
+    """
+    Ajustes de envío del job (copia inmutable, sin sesión), cacheados
+    SETTINGS_CACHE_TTL_SECONDS. Si no hay review URL lanza
+    repo.ReviewUrlConfigError (falta configuración) o RuntimeError (temporal);
+    ver should_defer_send.
+    """
+    now = time.monotonic()
+    with _job_context_lock:
+        cached = _job_context_cache.get(job_id)
+
+    if cached is None or cached[0] <= now:
+        ctx = _load_job_send_context(db, job_id)
+        ttl = SETTINGS_ERROR_TTL_SECONDS if ctx.error and not ctx.error_permanent else SETTINGS_CACHE_TTL_SECONDS
+        with _job_context_lock:
+            _job_context_cache[job_id] = (now + ttl, ctx)
+    else:
+        ctx = cached[1]
+
+    if ctx.error:
+        if ctx.error_permanent:
+            raise repo.ReviewUrlConfigError(ctx.error)
+        raise RuntimeError(ctx.error)
+    return ctx
+
+
+def should_defer_send(rr, error: Exception) -> bool:
+    """
+    Tras un error de get_job_send_context: True si la fila debe volver a
+    'scheduled' (error temporal y send_at reciente), False si se marca failed.
+    """
+    if isinstance(error, repo.ReviewUrlConfigError):
+        return False
+
+    send_at = rr.send_at
+    if send_at is None:
+        return True
+    if send_at.tzinfo is None:
+        send_at = send_at.replace(tzinfo=timezone.utc)
+    return utcnow() - send_at < timedelta(seconds=MAX_DEFER_SECONDS)
+
+
+def send_context_retry_delays() -> dict[int, float]:
+    """
+    Jobs con un error temporal reciente al resolver la review URL (aún en
+    caché) -> segundos hasta que se vuelva a intentar. Los de configuración
+    no se incluyen: sus filas se marcan failed.
+    """
+    now = time.monotonic()
+    with _job_context_lock:
+        return {
+            job_id: expires - now
+            for job_id, (expires, ctx) in _job_context_cache.items()
+            if ctx.error and not ctx.error_permanent and expires > now
+        }
+
+
+def invalidate_job_send_context(job_id: int) -> None:
+    with _job_context_lock:
+        _job_context_cache.pop(job_id, None)
+
+
+def warm_job_send_context(job_id: int) -> None:
+    """
+    Tras cambiar los ajustes: resuelve ya la review URL (Places API) para que
+    el envío no tenga que hacerlo. Pensado para BackgroundTasks.
+    """
+    invalidate_job_send_context(job_id)
+
+    db = SessionLocal()
+    try:
+        get_job_send_context(db, job_id)
+    except Exception as e:
+        print(f"[send_due] no se pudo precalcular review URL job_id={job_id}: {repr(e)}")
+    finally:
+        db.close()
+
+
+def resolve_template_sid():
+    return (
+        os.getenv("TWILIO_WHATSAPP_TEMPLATE_SID_REVIEWS")
+        or os.getenv("TWILIO_CONTENT_SID_REVIEWS")
+    )
+
+
+def pick_provider(settings) -> str:
+    """
+    "personal_number" si el número propio (whatsapp-web.js) está activo y
+    conectado; "twilio" en caso contrario.
+    """
+    provider = getattr(settings, "whatsapp_provider", None) or "twilio"
+    personal_enabled = bool(
+        getattr(settings, "whatsapp_personal_enabled", False)
+    )
+    session_status = getattr(settings, "whatsapp_session_status", None)
+
+    if (
+        provider == "personal_number"
+        and personal_enabled
+        and session_status == "ready"
+    ):
+        return "personal_number"
+    return "twilio"
+
+
+def send_one(rr, *, settings: JobSendContext, template_sid) -> str:
+    """
+    Envía el WhatsApp de una review request (HTTP bloqueante, sin tocar la BD:
+    se puede llamar desde un hilo). Devuelve el proveedor usado.
+    """
+    name = (rr.customer_name or "").strip() or "😊"
+    business_name = settings.business_name
+    review_url = settings.review_url
+    provider = pick_provider(settings)
+
+    if provider == "personal_number":
+        print(f"[send_due] usando numero propio rr={rr.id}")
+
+        result = send_whatsapp_review_message(
+            job_id=rr.job_id,
+            phone_e164=rr.phone_e164,
+            customer_name=name,
+            business_name=business_name,
+            google_review_url=review_url,
+            idempotency_key=rr.send_key,
+        )
+
+        print(
+            f"[send_due] personal send ok rr={rr.id} result={json.dumps(result, ensure_ascii=False)}"
+        )
+
+    else:
+        if not template_sid:
+            raise RuntimeError(
+                "Missing WhatsApp template SID "
+                "(TWILIO_WHATSAPP_TEMPLATE_SID_REVIEWS / TWILIO_CONTENT_SID_REVIEWS)"
+            )
+
+        variables = {
+            "1": name,
+            "2": review_url,
+        }
+
+        print(
+            f"[send_due] usando twilio rr={rr.id} "
+            f"vars={variables}"
+        )
+
+        sid = send_whatsapp_template(
+            to_e164=rr.phone_e164,
+            template_sid=template_sid,
+            variables=variables,
+        )
+
+        print(f"[send_due] twilio sid={sid} rr={rr.id}")
+
+    return provider
+
+
+def dispatch_one(
+    rr,
+    *,
+    settings: JobSendContext,
+    template_sid,
+    lease_expires_at,
+) -> Optional[str]:
+    """
+    Marca la fila como despachada (sesión propia, commit inmediato) y la
+    envía; se puede llamar desde un hilo. lease_expires_at: el devuelto por
+    claim_due. Devuelve el proveedor usado, o None si el lease ya no es de
+    este lote (no se envía).
+    """
+    provider = pick_provider(settings)
+
+    db = SessionLocal()
+    try:
+        owned = repo.mark_dispatched(
+            db,
+            request_id=rr.id,
+            provider=provider,
+            lease_expires_at=lease_expires_at,
+        )
+    finally:
+        db.close()
+
+    if not owned:
+        print(f"[send_due] lease perdido rr={rr.id}, no se envía")
+        return None
+
+    return send_one(rr, settings=settings, template_sid=template_sid)
 
 
 def process_pending(db):
@@ -14,100 +264,69 @@ def process_pending(db):
     """
     print("########## PROCESS_PENDING ACTIVO ##########")
 
-    pending = repo.get_due_scheduled(db)
+    lease_expires_at, pending = repo.claim_due(db)
 
-    template_sid = (
-        os.getenv("TWILIO_WHATSAPP_TEMPLATE_SID_REVIEWS")
-        or os.getenv("TWILIO_CONTENT_SID_REVIEWS")
-    )
+    template_sid = resolve_template_sid()
 
-    sent = 0
-    failed = 0
+    sent_ids: list[int] = []
+    failed: list[tuple[int, str]] = []
+    deferred: list[int] = []
 
     print(f"[send_due] encontrados: {len(pending)}")
     print(f"[send_due] template_sid={template_sid}")
 
     for rr in pending:
         try:
-            review_url = repo.ensure_business_review_url(db, job_id=rr.job_id)
-            settings = repo.get_business_settings(db, job_id=rr.job_id)
-
-            name = (rr.customer_name or "").strip() or "😊"
-            provider = getattr(settings, "whatsapp_provider", None) or "twilio"
-            business_name = getattr(settings, "business_name", None) if settings else None
-            personal_enabled = bool(
-                getattr(settings, "whatsapp_personal_enabled", False)
-            )
-            session_status = getattr(settings, "whatsapp_session_status", None)
+            settings = get_job_send_context(db, rr.job_id)
+        except Exception as e:
+            if should_defer_send(rr, e):
+                # review URL no disponible ahora: se reintenta en la próxima pasada
+                deferred.append(rr.id)
+                print(f"[send_due] aplazado rr={rr.id}: {repr(e)}")
+            else:
+                failed.append((rr.id, str(e)))
+                print(f"[send_due] error enviando rr={rr.id}: {repr(e)}")
+            continue
 
+        try:
             print(
                 f"[send_due] enviando rr={rr.id} "
                 f"job_id={rr.job_id} "
                 f"to={rr.phone_e164} "
                 f"send_at={rr.send_at} "
-                f"provider={provider} "
-                f"session_status={session_status}"
+                f"provider={pick_provider(settings)}"
             )
 
-            if (
-                provider == "personal_number"
-                and personal_enabled
-                and session_status == "ready"
+            if dispatch_one(
+                rr,
+                settings=settings,
+                template_sid=template_sid,
+                lease_expires_at=lease_expires_at,
             ):
-                print(f"[send_due] usando numero propio rr={rr.id}")
-
-                result = send_whatsapp_review_message(
-                    job_id=rr.job_id,
-                    phone_e164=rr.phone_e164,
-                    customer_name=name,
-                    business_name=business_name,
-                    google_review_url=review_url,
-                )
-
-                print(
-                    f"[send_due] personal send ok rr={rr.id} result={json.dumps(result, ensure_ascii=False)}"
-                )
-
-            else:
-                if not template_sid:
-                    raise RuntimeError(
-                        "Missing WhatsApp template SID "
-                        "(TWILIO_WHATSAPP_TEMPLATE_SID_REVIEWS / TWILIO_CONTENT_SID_REVIEWS)"
-                    )
-
-                variables = {
-                    "1": name,
-                    "2": review_url,
-                }
-
-                print(
-                    f"[send_due] usando twilio rr={rr.id} "
-                    f"vars={variables}"
-                )
-
-                sid = send_whatsapp_template(
-                    to_e164=rr.phone_e164,
-                    template_sid=template_sid,
-                    variables=variables,
-                )
-
-                print(f"[send_due] twilio sid={sid} rr={rr.id}")
-
-            repo.mark_sent(db, rr=rr)
-            sent += 1
+                sent_ids.append(rr.id)
 
         except Exception as e:
-            try:
-                repo.mark_failed(db, rr=rr, error_message=str(e))
-            except Exception as inner:
-                db.rollback()
-                print(f"[send_due] error marcando failed rr={rr.id}: {repr(inner)}")
-
-            failed += 1
+            failed.append((rr.id, str(e)))
             print(f"[send_due] error enviando rr={rr.id}: {repr(e)}")
 
+    # un solo commit para todo el lote; si el proceso muere antes, al caducar
+    # el lease los ya despachados quedan como IN_DOUBT (no se reenvían)
+    try:
+        if pending:
+            repo.record_send_outcomes(
+                db,
+                sent_ids=sent_ids,
+                failed=failed,
+                lease_expires_at=lease_expires_at,
+            )
+            repo.release_claims(db, ids=deferred, lease_expires_at=lease_expires_at)
+    except Exception as e:
+        db.rollback()
+        print(f"[send_due] error guardando resultados: {repr(e)}")
+
     return {
         "processed": len(pending),
-        "sent": sent,
-        "failed": failed,
-    }
\ No newline at end of file
+        "sent": len(sent_ids),
+        "failed": len(failed),
+        "deferred": len(deferred),
+    }
@@ -0,0 +1,82 @@
+"""
+Despertar del worker de envíos cuando se programa algo nuevo.
+
+- Postgres: NOTIFY en el canal REVIEW_WAKEUP_CHANNEL dentro de la misma
+  transacción que crea las review requests (se entrega al hacer commit);
+  el worker escucha con LISTEN en una conexión propia.
+- Otros motores (SQLite): threading.Event en memoria, solo despierta a un
+  worker que corra en el mismo proceso; si no, queda el sondeo por tiempo.
+"""
+
+from __future__ import annotations
+
+import select
+import threading
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+REVIEW_WAKEUP_CHANNEL = "review_requests_wakeup"
+
+_local_event = threading.Event()
+
+
+def notify_review_requests_scheduled(db: Session) -> None:
+    """Avisa al worker; en Postgres se envía con el commit de la sesión."""
+    if db.bind is not None and db.bind.dialect.name == "postgresql":
+        db.execute(text("SELECT pg_notify(:channel, '')"), {"channel": REVIEW_WAKEUP_CHANNEL})
+    else:
+        _local_event.set()
+
+
+class WakeupListener:
+    """
+    wait(timeout) bloquea hasta una notificación o hasta timeout segundos.
+    Si la conexión LISTEN falla, se comporta como un sleep y reintenta
+    la conexión en la siguiente espera.
+    """
+
+    def __init__(self, engine: Engine) -> None:
+        self.engine = engine
+        self._raw = None
+
+    def _connect(self):
+        if self._raw is None:
+            raw = self.engine.raw_connection()
+            conn = raw.driver_connection
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {REVIEW_WAKEUP_CHANNEL}")
+            self._raw = raw
+        return self._raw.driver_connection
+
+    def wait(self, timeout: float) -> bool:
+        if self.engine.dialect.name != "postgresql":
+            woken = _local_event.wait(timeout)
+            _local_event.clear()
+            return woken
+
+        try:
+            conn = self._connect()
+            if not conn.notifies:
+                ready, _, _ = select.select([conn], [], [], timeout)
+                if ready:
+                    conn.poll()
+            woken = bool(conn.notifies)
+            conn.notifies.clear()
+            return woken
+        except Exception as e:
+            print(f"[review_sender] LISTEN no disponible, espera por tiempo: {repr(e)}")
+            self.close()
+            _local_event.wait(timeout)
+            return False
+
+    def close(self) -> None:
+        raw = self._raw
+        self._raw = None
+        if raw is not None:
+            try:
+                raw.invalidate()
+            except Exception:
+                pass
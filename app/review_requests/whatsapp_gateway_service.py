@@ -61,6 +61,7 @@ def send_whatsapp_review_message(
     customer_name: str,
     business_name: str | None,
     google_review_url: str | None,
+    idempotency_key: str | None = None,
 ) -> dict:
     message = (
         f"Hola {customer_name}, gracias por tu visita"
@@ -68,14 +69,21 @@ def send_whatsapp_review_message(
         f"¿Nos dejas una reseña aquí? {google_review_url}"
     )
 
+    headers = _headers()
+    if idempotency_key:
+        # clave estable por review request para que el gateway pueda
+        # deduplicar; el worker no cuenta con ello (no reenvía lo despachado)
+        headers["Idempotency-Key"] = idempotency_key
+
     response = requests.post(
         f"{WHATSAPP_GATEWAY_URL}/messages/send",
         json={
             "job_id": job_id,
             "to": phone_e164,
             "message": message,
+            "idempotency_key": idempotency_key,
         },
-        headers=_headers(),
+        headers=headers,
         timeout=45,
     )
 
@@ -1,29 +1,240 @@
 from __future__ import annotations
 
+import asyncio
 import os
-import time
-import json
 
 from app.db import SessionLocal, engine, Base
+from app.schema_upgrades import apply_schema_upgrades
 from . import repo
-from .twilio_service import send_whatsapp_template
-from .whatsapp_gateway_service import send_whatsapp_review_message
+from .rate_limit import AsyncTokenBucket
+from .sender import (
+    dispatch_one,
+    get_job_send_context,
+    pick_provider,
+    resolve_template_sid,
+    send_context_retry_delays,
+    should_defer_send,
+)
+from .wakeup import WakeupListener
 
 
 POLL_SECONDS = int(os.environ.get("REVIEW_SENDER_POLL_SECONDS", "30"))
 BATCH_SIZE = int(os.environ.get("REVIEW_SENDER_BATCH_SIZE", "25"))
+# espera mínima entre consultas (evita un bucle caliente si otros workers
+# tienen reclamadas las filas vencidas)
+MIN_SLEEP_SECONDS = float(os.environ.get("REVIEW_SENDER_MIN_SLEEP_SECONDS", "1"))
+
+# envíos simultáneos (las llamadas HTTP van en hilos vía asyncio.to_thread)
+CONCURRENCY = int(os.environ.get("REVIEW_SENDER_CONCURRENCY", "10"))
+
+# mensajes/segundo por proveedor y mensajes/minuto por job (0 = sin límite)
+PROVIDER_RATE_LIMITS = {
+    "twilio": float(os.environ.get("REVIEW_SENDER_TWILIO_PER_SECOND", "10")),
+    "personal_number": float(os.environ.get("REVIEW_SENDER_PERSONAL_PER_SECOND", "1")),
+}
+# límite por job desactivado por defecto; si se activa no se espera dentro del
+# lote: las filas sin cupo vuelven a 'scheduled' y el job no se reclama hasta
+# que tenga cupo, así un job limitado no frena a los demás
+JOB_PER_MINUTE = float(os.environ.get("REVIEW_SENDER_JOB_PER_MINUTE", "0"))
+JOB_BURST = float(os.environ.get("REVIEW_SENDER_JOB_BURST", "5"))
+
+
+def _lease_seconds() -> int:
+    """
+    El lease debe durar más que un lote entero al ritmo del proveedor más
+    lento (más margen para las llamadas HTTP); si no, caduca con envíos en
+    curso.
+    """
+    slowest = min((r for r in PROVIDER_RATE_LIMITS.values() if r > 0), default=0)
+    throttled_seconds = BATCH_SIZE / slowest if slowest else 0
+    return max(repo.SEND_LEASE_SECONDS, int(throttled_seconds * 2) + 120)
+
+
+LEASE_SECONDS = _lease_seconds()
+
+_provider_buckets: dict[str, AsyncTokenBucket] = {}
+_job_buckets: dict[int, AsyncTokenBucket] = {}
+
+
+def _provider_bucket(provider: str) -> AsyncTokenBucket:
+    bucket = _provider_buckets.get(provider)
+    if bucket is None:
+        bucket = _provider_buckets[provider] = AsyncTokenBucket(PROVIDER_RATE_LIMITS.get(provider, 0))
+    return bucket
+
+
+def _job_bucket(job_id: int) -> AsyncTokenBucket:
+    bucket = _job_buckets.get(job_id)
+    if bucket is None:
+        # ráfaga de hasta JOB_BURST mensajes, luego JOB_PER_MINUTE de media
+        bucket = _job_buckets[job_id] = AsyncTokenBucket(JOB_PER_MINUTE / 60.0, capacity=JOB_BURST)
+    return bucket
+
+
+def _excluded_jobs() -> dict[int, float]:
+    """
+    Jobs que no se reclaman ahora (sin cupo por minuto o con un error
+    temporal de review URL) -> segundos hasta que vuelven a ser reclamables.
+    """
+    excluded = {
+        job_id: bucket.seconds_until_token()
+        for job_id, bucket in _job_buckets.items()
+        if not bucket.has_token()
+    }
+    for job_id, delay in send_context_retry_delays().items():
+        excluded[job_id] = max(delay, excluded.get(job_id, 0.0))
+    return excluded
+
+
+async def _dispatch(rr, *, settings, template_sid, lease_expires_at, semaphore):
+    provider = pick_provider(settings)
+
+    await _provider_bucket(provider).acquire()
+
+    async with semaphore:
+        print(f"[review_sender] sending id={rr.id} via {provider} to {rr.phone_e164}")
+        return await asyncio.to_thread(
+            dispatch_one,
+            rr,
+            settings=settings,
+            template_sid=template_sid,
+            lease_expires_at=lease_expires_at,
+        )
+
+
+async def _send_batch(db, due, *, lease_expires_at, template_sid, semaphore) -> None:
+    """
+    La BD solo se toca en el hilo del bucle (la sesión no es thread-safe);
+    los envíos HTTP se lanzan a la vez y los estados se guardan al final
+    con un único UPDATE del lote.
+    """
+    sent_ids: list[int] = []
+    failed: list[tuple[int, str]] = []
+    deferred: list[int] = []
+
+    tasks = []
+    for rr in due:
+        try:
+            # una resolución por job (caché con TTL), no una por mensaje
+            settings = get_job_send_context(db, rr.job_id)
+        except Exception as e:
+            tasks.append(None)
+            if should_defer_send(rr, e):
+                # error temporal (Places/HTTP): la fila sigue programada
+                deferred.append(rr.id)
+                print(f"[review_sender] deferred id={rr.id} err={e}")
+            else:
+                failed.append((rr.id, str(e)))
+                print(f"[review_sender] failed id={rr.id} err={e}")
+            continue
+
+        if not _job_bucket(rr.job_id).try_acquire():
+            tasks.append(None)
+            deferred.append(rr.id)
+            continue
+
+        tasks.append(asyncio.create_task(_dispatch(
+            rr,
+            settings=settings,
+            template_sid=template_sid,
+            lease_expires_at=lease_expires_at,
+            semaphore=semaphore,
+        )))
+
+    if deferred:
+        print(f"[review_sender] {len(deferred)} envíos aplazados (límite por job / review URL)")
+        repo.release_claims(db, ids=deferred, lease_expires_at=lease_expires_at)
+
+    pending = [t for t in tasks if t is not None]
+    results = await asyncio.gather(*pending, return_exceptions=True)
+    results_by_task = dict(zip(pending, results))
+
+    for rr, task in zip(due, tasks):
+        if task is None:
+            continue
+        result = results_by_task[task]
+        if isinstance(result, Exception):
+            failed.append((rr.id, str(result)))
+            print(f"[review_sender] failed id={rr.id} err={result}")
+        elif result is None:
+            # lease perdido: la fila es de otra pasada
+            continue
+        else:
+            sent_ids.append(rr.id)
+            print(f"[review_sender] sent id={rr.id} provider={result}")
+
+    # todas las filas del lote comparten el lease del reclamo
+    repo.record_send_outcomes(
+        db,
+        sent_ids=sent_ids,
+        failed=failed,
+        lease_expires_at=lease_expires_at,
+    )
+
+
+async def run() -> None:
+    template_sid = resolve_template_sid()
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    listener = WakeupListener(engine)
+
+    while True:
+        db = SessionLocal()
+        sleep_seconds = POLL_SECONDS
+        try:
+            lease_expires_at, due = repo.claim_due(
+                db,
+                batch_size=BATCH_SIZE,
+                lease_seconds=LEASE_SECONDS,
+                exclude_job_ids=set(_excluded_jobs()),
+            )
+            if due:
+                await _send_batch(
+                    db,
+                    due,
+                    lease_expires_at=lease_expires_at,
+                    template_sid=template_sid,
+                    semaphore=semaphore,
+                )
+
+            if len(due) < BATCH_SIZE:
+                # las filas vencidas de jobs excluidos no cuentan: se espera
+                # a que el primero de esos jobs vuelva a ser reclamable
+                excluded = _excluded_jobs()
+                sleep_seconds = repo.seconds_until_next_due(
+                    db,
+                    max_seconds=POLL_SECONDS,
+                    exclude_job_ids=set(excluded),
+                )
+                if excluded:
+                    sleep_seconds = min(sleep_seconds, min(excluded.values()))
+        except Exception as e:
+            print(f"[review_sender] error en el ciclo: {repr(e)}")
+            due = []
+        finally:
+            db.close()
+
+        # lote lleno: quedan más pendientes, se vuelve a consultar sin esperar
+        if len(due) >= BATCH_SIZE:
+            continue
+
+        # hasta el próximo send_at, o antes si llega un aviso (send-now / importación)
+        await asyncio.to_thread(listener.wait, max(MIN_SLEEP_SECONDS, sleep_seconds))
 
 
 def main():
     Base.metadata.create_all(bind=engine)
+    apply_schema_upgrades(engine)
 
-    print("[review_sender] worker started. poll=", POLL_SECONDS)
-
-    template_sid = (
-        os.environ.get("TWILIO_WHATSAPP_TEMPLATE_SID_REVIEWS")
-        or os.environ.get("TWILIO_CONTENT_SID_REVIEWS")
+    print(
+        "[review_sender] worker started. poll=", POLL_SECONDS,
+        "batch=", BATCH_SIZE,
+        "concurrency=", CONCURRENCY,
+        "lease=", LEASE_SECONDS,
+        "job_per_minute=", JOB_PER_MINUTE or "off",
     )
 
+    template_sid = resolve_template_sid()
+
     print(
         "[review_sender] ENV TWILIO_WHATSAPP_TEMPLATE_SID_REVIEWS =",
         os.environ.get("TWILIO_WHATSAPP_TEMPLATE_SID_REVIEWS"),
@@ -40,76 +251,8 @@ def main():
             "(TWILIO_WHATSAPP_TEMPLATE_SID_REVIEWS o TWILIO_CONTENT_SID_REVIEWS)"
         )
 
-    while True:
-        db = SessionLocal()
-        try:
-            due = repo.get_due_scheduled(db, batch_size=BATCH_SIZE)
-            if not due:
-                time.sleep(POLL_SECONDS)
-                continue
-
-            for rr in due:
-                try:
-                    review_url = repo.ensure_business_review_url(db, job_id=rr.job_id)
-                    settings = repo.get_business_settings(db, job_id=rr.job_id)
-
-                    name = (rr.customer_name or "").strip() or "😊"
-                    provider = getattr(settings, "whatsapp_provider", None) or "twilio"
-                    business_name = getattr(settings, "business_name", None) if settings else None
-                    personal_enabled = bool(
-                        getattr(settings, "whatsapp_personal_enabled", False)
-                    )
-
-                    if provider == "personal_number" and personal_enabled:
-                        print(
-                            "[review_sender] sending via personal_number to",
-                            rr.phone_e164,
-                        )
-
-                        result = send_whatsapp_review_message(
-                            job_id=rr.job_id,
-                            phone_e164=rr.phone_e164,
-                            customer_name=name,
-                            business_name=business_name,
-                            google_review_url=review_url,
-                        )
-
-                        repo.mark_sent(db, rr=rr)
-                        print(
-                            f"[review_sender] sent id={rr.id} personal_result={json.dumps(result, ensure_ascii=False)}"
-                        )
-
-                    else:
-                        variables = {
-                            "1": name,
-                            "2": review_url,
-                        }
-
-                        print(
-                            "[review_sender] sending via twilio to",
-                            rr.phone_e164,
-                            "content_variables=",
-                            json.dumps(variables, ensure_ascii=False),
-                        )
-
-                        sid = send_whatsapp_template(
-                            to_e164=rr.phone_e164,
-                            template_sid=template_sid,
-                            variables=variables,
-                        )
-
-                        repo.mark_sent(db, rr=rr)
-                        print(f"[review_sender] sent id={rr.id} twilio_sid={sid}")
-
-                except Exception as e:
-                    repo.mark_failed(db, rr=rr, error_message=str(e))
-                    print(f"[review_sender] failed id={rr.id} err={e}")
-
-        finally:
-            db.close()
-
-        time.sleep(2)
+    asyncio.run(run())
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,50 @@
+# app/schema_upgrades.py
+"""
+Columnas añadidas a tablas que ya existen en producción.
+
+create_all() solo crea tablas nuevas, no altera las existentes; aquí se
+añaden las columnas que falten (idempotente, se ejecuta en cada arranque).
+"""
+
+from __future__ import annotations
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+# (tabla, columna, tipo SQL)
+COLUMN_UPGRADES: list[tuple[str, str, str]] = [
+    ("review_import_batches", "progress_json", "JSON"),
+    ("review_requests", "lease_expires_at", "TIMESTAMP WITH TIME ZONE"),
+    ("review_requests", "send_key", "VARCHAR(64)"),
+    ("review_requests", "dispatched_at", "TIMESTAMP WITH TIME ZONE"),
+    ("review_requests", "send_provider", "VARCHAR(32)"),
+]
+
+# (tipo ENUM de Postgres, valor nuevo). En SQLite el Enum es un VARCHAR sin CHECK.
+ENUM_UPGRADES: list[tuple[str, str]] = [
+    ("reviewrequeststatus", "sending"),
+]
+
+
+def apply_schema_upgrades(engine: Engine) -> None:
+    insp = inspect(engine)
+    tables = set(insp.get_table_names())
+
+    with engine.begin() as conn:
+        for table, column, sql_type in COLUMN_UPGRADES:
+            if table not in tables:
+                continue
+            existing = {c["name"] for c in insp.get_columns(table)}
+            if column in existing:
+                continue
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {sql_type}"))
+            print(f"🧱 columna añadida: {table}.{column}")
+
+    if engine.dialect.name != "postgresql":
+        return
+
+    # ALTER TYPE ... ADD VALUE no puede usarse en la misma transacción que lo
+    # añade: cada valor en autocommit
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for type_name, value in ENUM_UPGRADES:
+            conn.execute(text(f"ALTER TYPE {type_name} ADD VALUE IF NOT EXISTS '{value}'"))
@@ -19,9 +19,11 @@ from datetime import datetime, timedelta, timezone
 from api.geogrid import router as geogrid_router
 import requests
 from supabase_client import supabase
-from app.db import Base, engine, get_db
+from app.db import Base, engine, get_db, SessionLocal
+from app.schema_upgrades import apply_schema_upgrades
 from urllib.parse import urlparse, parse_qs
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from openai import OpenAI
 
 from collections import defaultdict
@@ -41,9 +43,20 @@ from app.schemas import ScrapeRequest, ScrapeResponse, JobStatusResponse
 from app.models import ScrapeJob, Review
 from app.reviews_service import scrape_and_store
 from app.models_analysis_cache import AnalysisCache
-from app.models_ai_reply_cache import ReviewAIReply
+from app.models_ai_reply_cache import ReviewAIReply, ReviewAIReplyBatch
+from app.review_dedup import collapse_near_duplicates
+from app.models_llm_cache import LLMResponseCache
+from app.llm_cache import cached_llm_call
+from app.ai_replies import (
+    REPLY_MODEL,
+    REPLY_TEMPERATURE,
+    REPLY_TONE,
+    build_reply_messages,
+    reply_input_hash,
+)
 from services.serp_provider import find_business_coordinates
 from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
 from api.gbp_routes import router as gbp_router
 from services.apify_places import find_business_coordinates_apify
 from services.serp_provider import find_business_coordinates
@@ -57,6 +70,7 @@ from api.jobs_routes import router as jobs_router
 from api.stripe_webhook_routes import router as stripe_webhook_router
 
 from api.stripe_routes import router as stripe_router
+from api.ai_reply_batch_routes import router as ai_reply_batch_router
 print("DEBUG OPENAI_API_KEY:", "OK" if os.getenv("OPENAI_API_KEY") else "MISSING")
 
 
@@ -110,8 +124,23 @@ def startup_event():
 
     # DB
     Base.metadata.create_all(bind=engine)
+    apply_schema_upgrades(engine)
     print("✅ DB ready:", engine.url)
 
+    # importaciones en segundo plano que murieron con un proceso anterior
+    from app.review_requests.import_repo import fail_stale_import_batches
+
+    db = SessionLocal()
+    try:
+        stale = fail_stale_import_batches(db)
+        if stale:
+            print(f"⚠️ {stale} importaciones interrumpidas marcadas como fallidas")
+    except Exception as e:
+        db.rollback()
+        print("❌ no se pudieron revisar importaciones interrumpidas:", repr(e))
+    finally:
+        db.close()
+
     # OpenAI
     api_key = os.getenv("OPENAI_API_KEY")
 
@@ -142,6 +171,7 @@ app.include_router(jobs_router)
 app.include_router(stripe_webhook_router)
 app.include_router(stripe_router)
 app.include_router(geogrid_router)
+app.include_router(ai_reply_batch_router)
 # =========================
 # Rutas
 # =========================
@@ -250,40 +280,31 @@ def places_search(q: str = Query(..., min_length=2, description="Nombre del nego
 # ======================================
 
 async def generate_reply(review: dict, openai_client: OpenAI) -> str:
+    return generate_reply_sync(review, openai_client)
+
+
+def generate_reply_sync(review: dict, openai_client: OpenAI) -> str:
     if openai_client is None:
         raise HTTPException(500, "IA no configurada (OPENAI_API_KEY falta)")
 
 
-    star = review.get("star_rating", 5)
-    comment = review.get("comment", "")
-    reviewer = review.get("reviewer_name", "el cliente")
-
-    system_prompt = (
-        "Eres un asistente experto en atención al cliente para pequeñas empresas. "
-        "Respondes a reseñas de Google en español con un tono humano, cercano y profesional. "
-        "Sé breve (3-5 frases), agradecido y, si la reseña es negativa, empático y orientado a solución. "
-        "No inventes datos ni promociones agresivas."
-    )
+    messages = build_reply_messages(review)
 
-    user_prompt = f"""Reseña:
-- Estrellas: {star}
-- Cliente: {reviewer}
-- Comentario: "{comment}"
-
-Redacta la respuesta que pondrá el negocio en su perfil de Google.
-"""
+    def _call() -> str:
+        completion = openai_client.chat.completions.create(
+            model=REPLY_MODEL,
+            messages=messages,
+            temperature=REPLY_TEMPERATURE,
+        )
+        return completion.choices[0].message.content.strip()
 
-    completion = openai_client.chat.completions.create(
-        model="gpt-4.1-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.5,
+    return cached_llm_call(
+        model=REPLY_MODEL,
+        temperature=REPLY_TEMPERATURE,
+        prompt=messages,
+        compute=_call,
     )
 
-    return completion.choices[0].message.content.strip()
-
 
 # ======================================
 # Mock de reseñas para pruebas
@@ -771,7 +792,18 @@ async def topics_summary(
         if r.text
     ]
 
-    reviews_for_ai = reviews[-10000:]
+    # Casi duplicados ("Excelente", "Muy buena atención"...) -> 1 representante con "veces"
+    reviews_for_ai = [
+        {
+            "id": g["id"],
+            "created_at": g["created_at"],
+            "star_rating": g["star_rating"],
+            "comment": g["comment"],
+            "veces": g["veces"],
+        }
+        for g in collapse_near_duplicates(reviews[-10000:])
+    ]
+    print("🧹 topics_summary dedup:", len(reviews[-10000:]), "->", len(reviews_for_ai))
 
     system_prompt = (
         "Eres un analista experto en reseñas de negocios. "
@@ -781,11 +813,13 @@ async def topics_summary(
     )
 
     user_prompt = f"""
-Estas son las reseñas en JSON:
+Estas son las reseñas en JSON.
+Cada reseña tiene un campo "veces": nº de reseñas casi idénticas que representa.
 
 {json.dumps(reviews_for_ai, ensure_ascii=False)}
 
 Agrúpalas en un máximo de {max_topics} temas.
+Al contar "menciones", suma el campo "veces" de cada reseña (no cuentes 1 por entrada).
 
 Devuelve SOLO este JSON:
 
@@ -801,16 +835,29 @@ Devuelve SOLO este JSON:
 }}
 """
 
-    try:
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+    def _call_topics() -> str:
         completion = openai_client.chat.completions.create(
             model="gpt-4.1-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
+            messages=messages,
             temperature=0.2,
         )
-        parsed = json.loads(completion.choices[0].message.content or "{}")
+        content = completion.choices[0].message.content or "{}"
+        json.loads(content)  # solo se cachea JSON válido
+        return content
+
+    try:
+        content = cached_llm_call(
+            model="gpt-4.1-mini",
+            temperature=0.2,
+            prompt=messages,
+            compute=_call_topics,
+        )
+        parsed = json.loads(content)
         topics = parsed.get("topics", [])
     except Exception as e:
         print("⚠️ Error IA topics_summary:", e)
@@ -1008,7 +1055,17 @@ async def action_plan(
 
     negative = [r for r in reviews_for_ai if r["star_rating"] <= 3]
     base = negative if len(negative) >= 5 else reviews_for_ai
-    base = base[-3000:]
+
+    # Casi duplicados -> 1 representante (su id sigue siendo un id real)
+    base = [
+        {
+            "id": g["id"],
+            "star_rating": g["star_rating"],
+            "comment": g["comment"],
+            "veces": g["veces"],
+        }
+        for g in collapse_near_duplicates(base[-3000:])
+    ]
 
     system_prompt = (
         "Eres un consultor experto en experiencia de cliente para negocios locales. "
@@ -1016,7 +1073,8 @@ async def action_plan(
     )
 
     user_prompt = f"""
-Estas son reseñas reales (JSON). Cada reseña tiene un id:
+Estas son reseñas reales (JSON). Cada reseña tiene un id y un campo "veces"
+(nº de reseñas casi idénticas que representa; úsalo para priorizar):
 
 {json.dumps(base, ensure_ascii=False)}
 
@@ -1039,16 +1097,29 @@ Reglas:
 - 2 a 4 ids por categoría.
 """
 
-    try:
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+    def _call_action_plan() -> str:
         completion = openai_client.chat.completions.create(
             model="gpt-4.1-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
+            messages=messages,
+            temperature=0.3,
+        )
+        content = completion.choices[0].message.content or "{}"
+        json.loads(content)  # solo se cachea JSON válido
+        return content
+
+    try:
+        content = cached_llm_call(
+            model="gpt-4.1-mini",
             temperature=0.3,
+            prompt=messages,
+            compute=_call_action_plan,
         )
-        parsed = json.loads(completion.choices[0].message.content or "{}")
+        parsed = json.loads(content)
         categorias = parsed.get("categorias") or []
     except Exception as e:
         print("⚠️ IA action_plan:", repr(e))
@@ -1282,16 +1353,11 @@ def build_place_key(info: dict) -> str:
     return info.get("query_text","").lower()
 
 
-@app.get("/reviews/ai-replies")
-async def ai_replies(
-    request: Request,
-    job_id: int = Query(..., description="ID del job (local)"),
-    db: Session = Depends(get_db),
-):
-    openai_client = request.app.state.openai_client
-    if not openai_client:
-        raise HTTPException(500, "IA no configurada (OPENAI_API_KEY falta)")
-
+def _load_recent_reviews_for_replies(db: Session, job_id: int):
+    """
+    Reseñas con texto de los últimos 30 días (más recientes primero) y
+    mapa review_id -> ReviewAIReply cacheada.
+    """
     cutoff = datetime.now(timezone.utc) - timedelta(days=30)
 
     def parse_dt_safe(v):
@@ -1319,7 +1385,7 @@ async def ai_replies(
         rating = int(r.rating or 0)
         text = r.text.strip()
 
-        input_hash = hashlib.sha1(f"{rating}|{text}".encode("utf-8")).hexdigest()
+        input_hash = reply_input_hash(rating, text)
 
         reviews.append(
             {
@@ -1334,14 +1400,81 @@ async def ai_replies(
 
     reviews.sort(key=lambda x: x["created_at"], reverse=True)
     if not reviews:
-        print("⚠️ ai_replies: no hay reviews en últimos 30 días")
-        return []
+        return [], {}
 
     # 2) Trae replies cacheadas
     ids = [r["id"] for r in reviews]
     cached_rows = db.query(ReviewAIReply).filter(ReviewAIReply.review_id.in_(ids)).all()
     cached_map = {c.review_id: c for c in cached_rows}
 
+    return reviews, cached_map
+
+
+def _upsert_ai_reply(db: Session, *, job_id: int, review: dict, reply_text: str) -> None:
+    now = datetime.now(timezone.utc)
+
+    def _update(c: ReviewAIReply) -> None:
+        c.reply_text = reply_text
+        c.input_hash = review["input_hash"]
+        c.model_used = REPLY_MODEL
+        c.tone = REPLY_TONE
+        c.updated_at = now
+
+    c = db.query(ReviewAIReply).filter(ReviewAIReply.review_id == review["id"]).first()
+    if c:
+        _update(c)
+        db.commit()
+        return
+
+    db.add(
+        ReviewAIReply(
+            review_id=review["id"],
+            job_id=job_id,
+            input_hash=review["input_hash"],
+            reply_text=reply_text,
+            model_used=REPLY_MODEL,
+            tone=REPLY_TONE,
+            created_at=now,
+            updated_at=now,
+        )
+    )
+    try:
+        db.commit()
+    except IntegrityError:
+        # otra generación simultánea insertó la fila antes: se actualiza esa
+        db.rollback()
+        c = db.query(ReviewAIReply).filter(ReviewAIReply.review_id == review["id"]).first()
+        if c is None:
+            raise
+        _update(c)
+        db.commit()
+
+
+def _ai_reply_item(r: dict, reply_text: str) -> dict:
+    return {
+        "review_id": r["id"],
+        "review_text": r["text"],
+        "reply_text": reply_text,
+        "rating": r["rating"],
+        "created_at": r["created_at"].isoformat(),
+    }
+
+
+@app.get("/reviews/ai-replies")
+async def ai_replies(
+    request: Request,
+    job_id: int = Query(..., description="ID del job (local)"),
+    db: Session = Depends(get_db),
+):
+    openai_client = request.app.state.openai_client
+    if not openai_client:
+        raise HTTPException(500, "IA no configurada (OPENAI_API_KEY falta)")
+
+    reviews, cached_map = _load_recent_reviews_for_replies(db, job_id)
+    if not reviews:
+        print("⚠️ ai_replies: no hay reviews en últimos 30 días")
+        return []
+
     # 3) Genera SOLO las que faltan o cambiaron
     to_upsert = []
     results = []
@@ -1373,26 +1506,18 @@ async def ai_replies(
                         job_id=job_id,
                         input_hash=r["input_hash"],
                         reply_text=reply_text,
-                        model_used="gpt-4.1-mini",
-                        tone="default",
+                        model_used=REPLY_MODEL,
+                        tone=REPLY_TONE,
                         created_at=datetime.now(timezone.utc),
                         updated_at=datetime.now(timezone.utc),
                     )
                 )
 
-        results.append(
-            {
-                "review_id": r["id"],
-                "review_text": r["text"],
-                "reply_text": reply_text,
-                "rating": r["rating"],
-                "created_at": r["created_at"].isoformat(),
-            }
-        )
+        results.append(_ai_reply_item(r, reply_text))
 
     # ✅ DEBUG (fuera del loop, bien indentado)
     print("🧠 ai_replies reviews:", len(reviews))
-    print("🧠 ai_replies cached_rows:", len(cached_rows))
+    print("🧠 ai_replies cached_rows:", len(cached_map))
     print("🧠 ai_replies to_upsert:", len(to_upsert))
 
     # 4) Guarda nuevas/actualizadas
@@ -1405,7 +1530,188 @@ async def ai_replies(
     return results
 
 
+AI_REPLIES_STREAM_CONCURRENCY = int(os.getenv("AI_REPLIES_STREAM_CONCURRENCY", "4"))
+
+
+@app.get("/reviews/ai-replies/stream")
+async def ai_replies_stream(
+    request: Request,
+    job_id: int = Query(..., description="ID del job (local)"),
+    format: Literal["ndjson", "sse"] = Query("ndjson"),
+    db: Session = Depends(get_db),
+):
+    """
+    Igual que /reviews/ai-replies pero en streaming: primero las respuestas
+    cacheadas y después cada respuesta nueva en cuanto el LLM la termina
+    (hasta AI_REPLIES_STREAM_CONCURRENCY generaciones en paralelo).
+    Cada línea lleva "source": "cached" | "generated" | "error".
+    """
+    openai_client = request.app.state.openai_client
+    if not openai_client:
+        raise HTTPException(500, "IA no configurada (OPENAI_API_KEY falta)")
+
+    reviews, cached_map = _load_recent_reviews_for_replies(db, job_id)
+
+    cached_items = []
+    missing = []
+    for r in reviews:
+        c = cached_map.get(r["id"])
+        if c and c.input_hash == r["input_hash"]:
+            cached_items.append(_ai_reply_item(r, c.reply_text))
+        else:
+            missing.append(r)
+
+    print("🧠 ai_replies_stream:", {"cached": len(cached_items), "missing": len(missing)})
+
+    def encode(item: dict) -> str:
+        line = json.dumps(item, ensure_ascii=False)
+        return f"data: {line}\n\n" if format == "sse" else line + "\n"
+
+    def generate_and_save(r: dict) -> str:
+        reply_text = generate_reply_sync(
+            {
+                "reviewer_name": r["author"],
+                "star_rating": r["rating"],
+                "comment": r["text"],
+            },
+            openai_client,
+        )
+        # La sesión del Depends ya está cerrada cuando se consume el stream
+        session = SessionLocal()
+        try:
+            _upsert_ai_reply(session, job_id=job_id, review=r, reply_text=reply_text)
+        finally:
+            session.close()
+        return reply_text
+
+    async def stream():
+        for item in cached_items:
+            yield encode({**item, "source": "cached"})
+
+        sem = asyncio.Semaphore(max(1, AI_REPLIES_STREAM_CONCURRENCY))
+
+        async def one(r: dict):
+            async with sem:
+                try:
+                    return r, await asyncio.to_thread(generate_and_save, r), None
+                except Exception as e:
+                    return r, None, e
+
+        tasks = [asyncio.create_task(one(r)) for r in missing]
+        try:
+            for fut in asyncio.as_completed(tasks):
+                r, reply_text, err = await fut
+                if err is not None:
+                    print(f"⚠️ ai_replies_stream review={r['id']}:", repr(err))
+                    yield encode({**_ai_reply_item(r, None), "source": "error", "error": str(err)})
+                    continue
+                yield encode({**_ai_reply_item(r, reply_text), "source": "generated"})
+        finally:
+            # cliente desconectado -> no seguir generando
+            for t in tasks:
+                t.cancel()
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream(), media_type=media_type)
+
+
+
+
+
+@app.get("/reviews/ai-reply/stream")
+def ai_reply_stream(
+    request: Request,
+    review_id: int = Query(..., description="ID de la reseña"),
+    regenerate: bool = Query(False, description="Ignora la respuesta guardada"),
+    db: Session = Depends(get_db),
+):
+    """
+    "Responder ahora": reenvía los tokens del LLM según llegan (text/plain).
+    Al terminar, el texto completo se guarda en ReviewAIReply.
+    """
+    openai_client = request.app.state.openai_client
+    if not openai_client:
+        raise HTTPException(500, "IA no configurada (OPENAI_API_KEY falta)")
+
+    row = db.query(Review).filter(Review.id == review_id).first()
+    if not row:
+        raise HTTPException(404, "Reseña no encontrada")
+
+    text = (row.text or "").strip()
+    if not text:
+        raise HTTPException(400, "La reseña no tiene texto")
+
+    rating = int(row.rating or 0)
+    job_id = row.job_id
+    review = {
+        "id": row.id,
+        "author": row.author_name or "Cliente",
+        "rating": rating,
+        "text": text,
+        "input_hash": reply_input_hash(rating, text),
+    }
+
+    cached = db.query(ReviewAIReply).filter(ReviewAIReply.review_id == review_id).first()
+    if cached and cached.input_hash == review["input_hash"] and not regenerate:
+        cached_text = cached.reply_text
+        return StreamingResponse(iter([cached_text]), media_type="text/plain; charset=utf-8")
+
+    messages = build_reply_messages(
+        {
+            "reviewer_name": review["author"],
+            "star_rating": rating,
+            "comment": text,
+        }
+    )
+
+    # se abre antes de responder: un error al arrancar es un HTTP 502 con
+    # mensaje, no una conexión cortada tras las cabeceras 200
+    try:
+        response = openai_client.chat.completions.create(
+            model=REPLY_MODEL,
+            messages=messages,
+            temperature=REPLY_TEMPERATURE,
+            stream=True,
+        )
+    except Exception as e:
+        print("❌ ai_reply_stream OpenAI:", repr(e))
+        raise HTTPException(status_code=502, detail=f"Error generando la respuesta: {e}")
+
+    def stream():
+        parts: list[str] = []
+        try:
+            for chunk in response:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            # a mitad del stream ya no se puede cambiar el status: se registra,
+            # se cierra el cuerpo limpiamente y no se guarda una respuesta a medias
+            print("❌ ai_reply_stream cortado:", review_id, repr(e))
+            return
+        finally:
+            try:
+                response.close()
+            except Exception:
+                pass
+
+        reply_text = "".join(parts).strip()
+        if not reply_text:
+            return
+
+        # La sesión del Depends ya está cerrada cuando termina el stream
+        session = SessionLocal()
+        try:
+            _upsert_ai_reply(session, job_id=job_id, review=review, reply_text=reply_text)
+            print("💾 ai_reply_stream guardada:", review_id)
+        except Exception as e:
+            session.rollback()
+            print("⚠️ ai_reply_stream guardando:", repr(e))
+        finally:
+            session.close()
 
+    return StreamingResponse(stream(), media_type="text/plain; charset=utf-8")
 
 
 @app.post("/jobs/{job_id}/resolve-location")